@@ -0,0 +1,92 @@
+"""
+Compares the gunicorn sync workers (src/wsgi.py) with uvicorn workers running
+the ASGI entry point (src/asgi.py) on the same number of processes, for the
+routes asgi.py serves on the async engine and one route it hands back to
+Flask. Throughput is reported per worker and per CPU second used by the
+server, so the two models can be compared per core.
+
+    python bench/asgi.py --database-url postgresql://... --workers 1 --concurrency 32
+
+The async workers pay off when the database is a network round trip away;
+against a local SQLite file both models are mostly CPU bound.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from routes import run_server
+from seed import DEFAULT_VOLUMES, ROOT, add_volume_arguments, seed
+
+ROUTES = [
+    ('GET', '/users/{user_id}/favorites'),
+    ('POST', '/favorite/planet/{planet_id}/user/{user_id}'),
+    ('DELETE', '/favorite/planet/{planet_id}/user/{user_id}'),
+    ('POST', '/favorite/people/{character_id}/user/{user_id}'),
+    ('DELETE', '/favorite/people/{character_id}/user/{user_id}'),
+    # served by Flask through the WSGI fallback
+    ('GET', '/people/{character_id}'),
+]
+
+
+def server_commands(workers):
+    src = os.path.join(ROOT, 'src')
+    return {
+        'gunicorn_sync': [sys.executable, '-m', 'gunicorn', 'wsgi', '--chdir', src, '--workers', str(workers),
+                          '--log-level', 'warning', '--bind', '127.0.0.1:{port}'],
+        'uvicorn_asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--app-dir', src,
+                         '--workers', str(workers), '--log-level', 'warning', '--no-access-log',
+                         '--host', '127.0.0.1', '--port', '{port}'],
+    }
+
+
+def per_worker(report, workers):
+    for summary in report['routes'].values():
+        if summary['requests_per_second'] is not None:
+            summary['requests_per_second_per_worker'] = round(summary['requests_per_second'] / workers, 1)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the sync and the async worker models.')
+    add_volume_arguments(parser)
+    parser.add_argument('--requests', type=int, default=500, help='requests per route')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--database-url', help='defaults to a fresh SQLite file')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    volumes = {name: getattr(args, name) for name in DEFAULT_VOLUMES}
+    database_url = args.database_url or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    os.environ['DATABASE_URL'] = database_url
+    # every request comes from the same client
+    os.environ['ADMISSION_RATE'] = '0'
+
+    from app import create_app
+
+    app = create_app()
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'volumes': volumes, 'requests_per_route': args.requests, 'workers': args.workers,
+                   'concurrency': args.concurrency, 'database': database_url.split(':')[0]},
+    }
+    for name, command in server_commands(args.workers).items():
+        # both servers start from the same data
+        seed(app, volumes, args.seed)
+        report[name] = per_worker(run_server(command, dict(os.environ), ROUTES, volumes, args.requests,
+                                             args.seed, args.workers, args.concurrency), args.workers)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
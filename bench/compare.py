@@ -0,0 +1,93 @@
+"""
+Compares two result files of bench/routes.py and exits with status 1 when a
+route got slower (p95) or issues more SQL statements than the baseline.
+Result files of bench/startup.py are compared on their import, create_app,
+first request and gunicorn boot times.
+
+    python bench/compare.py baseline.json current.json --threshold 0.2
+"""
+import argparse
+import json
+import sys
+
+MODES = ('client', 'gunicorn')
+
+
+def compare(baseline, current, threshold):
+    regressions = []
+    lines = []
+    for mode in MODES:
+        if mode not in baseline or mode not in current:
+            continue
+        for route, after in current[mode]['routes'].items():
+            before = baseline[mode]['routes'].get(route)
+            if before is None:
+                continue
+            change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] if before['p95_ms'] else 0
+            line = f'{mode:9} {route:60} p95 {before["p95_ms"]:9.2f} -> {after["p95_ms"]:9.2f} ms ({change:+.0%})'
+            if change > threshold:
+                regressions.append(line)
+            before_sql = before.get('sql_statements_per_request')
+            after_sql = after.get('sql_statements_per_request')
+            if before_sql is not None and after_sql is not None:
+                line += f'  sql {before_sql} -> {after_sql}'
+                if after_sql > before_sql:
+                    regressions.append(f'{mode:9} {route:60} sql {before_sql} -> {after_sql}')
+            lines.append(line)
+    return lines, regressions
+
+
+def startup_timings(profile):
+    timings = {'import_ms': profile['import_ms'], 'create_app_ms': profile['create_app_ms']}
+    for url, value in profile['first_request_ms'].items():
+        timings[f'first {url}'] = value
+    for name in ('gunicorn', 'gunicorn_preload'):
+        if name in profile:
+            timings[f'{name} boot_ms'] = profile[name]['boot_ms']
+    return timings
+
+
+def compare_startup(baseline, current, threshold):
+    regressions = []
+    lines = []
+    for name, profile in current.get('startup', {}).items():
+        if name not in baseline.get('startup', {}):
+            continue
+        before = startup_timings(baseline['startup'][name])
+        for timing, after in startup_timings(profile).items():
+            if timing not in before:
+                continue
+            change = (after - before[timing]) / before[timing] if before[timing] else 0
+            line = f'startup   {name:6} {timing:53} {before[timing]:9.2f} -> {after:9.2f} ms ({change:+.0%})'
+            if change > threshold:
+                regressions.append(line)
+            lines.append(line)
+    return lines, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files.')
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative p95 increase reported as a regression')
+    args = parser.parse_args()
+    with open(args.baseline) as handle:
+        baseline = json.load(handle)
+    with open(args.current) as handle:
+        current = json.load(handle)
+
+    lines, regressions = compare(baseline, current, args.threshold)
+    startup_lines, startup_regressions = compare_startup(baseline, current, args.threshold)
+    lines += startup_lines
+    regressions += startup_regressions
+    print('\n'.join(lines))
+    if regressions:
+        print('\nregressions:')
+        print('\n'.join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,316 @@
+"""
+Benchmarks every route of src/app.py against a seeded database, through the
+Flask test client and through a real gunicorn process, and writes the results
+as JSON so runs can be compared with bench/compare.py.
+
+    python bench/routes.py --characters 100000 --requests 200 --output results.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from seed import DEFAULT_VOLUMES, ROOT, add_volume_arguments, seed
+
+# (method, url template); the placeholders are filled with random seeded ids
+ROUTES = [
+    ('GET', '/user'),
+    ('GET', '/users'),
+    ('GET', '/users?limit=50'),
+    ('GET', '/people'),
+    ('GET', '/people?limit=50'),
+    ('GET', '/people?planet_id={planet_id}'),
+    ('GET', '/people?name=character%201&sort=name&limit=50'),
+    ('GET', '/people/{character_id}'),
+    ('GET', '/people?ids={character_id},{planet_id},{user_id}'),
+    ('GET', '/planets'),
+    ('GET', '/planets?climate=arid&limit=50'),
+    ('GET', '/planets/{planet_id}'),
+    ('GET', '/starships'),
+    ('GET', '/starships/{starship_id}'),
+    ('GET', '/search?q=planet&limit=20'),
+    ('GET', '/search?q=character%207&type=character'),
+    ('GET', '/popular/people'),
+    ('GET', '/popular/planets?limit=50'),
+    ('GET', '/popular/starships'),
+    # the first page of the change log, from its start
+    ('GET', '/changes?since=WzAsIDBd&limit=50'),
+    ('GET', '/users/{user_id}/favorites'),
+    ('POST', '/favorite/planet/{planet_id}/user/{user_id}'),
+    ('DELETE', '/favorite/planet/{planet_id}/user/{user_id}'),
+    ('POST', '/favorite/people/{character_id}/user/{user_id}'),
+    ('DELETE', '/favorite/people/{character_id}/user/{user_id}'),
+    ('POST', '/users/{user_id}/favorites/batch'),
+    ('POST', '/people'),
+]
+# routes that are deliberately not benchmarked
+SKIPPED_ENDPOINTS = {'static', 'sitemap', 'bulk_import', 'cache_stats', 'healthz', 'readyz', 'metrics'}
+
+
+def request_body(method, template, rng, volumes):
+    if template.endswith('/favorites/batch'):
+        return {'items': [{'op': rng.choice(('add', 'remove')), 'type': 'planet',
+                           'id': rng.randint(1, volumes['planets'])} for _ in range(10)]}
+    if method == 'POST' and template == '/people':
+        return {'name': 'bench', 'height': 170, 'description': 'created by the benchmark'}
+    return None
+
+
+def route_rng(seed, template):
+    # POST and DELETE of the same path draw the same ids, so the DELETEs
+    # remove the favorites the POSTs created
+    return random.Random(f'{seed} {template}')
+
+
+def fill(template, rng, volumes):
+    return template.format(
+        user_id=rng.randint(1, volumes['users']),
+        planet_id=rng.randint(1, volumes['planets']),
+        character_id=rng.randint(1, volumes['characters']),
+        starship_id=rng.randint(1, volumes['starships']),
+    )
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, elapsed, statuses, statements=None):
+    summary = {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'statuses': {str(status): statuses.count(status) for status in sorted(set(statuses))},
+    }
+    if statements is not None:
+        summary['sql_statements_per_request'] = round(statements / len(latencies), 2)
+    return summary
+
+
+def check_coverage(app):
+    adapter = app.url_map.bind('localhost')
+    covered = set()
+    for method, template in ROUTES:
+        path = template.split('?')[0].format(user_id=1, planet_id=1, character_id=1, starship_id=1)
+        covered.add((adapter.match(path, method)[0], method))
+    missing = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint in SKIPPED_ENDPOINTS or rule.endpoint.startswith(('admin', '_')) or '.' in rule.endpoint:
+            continue
+        for method in rule.methods - {'HEAD', 'OPTIONS'}:
+            if (rule.endpoint, method) not in covered:
+                missing.append(f'{method} {rule.rule}')
+    return sorted(missing)
+
+
+def run_client(app, volumes, requests, seed):
+    from sqlalchemy import event
+    from models import db
+
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', count)
+    client = app.test_client()
+    results = {}
+    try:
+        for method, template in ROUTES:
+            rng = route_rng(seed, template)
+            latencies, statuses = [], []
+            statements[0] = 0
+            started = time.perf_counter()
+            for _ in range(requests):
+                url = fill(template, rng, volumes)
+                body = request_body(method, template, rng, volumes)
+                request_started = time.perf_counter()
+                response = client.open(url, method=method, json=body)
+                response.get_data()
+                latencies.append(time.perf_counter() - request_started)
+                statuses.append(response.status_code)
+            results[f'{method} {template}'] = summarize(
+                latencies, time.perf_counter() - started, statuses, statements[0])
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    # ru_maxrss is in kilobytes on Linux
+    return {'routes': results, 'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port, process, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('the server exited during startup')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('the server did not start listening')
+
+
+def _worker_pids(master_pid):
+    children = f'/proc/{master_pid}/task/{master_pid}/children'
+    if not os.path.exists(children):
+        return None
+    with open(children) as handle:
+        return handle.read().split()
+
+
+def _worker_peak_rss_mb(master_pid):
+    peak = 0
+    pids = _worker_pids(master_pid)
+    if pids is None:
+        return None
+    # servers started with a single worker may serve from the master process
+    for pid in pids or [str(master_pid)]:
+        try:
+            with open(f'/proc/{pid}/status') as handle:
+                for line in handle:
+                    if line.startswith('VmHWM:'):
+                        peak = max(peak, int(line.split()[1]))
+        except FileNotFoundError:
+            continue
+    return round(peak / 1024, 1)
+
+
+def _cpu_seconds(master_pid):
+    """
+    User and system CPU time used so far by the server and its workers.
+    """
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0
+    for pid in [str(master_pid)] + (_worker_pids(master_pid) or []):
+        try:
+            with open(f'/proc/{pid}/stat') as handle:
+                fields = handle.read().rsplit(')', 1)[1].split()
+        except FileNotFoundError:
+            continue
+        # utime and stime, fields 14 and 15 of proc(5)
+        total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def run_gunicorn(env, volumes, requests, seed, workers, concurrency):
+    command = [sys.executable, '-m', 'gunicorn', 'wsgi', '--chdir', os.path.join(ROOT, 'src'),
+               '--workers', str(workers), '--log-level', 'warning', '--bind', '127.0.0.1:{port}']
+    return run_server(command, env, ROUTES, volumes, requests, seed, workers, concurrency)
+
+
+def run_server(command, env, routes, volumes, requests, seed, workers, concurrency):
+    """
+    Starts `command`, where {port} stands for the port to listen on, and runs
+    `routes` against it from `concurrency` threads.
+    """
+    port = _free_port()
+    process = subprocess.Popen([part.format(port=port) for part in command], env=env)
+    results = {}
+    try:
+        _wait_for_port(port, process)
+
+        def call(args):
+            method, url, body = args
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            started = time.perf_counter()
+            connection.request(method, url, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            connection.close()
+            return time.perf_counter() - started, response.status
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            for method, template in routes:
+                rng = route_rng(seed, template)
+                calls = [(method, fill(template, rng, volumes), request_body(method, template, rng, volumes))
+                         for _ in range(requests)]
+                cpu_started = _cpu_seconds(process.pid)
+                started = time.perf_counter()
+                outcomes = list(pool.map(call, calls))
+                summary = results[f'{method} {template}'] = summarize(
+                    [latency for latency, _ in outcomes], time.perf_counter() - started,
+                    [status for _, status in outcomes])
+                cpu = _cpu_seconds(process.pid) - cpu_started
+                summary['requests_per_cpu_second'] = round(requests / cpu, 1) if cpu else None
+        peak_rss = _worker_peak_rss_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return {'routes': results, 'workers': workers, 'concurrency': concurrency, 'peak_worker_rss_mb': peak_rss}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every route of the API.')
+    add_volume_arguments(parser)
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--mode', choices=('client', 'gunicorn', 'both'), default='both')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--database-url', help='defaults to a fresh SQLite file')
+    parser.add_argument('--no-cache', action='store_true', help='disable the response cache')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='turn the per-client rate limit on (ADMISSION_RATE, else 100 per second), '
+                             'every request comes from the same client')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    volumes = {name: getattr(args, name) for name in DEFAULT_VOLUMES}
+    database_url = args.database_url or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    os.environ['DATABASE_URL'] = database_url
+    if args.no_cache:
+        os.environ['CACHE_MAX_ENTRIES'] = '0'
+    if args.rate_limit:
+        os.environ.setdefault('ADMISSION_RATE', '100')
+    else:
+        os.environ['ADMISSION_RATE'] = '0'
+
+    from app import create_app
+
+    app = create_app()
+    seed(app, volumes, args.seed)
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'volumes': volumes, 'requests_per_route': args.requests, 'cache': not args.no_cache,
+                   'rate_limit': args.rate_limit, 'database': database_url.split(':')[0]},
+        'uncovered_routes': check_coverage(app),
+    }
+    if args.mode in ('client', 'both'):
+        report['client'] = run_client(app, volumes, args.requests, args.seed)
+    if args.mode in ('gunicorn', 'both'):
+        # the routes above wrote favorites and characters: start from the same data
+        seed(app, volumes, args.seed)
+        report['gunicorn'] = run_gunicorn(dict(os.environ), volumes, args.requests, args.seed,
+                                          args.workers, args.concurrency)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
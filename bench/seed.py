@@ -0,0 +1,103 @@
+"""
+Seeds the configured database with synthetic users, planets, characters,
+starships and favorites for the benchmarks.
+
+    DATABASE_URL=sqlite:////tmp/bench.db python bench/seed.py --characters 100000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+DEFAULT_VOLUMES = {
+    'users': 1000,
+    'planets': 500,
+    'characters': 10000,
+    'starships': 1000,
+    'favorites': 20000,
+}
+BATCH_SIZE = 5000
+CLIMATES = ('arid', 'temperate', 'frozen', 'tropical', 'murky')
+TERRAINS = ('desert', 'grasslands', 'tundra', 'jungle', 'swamp')
+
+
+def add_volume_arguments(parser):
+    for name, default in DEFAULT_VOLUMES.items():
+        parser.add_argument(f'--{name}', type=int, default=default)
+
+
+def _insert(db, model, rows):
+    from sqlalchemy import insert
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            db.session.execute(insert(model), batch)
+            batch = []
+    if batch:
+        db.session.execute(insert(model), batch)
+    db.session.commit()
+
+
+def seed(app, volumes, random_seed=42):
+    """
+    Recreates the tables and fills them. Ids are 1..N for every table, which
+    the route benchmarks rely on.
+    """
+    from models import db, User, Planet, Character, Starship, Favorite
+    rng = random.Random(random_seed)
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        _insert(db, User, ({'name': f'user {i}', 'email': f'user{i}@example.com', 'password': 'secret'}
+                           for i in range(volumes['users'])))
+        _insert(db, Planet, ({'name': f'planet {i}', 'climate': CLIMATES[i % len(CLIMATES)],
+                              'terrain': TERRAINS[i % len(TERRAINS)], 'description': 'a planet ' * 10}
+                             for i in range(volumes['planets'])))
+        _insert(db, Character, ({'name': f'character {i}', 'height': 120 + i % 100, 'description': 'a character ' * 10,
+                                 'planet_id': rng.randint(1, volumes['planets']) if volumes['planets'] else None}
+                                for i in range(volumes['characters'])))
+        _insert(db, Starship, ({'name': f'starship {i}', 'model': f'model {i % 50}',
+                                'manufacturer': f'manufacturer {i % 20}', 'description': 'a starship ' * 10}
+                               for i in range(volumes['starships'])))
+
+        kinds = [(column, volumes[table]) for column, table in
+                 (('character_id', 'characters'), ('planet_id', 'planets'), ('starship_id', 'starships'))
+                 if volumes[table] and volumes['users']]
+        seen = set()
+        favorites = []
+        # bounded attempts: small catalogs can't hold every requested favorite
+        for _ in range(volumes['favorites'] * 2 if kinds else 0):
+            if len(favorites) >= volumes['favorites']:
+                break
+            column, count = rng.choice(kinds)
+            favorite = (rng.randint(1, volumes['users']), column, rng.randint(1, count))
+            if favorite not in seen:
+                seen.add(favorite)
+                favorites.append({'user_id': favorite[0], column: favorite[2]})
+        for column, _ in kinds:
+            _insert(db, Favorite, (favorite for favorite in favorites if column in favorite))
+
+        # the bulk inserts above bypass the favorite counters
+        from favorites import backfill_favorite_counts
+        backfill_favorite_counts()
+        db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Seed the database for the benchmarks.')
+    add_volume_arguments(parser)
+    args = parser.parse_args()
+    from app import create_app
+    app = create_app()
+    started = time.perf_counter()
+    seed(app, {name: getattr(args, name) for name in DEFAULT_VOLUMES})
+    print(f'seeded {app.config["SQLALCHEMY_DATABASE_URI"]} in {time.perf_counter() - started:.1f}s')
+
+
+if __name__ == '__main__':
+    main()
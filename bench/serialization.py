@@ -0,0 +1,76 @@
+"""
+Compares the list serialization path (column tuples + JSONProvider) with the
+previous one (ORM objects, serialize() and Flask's default provider) and
+checks that both produce the same bytes.
+
+    python bench/serialization.py --rows 100000 --repeat 5
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+
+def best_of(repeat, fn):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    db_path = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    os.environ['DATABASE_URL'] = f'sqlite:///{db_path}'
+
+    from flask.json.provider import DefaultJSONProvider
+    from sqlalchemy import insert
+    from app import create_app
+    app = create_app()
+    from models import db, Character
+    from pagination import list_response
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(insert(Character), [
+            {'name': f'character {i}', 'height': 150 + i % 60, 'description': 'x' * 120}
+            for i in range(args.rows)
+        ])
+        db.session.commit()
+
+    default_provider = DefaultJSONProvider(app)
+    results = {'rows': args.rows}
+    with app.test_request_context('/people'):
+        def previous():
+            people = Character.query.order_by(Character.id).all()
+            body = default_provider.response({'data': [person.serialize() for person in people]}).get_data()
+            db.session.expunge_all()
+            return body
+
+        def current():
+            response, _ = list_response(Character.query, Character)
+            return response.get_data()
+
+        results['previous_seconds'], previous_body = best_of(args.repeat, previous)
+        results['current_seconds'], current_body = best_of(args.repeat, current)
+
+    results['identical_output'] = previous_body == current_body
+    results['speedup'] = round(results['previous_seconds'] / results['current_seconds'], 2)
+    print(json.dumps(results, indent=2))
+    return 0 if results['identical_output'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
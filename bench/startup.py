@@ -0,0 +1,162 @@
+"""
+Measures how fast the app starts for each APP_PROFILE: import time,
+create_app() time and latency of the first requests in fresh interpreters,
+and the time gunicorn takes to answer its first request with and without
+--preload. Results are JSON, compared between runs with bench/compare.py.
+
+    python bench/startup.py --runs 5 --output startup.json
+"""
+import argparse
+import http.client
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from seed import DEFAULT_VOLUMES, ROOT, add_volume_arguments, seed
+from routes import _free_port, _wait_for_port, _worker_peak_rss_mb, _worker_pids
+
+PROFILES = ('api', 'admin', 'full')
+FIRST_REQUESTS = ('/healthz', '/people?limit=20', '/planets')
+
+# run in a fresh interpreter per measurement, prints its timings as JSON
+PROBE = '''
+import json, resource, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+application = app.create_app()
+created = time.perf_counter()
+client = application.test_client()
+first = {}
+for url in sys.argv[1:]:
+    request_started = time.perf_counter()
+    response = client.get(url)
+    response.get_data()
+    assert response.status_code == 200, (url, response.status_code)
+    first[url] = (time.perf_counter() - request_started) * 1000
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': first,
+    'modules': len(sys.modules),
+    'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+'''
+
+
+def probe(env):
+    output = subprocess.run([sys.executable, '-c', PROBE, *FIRST_REQUESTS], env=env, cwd=os.path.join(ROOT, 'src'),
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def measure_profile(env, runs):
+    samples = [probe(env) for _ in range(runs)]
+    first = {url: round(statistics.median(sample['first_request_ms'][url] for sample in samples), 2)
+             for url in FIRST_REQUESTS}
+    return {
+        'import_ms': round(statistics.median(sample['import_ms'] for sample in samples), 2),
+        'create_app_ms': round(statistics.median(sample['create_app_ms'] for sample in samples), 2),
+        'first_request_ms': first,
+        'modules': samples[-1]['modules'],
+        'peak_rss_mb': round(max(sample['peak_rss_mb'] for sample in samples), 1),
+    }
+
+
+def _workers_private_mb(master_pid):
+    """
+    Memory of the workers that isn't shared with the master or each other,
+    what --preload saves on.
+    """
+    total = 0
+    for pid in _worker_pids(master_pid) or []:
+        try:
+            with open(f'/proc/{pid}/smaps_rollup') as handle:
+                for line in handle:
+                    if line.startswith(('Private_Clean:', 'Private_Dirty:')):
+                        total += int(line.split()[1])
+        except FileNotFoundError:
+            return None
+    return round(total / 1024, 1)
+
+
+def measure_gunicorn(env, workers, preload):
+    """
+    Time from starting gunicorn to the first answer of /planets, which needs
+    a booted worker with its precompiled lists, and the memory of the workers.
+    """
+    port = _free_port()
+    command = [sys.executable, '-m', 'gunicorn', 'wsgi', '--chdir', os.path.join(ROOT, 'src'),
+               '--workers', str(workers), '--log-level', 'warning', '--bind', f'127.0.0.1:{port}']
+    if preload:
+        command.append('--preload')
+    started = time.perf_counter()
+    # run from the root, where gunicorn.conf.py is
+    process = subprocess.Popen(command, env=env, cwd=ROOT)
+    try:
+        _wait_for_port(port, process)
+        while True:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+            try:
+                connection.request('GET', '/planets')
+                if connection.getresponse().status == 200:
+                    break
+            except OSError:
+                time.sleep(0.01)
+            finally:
+                connection.close()
+        boot = time.perf_counter() - started
+        # let every worker finish booting before reading their memory
+        time.sleep(1)
+        peak_rss = _worker_peak_rss_mb(process.pid)
+        private = _workers_private_mb(process.pid)
+    finally:
+        process.terminate()
+        process.wait(timeout=30)
+    return {'boot_ms': round(boot * 1000, 1), 'peak_worker_rss_mb': peak_rss, 'workers_private_mb': private}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the startup of the app per profile.')
+    add_volume_arguments(parser)
+    parser.add_argument('--runs', type=int, default=5, help='fresh interpreters per profile')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--no-gunicorn', action='store_true')
+    parser.add_argument('--database-url', help='defaults to a fresh SQLite file')
+    parser.add_argument('--output', help='write the JSON results to this file')
+    args = parser.parse_args()
+
+    volumes = {name: getattr(args, name) for name in DEFAULT_VOLUMES}
+    database_url = args.database_url or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "bench.db")}'
+    os.environ['DATABASE_URL'] = database_url
+
+    from app import create_app
+    seed(create_app('api'), volumes)
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {'volumes': volumes, 'runs': args.runs, 'workers': args.workers,
+                   'database': database_url.split(':')[0]},
+        'startup': {},
+    }
+    for profile in PROFILES:
+        env = dict(os.environ, APP_PROFILE=profile)
+        report['startup'][profile] = measure_profile(env, args.runs)
+        if not args.no_gunicorn:
+            for preload in (False, True):
+                name = 'gunicorn_preload' if preload else 'gunicorn'
+                report['startup'][profile][name] = measure_gunicorn(env, args.workers, preload)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            handle.write(output)
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
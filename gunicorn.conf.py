@@ -0,0 +1,24 @@
+"""
+Gunicorn settings, read from the directory gunicorn starts in (see Procfile).
+
+With --preload (or GUNICORN_PRELOAD=1) the app is built once in the master
+and the workers fork from it, sharing its memory until they write to it.
+"""
+import os
+
+preload_app = os.getenv('GUNICORN_PRELOAD', '') in ('1', 'true', 'yes')
+
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from app import prepare_for_fork
+        from wsgi import application
+        prepare_for_fork(application)
+
+
+def post_worker_init(worker):
+    # build the precompiled catalog lists before the worker takes requests,
+    # so its first GET /planets or /people doesn't pay for them. Preloaded
+    # workers got them from the master and only check they are current.
+    from precompiled import warm_up
+    warm_up(worker.wsgi)
@@ -38,6 +38,22 @@ def get_metadata():
     return target_db.metadata
 
 
+def include_for_dialect(include_object, dialect_name):
+    """
+    Leaves the objects the models only create on other databases
+    (Index(...).ddl_if(dialect=...)) out of autogenerate, then applies the
+    include_object of the app.
+    """
+    def include(obj, name, type_, reflected, compare_to):
+        ddl_if = getattr(obj, '_ddl_if', None)
+        if not reflected and ddl_if is not None and ddl_if.dialect is not None:
+            dialects = (ddl_if.dialect,) if isinstance(ddl_if.dialect, str) else ddl_if.dialect
+            if dialect_name not in dialects:
+                return False
+        return include_object is None or include_object(obj, name, type_, reflected, compare_to)
+    return include
+
+
 def run_migrations_offline():
     """Run migrations in 'offline' mode.
 
@@ -79,12 +95,16 @@ def run_migrations_online():
 
     connectable = current_app.extensions['migrate'].db.get_engine()
 
+    configure_args = dict(current_app.extensions['migrate'].configure_args)
+
     with connectable.connect() as connection:
+        configure_args['include_object'] = include_for_dialect(
+            configure_args.get('include_object'), connection.dialect.name)
         context.configure(
             connection=connection,
             target_metadata=get_metadata(),
             process_revision_directives=process_revision_directives,
-            **current_app.extensions['migrate'].configure_args
+            **configure_args
         )
 
         with context.begin_transaction():
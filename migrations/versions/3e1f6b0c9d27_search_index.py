@@ -0,0 +1,61 @@
+"""search index
+
+Revision ID: 3e1f6b0c9d27
+Revises: a33f4301732f
+Create Date: 2026-10-18 13:32:10.418215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+SEARCHABLE_TABLES = ('characters', 'planets', 'starships')
+
+# revision identifiers, used by Alembic.
+revision = '3e1f6b0c9d27'
+down_revision = 'a33f4301732f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+    for table in SEARCHABLE_TABLES:
+        if dialect == 'postgresql':
+            # rewrites the table once to compute the column for the existing rows
+            op.execute(
+                f"ALTER TABLE {table} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+                f"setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+                f"setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED")
+            op.execute(f'CREATE INDEX ix_{table}_search ON {table} USING GIN (search_vector)')
+        elif dialect == 'sqlite':
+            index = f'{table}_search'
+            op.execute(
+                f"CREATE VIRTUAL TABLE {index} USING fts5(name, description, content='{table}', "
+                f"content_rowid='id', tokenize='porter unicode61')")
+            op.execute(
+                f"CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN "
+                f"INSERT INTO {index}(rowid, name, description) VALUES (new.id, new.name, new.description); END")
+            op.execute(
+                f"CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN "
+                f"INSERT INTO {index}({index}, rowid, name, description) "
+                f"VALUES ('delete', old.id, old.name, old.description); END")
+            op.execute(
+                f"CREATE TRIGGER {index}_update AFTER UPDATE OF name, description ON {table} BEGIN "
+                f"INSERT INTO {index}({index}, rowid, name, description) "
+                f"VALUES ('delete', old.id, old.name, old.description); "
+                f"INSERT INTO {index}(rowid, name, description) VALUES (new.id, new.name, new.description); END")
+            # index the existing rows
+            op.execute(f"INSERT INTO {index}({index}) VALUES ('rebuild')")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in SEARCHABLE_TABLES:
+        if dialect == 'postgresql':
+            op.execute(f'DROP INDEX ix_{table}_search')
+            op.execute(f'ALTER TABLE {table} DROP COLUMN search_vector')
+        elif dialect == 'sqlite':
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER {table}_search_{trigger}')
+            op.execute(f'DROP TABLE {table}_search')
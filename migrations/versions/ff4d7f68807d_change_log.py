@@ -0,0 +1,95 @@
+"""change log
+
+Revision ID: ff4d7f68807d
+Revises: b862bb8cc22f
+Create Date: 2026-10-18 14:09:55.561305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# the recorded columns of every tracked table, all of them but favorites_count
+TRACKED_COLUMNS = {
+    'characters': ('id', 'name', 'height', 'description', 'planet_id'),
+    'planets': ('id', 'climate', 'name', 'description', 'terrain'),
+    'starships': ('id', 'name', 'model', 'manufacturer', 'description'),
+    'favorites': ('id', 'user_id', 'character_id', 'planet_id', 'starship_id'),
+}
+
+# revision identifiers, used by Alembic.
+revision = 'ff4d7f68807d'
+down_revision = 'b862bb8cc22f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('row_id', sa.Integer(), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('changed_at', sa.DateTime(), nullable=False),
+    sa.Column('txid', sa.BigInteger(), server_default='0', nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+    with op.batch_alter_table('changes', schema=None) as batch_op:
+        batch_op.create_index('ix_changes_changed_at', ['changed_at'], unique=False)
+        batch_op.create_index('ix_changes_position', ['txid', 'id'], unique=False)
+        batch_op.create_index('ix_changes_row', ['table_name', 'row_id', 'id'], unique=False)
+
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        op.execute("""
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+    INSERT INTO changes (table_name, row_id, op, user_id, changed_at, txid)
+    VALUES (TG_TABLE_NAME, (changed->>'id')::integer, lower(TG_OP), (changed->>'user_id')::integer,
+            now() AT TIME ZONE 'utc', txid_current());
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+""")
+    for table, columns in TRACKED_COLUMNS.items():
+        if dialect == 'postgresql':
+            op.execute(
+                f"CREATE TRIGGER {table}_changes AFTER INSERT OR DELETE OR UPDATE OF {', '.join(columns)} "
+                f"ON {table} FOR EACH ROW EXECUTE PROCEDURE record_change()")
+        elif dialect == 'sqlite':
+            for change, timing, row in (('insert', 'INSERT', 'new'),
+                                        ('update', f"UPDATE OF {', '.join(columns)}", 'new'),
+                                        ('delete', 'DELETE', 'old')):
+                user_id = f'{row}.user_id' if 'user_id' in columns else 'NULL'
+                op.execute(
+                    f"CREATE TRIGGER {table}_changes_{change} AFTER {timing} ON {table} BEGIN "
+                    f"INSERT INTO changes (table_name, row_id, op, user_id, changed_at) "
+                    f"VALUES ('{table}', {row}.id, '{change}', {user_id}, CURRENT_TIMESTAMP); END")
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    for table in TRACKED_COLUMNS:
+        if dialect == 'postgresql':
+            op.execute(f'DROP TRIGGER {table}_changes ON {table}')
+        elif dialect == 'sqlite':
+            for change in ('insert', 'update', 'delete'):
+                op.execute(f'DROP TRIGGER {table}_changes_{change}')
+    if dialect == 'postgresql':
+        op.execute('DROP FUNCTION record_change()')
+
+    with op.batch_alter_table('changes', schema=None) as batch_op:
+        batch_op.drop_index('ix_changes_row')
+        batch_op.drop_index('ix_changes_position')
+        batch_op.drop_index('ix_changes_changed_at')
+
+    op.drop_table('changes')
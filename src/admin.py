@@ -1,39 +1,149 @@
 import os
+from flask import g
 from flask_admin import Admin
-from models import db, User, Login, Planet, Character, Starship, Favorite
 from flask_admin.contrib.sqla import ModelView
+from flask_admin.contrib.sqla.filters import FilterEqual
+from sqlalchemy import func, or_, text
+from sqlalchemy.orm import joinedload
+from filters import name_prefix
+from models import db, User, Login, Planet, Character, Starship, Favorite
 
-
-class UserModelView(ModelView):
+# above this many rows the list views show an estimated total
+ESTIMATED_COUNT_THRESHOLD = int(os.getenv('ADMIN_ESTIMATED_COUNT_THRESHOLD', 100000))
+
+
+def estimated_count(session, table):
+    """
+    Row count of `table` from the statistics of the database, None when they
+    have none.
+    """
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # -1 until the table is first analyzed
+        count = session.execute(text('SELECT reltuples::bigint FROM pg_class WHERE oid = CAST(:table AS regclass)'),
+                                {'table': table}).scalar()
+        return count if count is not None and count >= 0 else None
+    if dialect == 'sqlite':
+        # a single seek on the primary key, ids are rarely deleted
+        return session.execute(text(f'SELECT max(rowid) FROM {table}')).scalar() or 0
+    return None
+
+
+def format_count(view, context, model, name):
+    return g.get('admin_counts', {}).get(name, {}).get(model.id, 0)
+
+
+class ScalableModelView(ModelView):
+    """
+    List views that stay fast on large tables:
+
+    - the relationship collections of `column_counts` are shown as counts,
+      one grouped query per column for the rows of the page
+    - past ESTIMATED_COUNT_THRESHOLD rows the total is estimated, and searches
+      and filters use the simple pager instead of counting their matches
+    - search is a prefix match and sorting and filters are limited to indexed
+      columns
+    """
     column_auto_select_related = True
+    column_default_sort = 'id'
+    # list column -> foreign key of the counted rows
+    column_counts = {}
+
+    def __init__(self, model, session, **kwargs):
+        self.column_formatters = dict(self.column_formatters, **{name: format_count for name in self.column_counts})
+        super().__init__(model, session, **kwargs)
+
+    def _apply_search(self, query, count_query, joins, count_joins, search):
+        condition = or_(*[name_prefix(field, search.strip()) for field, _ in self._search_fields])
+        query = query.filter(condition)
+        if count_query is not None:
+            count_query = count_query.filter(condition)
+        return query, count_query, joins, count_joins
+
+    def load_counts(self, rows):
+        ids = [row.id for row in rows]
+        g.admin_counts = {}
+        for name, column in self.column_counts.items():
+            counts = self.session.query(column, func.count()).filter(column.in_(ids)).group_by(column) if ids else []
+            g.admin_counts[name] = dict(counts)
+
+    def get_list(self, page, sort_column, sort_desc, search, filters, execute=True, page_size=None):
+        # ModelView.get_list, counting only what is cheap to count
+        joins = {}
+        count_joins = {}
+        estimate = estimated_count(self.session, self.model.__tablename__)
+        large = estimate is not None and estimate > ESTIMATED_COUNT_THRESHOLD
+
+        query = self.get_query()
+        count_query = self.get_count_query() if not large else None
+        if self._search_supported and search:
+            query, count_query, joins, count_joins = self._apply_search(
+                query, count_query, joins, count_joins, search)
+        if filters and self._filters:
+            query, count_query, joins, count_joins = self._apply_filters(
+                query, count_query, joins, count_joins, filters)
+
+        if count_query is not None:
+            count = count_query.scalar()
+        elif search or filters:
+            count = None
+        else:
+            count = estimate
+
+        for join in self._auto_joins:
+            query = query.options(joinedload(join))
+        query, joins = self._apply_sorting(query, joins, sort_column, sort_desc)
+        query = self._apply_pagination(query, page, page_size)
+
+        if execute:
+            query = query.all()
+            self.load_counts(query)
+        return count, query
+
+
+class UserModelView(ScalableModelView):
     column_list = ("id", "name", "email", "password", "is_active", "favorites", "logins")
+    column_counts = {'favorites': Favorite.user_id, 'logins': Login.user_id}
+    column_searchable_list = ("email",)
+    column_sortable_list = ("id", "email")
 
 
-class LoginModelView(ModelView):
-    column_auto_select_related = True
+class LoginModelView(ScalableModelView):
     column_list = ("id", "user_id", "user")
+    column_sortable_list = ("id",)
+    column_filters = (FilterEqual(Login.user_id, 'User id'),)
 
 
-class PlanetModelView(ModelView):
-    column_auto_select_related = True
+class PlanetModelView(ScalableModelView):
+    # favorites_count is the count of the favorites
     column_list = ("id", "name", "climate", "terrain",
-                   "description", "characters", "favorites")
+                   "description", "characters", "favorites_count")
+    column_counts = {'characters': Character.planet_id}
+    column_searchable_list = ("name",)
+    column_sortable_list = ("id", "name", "favorites_count")
+    column_filters = (FilterEqual(Planet.climate, 'Climate'), FilterEqual(Planet.terrain, 'Terrain'))
+    # maintained by the favorites write path
+    form_excluded_columns = ("favorites_count",)
 
 
-class CharacterModelView(ModelView):
-    column_auto_select_related = True
+class CharacterModelView(ScalableModelView):
     column_list = ("id", "name", "description",
-                   "planet_id", "planet", "favorites")
+                   "planet_id", "planet", "favorites_count")
+    column_searchable_list = ("name",)
+    column_sortable_list = ("id", "name", "height", "favorites_count")
+    column_filters = (FilterEqual(Character.planet_id, 'Planet id'), FilterEqual(Character.height, 'Height'))
+    form_excluded_columns = ("favorites_count",)
 
 
-class StarshipModelView(ModelView):
-    column_auto_select_related = True
+class StarshipModelView(ScalableModelView):
     column_list = ("id", "name", "model", "manufacturer",
-                   "description", "favorites")
+                   "description", "favorites_count")
+    column_searchable_list = ("name",)
+    column_sortable_list = ("id", "name", "favorites_count")
+    form_excluded_columns = ("favorites_count",)
 
 
-class FavoriteModelView(ModelView):
-    column_auto_select_related = True
+class FavoriteModelView(ScalableModelView):
     column_list = (
         "id",
         "user_id", "user",
@@ -41,6 +151,13 @@ class FavoriteModelView(ModelView):
         "planet_id", "planet",
         "starship_id", "starship",
     )
+    column_sortable_list = ("id",)
+    column_filters = (
+        FilterEqual(Favorite.user_id, 'User id'),
+        FilterEqual(Favorite.character_id, 'Character id'),
+        FilterEqual(Favorite.planet_id, 'Planet id'),
+        FilterEqual(Favorite.starship_id, 'Starship id'),
+    )
 
 
 def setup_admin(app):
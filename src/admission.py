@@ -0,0 +1,377 @@
+"""
+Admission control: keeps the expensive endpoints from taking every worker and
+database connection during a spike, so the cheap lookups still get through.
+
+- rate limit, off unless ADMISSION_RATE is set: every client address has a
+  token bucket of ADMISSION_BURST tokens refilled at ADMISSION_RATE per
+  second, and each request takes the cost of its endpoint (POLICIES). An
+  empty bucket gets 429 with Retry-After. The address is the one of the
+  connection: behind a proxy, set TRUSTED_PROXIES (see app.py) or every
+  client shares the bucket of the proxy.
+- concurrency, only with the Redis backend: the endpoints with a
+  `concurrency` run at most that many requests at once across the workers.
+  The others wait in a bounded queue, ADMISSION_QUEUE_SIZE per endpoint and
+  worker, for up to ADMISSION_QUEUE_TIMEOUT seconds. A full queue or a
+  request still waiting at the deadline gets 503 with Retry-After.
+
+The counters live in a backend: in Redis with a Redis cache backend
+(CACHE_URL), so they apply to all the workers, or in the process otherwise.
+An unavailable Redis lets requests through. In the process, the slots would
+be counted per worker, and a sync worker serves one request at a time, so
+the concurrency limits are off there unless ADMISSION_LOCAL_CONCURRENCY=1
+(threaded workers). A sync worker holds a queued request, which
+ADMISSION_QUEUE_SIZE=0 avoids by shedding at once. The favorite routes
+served by asgi.py skip admission.
+
+Queue depths, waits and shed requests are exported in /metrics (admission_*).
+"""
+import logging
+import math
+import os
+import threading
+import time
+import uuid
+from flask import g, jsonify, request
+from instrumentation import current_stats, wait_timer
+from pagination import wants_pagination
+
+logger = logging.getLogger(__name__)
+
+# tokens per second and client, 0 turns the rate limit off
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 0))
+ADMISSION_BURST = float(os.getenv('ADMISSION_BURST', 200))
+ADMISSION_LIST_CONCURRENCY = int(os.getenv('ADMISSION_LIST_CONCURRENCY', 4))
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 32))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 2))
+# concurrency limits of the memory backend, counted per worker
+ADMISSION_LOCAL_CONCURRENCY = os.getenv('ADMISSION_LOCAL_CONCURRENCY', '') in ('1', 'true', 'yes')
+# queued requests look for a free slot this often, for the ones freed by other workers
+ADMISSION_POLL_SECONDS = 0.02
+# a slot of a worker that died is freed after this long (Redis backend)
+ADMISSION_LEASE_SECONDS = 60
+# token buckets kept by the memory backend before the idle ones are dropped
+MAX_BUCKETS = 10000
+
+EXEMPT_ENDPOINTS = {'healthz', 'readyz', 'metrics', 'static'}
+
+
+class Policy:
+    """
+    Cost of the requests of an endpoint in rate limit tokens, with
+    `unbounded_cost` for the list requests without a limit, and the number of
+    them that run at once (None for no limit). The part of `unbounded_cost`
+    above `cost` is only taken from the requests that ran SQL statements,
+    not from the ones served from memory (cache, precompiled bodies).
+    """
+
+    def __init__(self, cost=1, unbounded_cost=None, concurrency=None):
+        self.cost = cost
+        self.unbounded_cost = unbounded_cost
+        self.concurrency = concurrency
+
+    def request_cost(self):
+        """
+        (tokens taken before the request, tokens taken after it if it ran SQL)
+        """
+        if self.unbounded_cost is not None and not wants_pagination() and 'ids' not in request.args:
+            return self.cost, self.unbounded_cost - self.cost
+        return self.cost, 0
+
+
+DEFAULT_POLICY = Policy()
+# endpoint -> policy, DEFAULT_POLICY for the others
+POLICIES = {
+    'get_users': Policy(cost=2, unbounded_cost=20, concurrency=ADMISSION_LIST_CONCURRENCY),
+    'get_people': Policy(cost=2, unbounded_cost=20, concurrency=ADMISSION_LIST_CONCURRENCY),
+    'get_planets': Policy(cost=2, unbounded_cost=20, concurrency=ADMISSION_LIST_CONCURRENCY),
+    'get_starships': Policy(cost=2, unbounded_cost=20, concurrency=ADMISSION_LIST_CONCURRENCY),
+    'search_catalog': Policy(cost=5, concurrency=ADMISSION_LIST_CONCURRENCY),
+    'get_popular': Policy(cost=2),
+    'batch_favorites': Policy(cost=5),
+    'bulk_import': Policy(cost=50, concurrency=1),
+}
+
+
+class Shed(Exception):
+    def __init__(self, status_code, msg, retry_after):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.msg = msg
+        self.retry_after = retry_after
+
+
+class MemoryBackend:
+    """
+    Slots and token buckets of this process.
+    """
+    name = 'memory'
+
+    def __init__(self):
+        self._slots = {}
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, endpoint, limit):
+        with self._lock:
+            if self._slots.get(endpoint, 0) >= limit:
+                return None
+            self._slots[endpoint] = self._slots.get(endpoint, 0) + 1
+            return endpoint
+
+    def release(self, endpoint, token):
+        with self._lock:
+            self._slots[endpoint] -= 1
+
+    def take(self, key, cost, rate, burst, debit=False):
+        """
+        Takes `cost` tokens from the bucket of `key`. Returns 0, or the
+        seconds until the bucket has them when it hasn't yet. A `debit` takes
+        them anyway, leaving the bucket below zero.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) >= MAX_BUCKETS:
+                # idle long enough to be full again
+                self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                                 if bucket[0] + (now - bucket[1]) * rate < burst}
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= cost or debit:
+                self._buckets[key] = (tokens - cost, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (cost - tokens) / rate
+
+    def stats(self):
+        return {}
+
+
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('PEXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local now = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local wait = 0
+if tokens >= cost or ARGV[5] == '1' then
+    tokens = tokens - cost
+else
+    wait = (cost - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.max(1, math.ceil((burst - tokens) / rate * 1000)))
+return tostring(wait)
+"""
+
+
+class RedisBackend:
+    """
+    Slots and token buckets shared by every worker, updated by Lua scripts so
+    each check is atomic. Slots are leased: those of a worker that died
+    without releasing them expire after ADMISSION_LEASE_SECONDS.
+    """
+    name = 'redis'
+
+    def __init__(self, client, prefix='swapi:admission:'):
+        self.client = client
+        self.prefix = prefix
+        self.errors = 0
+        self._acquire = client.register_script(ACQUIRE_SCRIPT)
+        self._take = client.register_script(TAKE_SCRIPT)
+
+    def _failed(self, action):
+        self.errors += 1
+        logger.warning('admission %s failed', action, exc_info=True)
+
+    def acquire(self, endpoint, limit):
+        token = uuid.uuid4().hex
+        now = time.time()
+        try:
+            acquired = self._acquire(keys=[f'{self.prefix}slots:{endpoint}'], args=[
+                now, limit, now + ADMISSION_LEASE_SECONDS, token, ADMISSION_LEASE_SECONDS * 1000])
+        except Exception:
+            self._failed('acquire')
+            # let the request through, without a slot to release
+            return ''
+        return token if acquired else None
+
+    def release(self, endpoint, token):
+        if not token:
+            return
+        try:
+            self.client.zrem(f'{self.prefix}slots:{endpoint}', token)
+        except Exception:
+            # the lease runs out on its own
+            self._failed('release')
+
+    def take(self, key, cost, rate, burst, debit=False):
+        try:
+            return float(self._take(keys=[f'{self.prefix}bucket:{key}'],
+                                    args=[rate, burst, cost, time.time(), int(debit)]))
+        except Exception:
+            self._failed('take')
+            return 0.0
+
+    def stats(self):
+        return {'errors': self.errors}
+
+
+def create_backend(cache_backend=None):
+    client = getattr(cache_backend, 'client', None)
+    if client is not None:
+        return RedisBackend(client)
+    return MemoryBackend()
+
+
+class Admission:
+    def __init__(self, backend, rate=ADMISSION_RATE, burst=ADMISSION_BURST,
+                 queue_size=ADMISSION_QUEUE_SIZE, queue_timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        # endpoint -> counters, for the metrics
+        self.counters = {}
+        # set by setup_admission() from the backend
+        self.limit_concurrency = False
+        self._released = threading.Condition()
+
+    def _counters(self, endpoint):
+        if endpoint not in self.counters:
+            self.counters[endpoint] = {'in_flight': 0, 'queued': 0, 'admitted': 0, 'waited': 0,
+                                       'wait_seconds': 0.0, 'shed_rate': 0, 'shed_queue_full': 0,
+                                       'shed_timeout': 0}
+        return self.counters[endpoint]
+
+    def check_rate(self, client, endpoint, cost):
+        if not self.rate:
+            return
+        wait = self.backend.take(client, min(cost, self.burst), self.rate, self.burst)
+        if wait > 0:
+            with self._released:
+                self._counters(endpoint)['shed_rate'] += 1
+            raise Shed(429, 'Too many requests', wait)
+
+    def debit(self, client, cost):
+        if self.rate:
+            self.backend.take(client, cost, self.rate, self.burst, debit=True)
+
+    def acquire(self, endpoint, limit):
+        """
+        A slot of the `limit` slots of `endpoint`, waiting in its queue for
+        one to free up until the queue timeout.
+        """
+        with self._released:
+            counters = self._counters(endpoint)
+        token = self.backend.acquire(endpoint, limit)
+        if token is None:
+            with self._released:
+                if counters['queued'] >= self.queue_size:
+                    counters['shed_queue_full'] += 1
+                    raise Shed(503, 'Too busy, try again later', self.queue_timeout)
+                counters['queued'] += 1
+            started = time.monotonic()
+            deadline = started + self.queue_timeout
+            try:
+                with wait_timer():
+                    while token is None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        with self._released:
+                            self._released.wait(min(remaining, ADMISSION_POLL_SECONDS))
+                        token = self.backend.acquire(endpoint, limit)
+            finally:
+                with self._released:
+                    counters['queued'] -= 1
+                    counters['waited'] += 1
+                    counters['wait_seconds'] += time.monotonic() - started
+            if token is None:
+                with self._released:
+                    counters['shed_timeout'] += 1
+                raise Shed(503, 'Too busy, try again later', self.queue_timeout)
+        with self._released:
+            counters['in_flight'] += 1
+            counters['admitted'] += 1
+        return token
+
+    def release(self, endpoint, token):
+        self.backend.release(endpoint, token)
+        with self._released:
+            self._counters(endpoint)['in_flight'] -= 1
+            self._released.notify()
+
+    def stats(self):
+        stats = {f'{endpoint}_{name}': value for endpoint, counters in sorted(self.counters.items())
+                 for name, value in counters.items()}
+        return {'backend': self.backend.name, **stats, **self.backend.stats()}
+
+
+def client_key():
+    # not the user id of the URL: nothing authenticates it
+    return f'address:{request.remote_addr}'
+
+
+def shed_response(shed):
+    response = jsonify({'msg': shed.msg})
+    response.status_code = shed.status_code
+    response.headers['Retry-After'] = str(max(1, math.ceil(shed.retry_after)))
+    return response
+
+
+admission = Admission(MemoryBackend())
+
+
+def setup_admission(app, cache_backend=None):
+    admission.backend = create_backend(cache_backend)
+    admission.limit_concurrency = admission.backend.name == 'redis' or ADMISSION_LOCAL_CONCURRENCY
+
+    @app.before_request
+    def admit_request():
+        endpoint = request.endpoint
+        if endpoint is None or endpoint in EXEMPT_ENDPOINTS or request.blueprint is not None:
+            return None
+        policy = POLICIES.get(endpoint, DEFAULT_POLICY)
+        cost, later_cost = policy.request_cost()
+        try:
+            admission.check_rate(client_key(), endpoint, cost)
+            if later_cost:
+                g.admission_debit = (client_key(), later_cost)
+            if policy.concurrency is not None and admission.limit_concurrency:
+                g.admission_slot = (endpoint, admission.acquire(endpoint, policy.concurrency))
+        except Shed as shed:
+            return shed_response(shed)
+        return None
+
+    # Flask runs the after_request hooks in the reverse order of their
+    # registration: this one, registered after report_request_stats() (see
+    # create_app), runs before it pops the stats of the request
+    @app.after_request
+    def charge_queries(response):
+        debit = g.pop('admission_debit', None)
+        stats = current_stats()
+        if debit is not None and stats is not None and stats.statements:
+            admission.debit(*debit)
+        return response
+
+    @app.teardown_request
+    def release_slot(error=None):
+        slot = g.pop('admission_slot', None)
+        if slot is not None:
+            admission.release(*slot)
+
+    return admission
@@ -1,46 +1,193 @@
 """
 This module takes care of starting the API Server, Loading the DB and Adding the endpoints
+
+create_app() builds the app for one of the APP_PROFILES (APP_PROFILE):
+
+    api    the JSON API only, what the API pods run
+    admin  the API and Flask-Admin
+    full   the API, Flask-Admin, the migrations and the flask commands (default)
+
+The optional subsystems are only imported by the profiles that use them, an
+api worker never loads Flask-Admin, Alembic or the commands. With gunicorn
+--preload, see prepare_for_fork().
 """
+import gc
+import io
 import os
-from flask import Flask, request, jsonify, url_for
-from flask_migrate import Migrate
-from flask_swagger import swagger
+from flask import Flask, Response, current_app, request, jsonify, url_for
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy.orm import configure_mappers, joinedload
 from utils import APIException, generate_sitemap
-from admin import setup_admin
-from models import db, User, Character, Planet, Favorite  
+from pagination import list_response, page_response, parse_limit, decode_cursor, encode_cursor
+from search import SEARCHABLE, include_object, search, search_terms, truncated_kinds
+from filters import parse_fields
+from serializers import JSONProvider, row_dicts
+from cache import cached_response, response_cache
+from precompiled import full_list_response, precompiled_stats, warm_up
+from compression import setup_compression
+from ingest import IMPORTABLE_MODELS, FORMATS, DEFAULT_BATCH_SIZE, import_rows
+from instrumentation import setup_instrumentation, route_metrics, record_rows
+from database import database_url, engine_options, pool_status, check_database, track_pool
+from replicas import setup_replicas, replica_set
+from admission import setup_admission
+from changes import feed_response, maintenance as change_log_maintenance
+from user_favorites import (add_to_document, remove_from_document, rebuild_document, document_body,
+                            refresher as favorite_documents)
+from models import db, User, Character, Planet, Starship, Favorite
+from favorites import (add_favorite, remove_favorite, get_favorite, apply_favorite_batch,
+                       MAX_BATCH_SIZE, EXISTS, USER_NOT_FOUND, ITEM_NOT_FOUND, KIND_ALIASES)
+
+# proxies in front of the app, whose X-Forwarded-For and X-Forwarded-Proto
+# are trusted: request.remote_addr is then the client, see admission.py
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+
+# /popular/<kind>
+POPULAR_MODELS = {'people': Character, 'planets': Planet, 'starships': Starship}
+DEFAULT_POPULAR_LIMIT = 10
+MAX_POPULAR_LIMIT = 100
+
+# (rule, view, options) of every endpoint, added to the app by create_app()
+ROUTES = []
+
+
+def route(rule, **options):
+    def decorator(view):
+        ROUTES.append((rule, view, options))
+        return view
+    return decorator
+
+
+def setup_admin_views(app):
+    from admin import setup_admin
+    setup_admin(app)
+
+
+def setup_migrations(app):
+    from flask_migrate import Migrate
+    Migrate(app, db, include_object=include_object)
+
+
+def setup_cli_commands(app):
+    from commands import setup_commands
+    setup_commands(app)
+
+
+# optional subsystems of each profile
+APP_PROFILES = {
+    'api': (),
+    'admin': (setup_admin_views,),
+    'full': (setup_admin_views, setup_migrations, setup_cli_commands),
+}
+
+
+def create_app(config=None):
+    """
+    Builds the app. `config` is a profile name or a mapping of Flask settings,
+    where APP_PROFILE picks the profile; the APP_PROFILE environment variable
+    otherwise.
+    """
+    if isinstance(config, str):
+        config = {'APP_PROFILE': config}
+    config = dict(config or {})
+    profile = config.setdefault('APP_PROFILE', os.getenv('APP_PROFILE', 'full'))
+    if profile not in APP_PROFILES:
+        raise ValueError(f'APP_PROFILE must be one of {", ".join(APP_PROFILES)}, not {profile!r}')
+
+    app = Flask(__name__)
+    if TRUSTED_PROXIES:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+    app.json = JSONProvider(app)
+    app.url_map.strict_slashes = False
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url()
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config.update(config)
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+
+    db.init_app(app)
+    with app.app_context():
+        track_pool(db.engine, 'primary')
+    CORS(app)
+    setup_instrumentation(app, db)
+    setup_replicas(app, db, response_cache.backend)
+    admission = setup_admission(app, response_cache.backend)
+    compression = setup_compression(app)
+    route_metrics.register_stats('response_cache', response_cache.stats,
+                                 counters=('hits', 'misses', 'evictions', 'versions_reads', 'versions_errors'))
+    route_metrics.register_stats('db_pool', pool_status, label='pool',
+                                 counters=('connects', 'checkouts', 'invalidations', 'wait_seconds_total'))
+    route_metrics.register_stats('db_replicas', replica_set.stats,
+                                 counters=('primary_reads', 'reads_*', 'failures_*'))
+    route_metrics.register_stats('precompiled_lists', precompiled_stats, counters=('*_rebuilds', '*_patches'))
+    route_metrics.register_stats('compression', compression.stats,
+                                 counters=('compressed', 'streamed', 'cache_hits', 'bytes_in', 'bytes_out'))
+    route_metrics.register_stats('change_log', change_log_maintenance.stats, counters=('runs', 'deleted'))
+    route_metrics.register_stats('favorite_documents', favorite_documents.stats,
+                                 counters=('runs', 'rebuilt', 'failures'))
+    route_metrics.register_stats('admission', admission.stats,
+                                 counters=('*_admitted', '*_waited', '*_wait_seconds', '*_shed_*', 'errors'))
+
+    app.register_error_handler(APIException, handle_invalid_usage)
+    for rule, view, options in ROUTES:
+        app.add_url_rule(rule, view_func=view, **options)
+    for setup in APP_PROFILES[profile]:
+        setup(app)
+    return app
+
+
+def prepare_for_fork(app):
+    """
+    Runs in the gunicorn master when the app is preloaded (--preload): does
+    once what every worker would do on its own, closes the connections the
+    workers must not share, and moves everything allocated so far out of
+    reach of the garbage collector, whose passes would otherwise write to
+    (and copy) the pages the workers share with the master.
+    """
+    configure_mappers()
+    warm_up(app)
+    with app.app_context():
+        db.engine.dispose()
+    for replica in replica_set.replicas:
+        replica.engine.dispose()
+    gc.freeze()
 
-app = Flask(__name__)
-app.url_map.strict_slashes = False
 
-db_url = os.getenv("DATABASE_URL")
-if db_url is not None:
-    app.config['SQLALCHEMY_DATABASE_URI'] = db_url.replace(
-        "postgres://", "postgresql://")
-else:
-    app.config['SQLALCHEMY_DATABASE_URI'] = "sqlite:////tmp/test.db"
+# Handle/serialize errors like a JSON object
+def handle_invalid_usage(error):
+    return jsonify(error.to_dict()), error.status_code
 
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False  
 
-MIGRATE = Migrate(app, db)
-db.init_app(app)
-CORS(app)
-setup_admin(app)
+@route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok'}), 200
 
 
-# Handle/serialize errors like a JSON object
-@app.errorhandler(APIException)
-def handle_invalid_usage(error):
-    return jsonify(error.to_dict()), error.status_code
+@route('/readyz', methods=['GET'])
+def readyz():
+    error = check_database(db.engine)
+    if error is not None:
+        return jsonify({'status': 'unavailable', 'error': error.__class__.__name__}), 503
+    return jsonify({'status': 'ok'}), 200
+
+
+@route('/metrics', methods=['GET'])
+def metrics():
+    return Response(route_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify({'data': response_cache.stats()}), 200
 
 
 # generate sitemap with all your endpoints
-@app.route('/')
+@route('/')
 def sitemap():
-    return generate_sitemap(app)
+    return generate_sitemap(current_app)
 
 
-@app.route('/user', methods=['GET'])
+@route('/user', methods=['GET'])
 def handle_hello():
     response_body = {
         "msg": "Hello, this is your GET /user response "
@@ -48,34 +195,38 @@ def handle_hello():
     return jsonify(response_body), 200
 
 
-@app.route('/users', methods=['GET'])
+def cached_tables(table):
+    # favorites_count changes with the favorites table, not with the item
+    if 'favorites_count' in request.args.get('fields', '').split(','):
+        return (table, 'favorites')
+    return table
+
+
+@route('/users', methods=['GET'])
 def get_users():
-    users = User.query.all()
-    users_serialized = []
-    for user in users:
-        users_serialized.append(user.serialize())
-    return jsonify({'data': users_serialized}), 200
+    return cached_response('users', lambda: list_response(User.query, User))
 
 
-@app.route('/people', methods=['GET'])
+@route('/people', methods=['GET'])
 def get_people():
-    people = Character.query.all()
-    people_serialized = []
-    for person in people:
-        people_serialized.append(person.serialize())
-    return jsonify({'data': people_serialized}), 200
+    return full_list_response('characters', lambda: cached_response(
+        cached_tables('characters'), lambda: list_response(Character.query, Character)))
 
 
-@app.route('/people/<int:people_id>', methods=['GET'])
+@route('/people/<int:people_id>', methods=['GET'])
 def get_single_person(people_id):
+    return cached_response(cached_tables('characters'), lambda: single_person(people_id))
+
+
+def single_person(people_id):
     person = Character.query.get(people_id)
     if person is None:
         return jsonify({'msg': 'Character not found'}), 404
-    return jsonify({'data': person.serialize()}), 200
+    return jsonify({'data': person.serialize(parse_fields(Character))}), 200
 
 
 
-@app.route('/people', methods=['POST'])
+@route('/people', methods=['POST'])
 def add_character():
     body = request.get_json(silent=True)
     if body is None:
@@ -103,30 +254,118 @@ def add_character():
 
 
 
-@app.route('/planets', methods=['GET'])
+@route('/planets', methods=['GET'])
 def get_planets():
-    planets = Planet.query.all()
-    planets_serialized = []
-    for planet in planets:
-        planets_serialized.append(planet.serialize())
-    return jsonify({'data': planets_serialized}), 200
+    return full_list_response('planets', lambda: cached_response(
+        cached_tables('planets'), lambda: list_response(Planet.query, Planet)))
 
 
-@app.route('/planets/<int:planet_id>', methods=['GET'])
+@route('/planets/<int:planet_id>', methods=['GET'])
 def get_single_planet(planet_id):
+    return cached_response(cached_tables('planets'), lambda: single_planet(planet_id))
+
+
+def single_planet(planet_id):
     planet = Planet.query.get(planet_id)
     if planet is None:
         return jsonify({'msg': 'Planet not found'}), 404
-    return jsonify({'data': planet.serialize()}), 200
-
-
-@app.route('/users/<int:user_id>/favorites', methods=['GET'])
+    return jsonify({'data': planet.serialize(parse_fields(Planet))}), 200
+
+
+@route('/starships', methods=['GET'])
+def get_starships():
+    return cached_response(cached_tables('starships'), lambda: list_response(Starship.query, Starship))
+
+
+@route('/starships/<int:starship_id>', methods=['GET'])
+def get_single_starship(starship_id):
+    return cached_response(cached_tables('starships'), lambda: single_starship(starship_id))
+
+
+def single_starship(starship_id):
+    starship = Starship.query.get(starship_id)
+    if starship is None:
+        return jsonify({'msg': 'Starship not found'}), 404
+    return jsonify({'data': starship.serialize(parse_fields(Starship))}), 200
+
+
+@route('/popular/<kind>', methods=['GET'])
+def get_popular(kind):
+    model = POPULAR_MODELS.get(kind)
+    if model is None:
+        return jsonify({'msg': f'type must be one of {", ".join(POPULAR_MODELS)}'}), 404
+    return cached_response((model.__tablename__, 'favorites'), lambda: popular_items(model))
+
+
+def popular_items(model):
+    limit = request.args.get('limit', DEFAULT_POPULAR_LIMIT, type=int)
+    if limit is None or limit < 1:
+        return jsonify({'msg': 'limit must be a positive integer'}), 400
+    keys = model.serialized_columns + ('favorites_count',)
+    # a backward scan of the favorites_count index, stopping after `limit` rows
+    rows = model.query.with_entities(*[getattr(model, key) for key in keys]).filter(
+        model.favorites_count > 0,
+    ).order_by(model.favorites_count.desc(), model.id.desc()).limit(min(limit, MAX_POPULAR_LIMIT)).all()
+    record_rows(len(rows))
+    return jsonify({'data': row_dicts(rows, keys)}), 200
+
+
+@route('/search', methods=['GET'])
+def search_catalog():
+    return cached_response(tuple(table.name for table in SEARCHABLE.values()), search_results)
+
+
+def search_results():
+    terms = search_terms(request.args.get('q', ''))
+    if not terms:
+        return jsonify({'msg': 'q must contain at least one word'}), 400
+    kinds = list(SEARCHABLE)
+    if request.args.get('type'):
+        kinds = [KIND_ALIASES.get(kind, kind) for kind in request.args['type'].split(',')]
+        if any(kind not in SEARCHABLE for kind in kinds):
+            return jsonify({'msg': f'type must be a comma separated list of {", ".join(SEARCHABLE)}'}), 400
+    limit = parse_limit()
+    after = request.args.get('after')
+    position = decode_cursor(after) if after else None
+    if position is not None and (not isinstance(position, list) or len(position) != 3):
+        raise APIException('Invalid cursor', status_code=400)
+
+    rows = search(terms, sorted(set(kinds)), limit, position)
+    record_rows(len(rows))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        item_type, item_id, _, rank = rows[-1]
+        next_cursor = encode_cursor([rank, item_type, item_id])
+    # only the best SEARCH_MAX_CANDIDATES matches of these types were kept
+    truncated = bool(truncated_kinds(terms, sorted(set(kinds))))
+    return page_response([{'type': item_type, 'id': item_id, 'name': name, 'rank': rank}
+                          for item_type, item_id, name, rank in rows], next_cursor, truncated=truncated)
+
+
+@route('/changes', methods=['GET'])
+def get_changes():
+    # never cached: a cursor only moves forward
+    return feed_response()
+
+
+@route('/users/<int:user_id>/favorites', methods=['GET'])
 def get_user_favorites(user_id):
+    body = document_body(db.session, user_id)
+    if body is not None:
+        return current_app.response_class(body, mimetype='application/json')
+
     user = User.query.get(user_id)
     if user is None:
         return jsonify({'msg': 'User not found'}), 404
 
-    favorites = Favorite.query.filter_by(user_id=user_id).all()
+    # the item of every favorite comes in the same query (LEFT OUTER JOINs),
+    # so serialize() below never lazy loads
+    favorites = Favorite.query.options(
+        joinedload(Favorite.character),
+        joinedload(Favorite.planet),
+        joinedload(Favorite.starship),
+    ).filter_by(user_id=user_id).order_by(Favorite.id).all()
     favorites_serialized = []
     for fav in favorites:
         favorites_serialized.append(fav.serialize())
@@ -134,79 +373,86 @@ def get_user_favorites(user_id):
     return jsonify({'data': favorites_serialized}), 200
 
 
-@app.route('/favorite/planet/<int:planet_id>/user/<int:user_id>', methods=['POST'])
-def add_favorite_planet(planet_id, user_id):
-    user = User.query.get(user_id)
-    if user is None:
+def favorite_created(kind, item_id, user_id, not_found_msg, created_msg):
+    status, favorite_id = add_favorite(user_id, kind, item_id)
+    if status == USER_NOT_FOUND:
         return jsonify({'msg': 'User not found'}), 404
-
-    planet = Planet.query.get(planet_id)
-    if planet is None:
-        return jsonify({'msg': 'Planet not found'}), 404
-
-    existing_fav = Favorite.query.filter_by(user_id=user_id, planet_id=planet_id).first()
-    if existing_fav is not None:
+    if status == ITEM_NOT_FOUND:
+        return jsonify({'msg': not_found_msg}), 404
+    if status == EXISTS:
         return jsonify({'msg': 'Favorite already exists'}), 409
+    add_to_document(db.session, user_id, favorite_id)
+    db.session.commit()
+    return jsonify({'msg': created_msg, 'data': get_favorite(favorite_id).serialize()}), 201
 
-    new_fav = Favorite()
-    new_fav.user_id = user_id
-    new_fav.planet_id = planet_id
 
-    db.session.add(new_fav)
+def favorite_deleted(kind, item_id, user_id, deleted_msg):
+    if not remove_favorite(user_id, kind, item_id):
+        return jsonify({'msg': 'Favorite not found'}), 404
+    remove_from_document(db.session, user_id, kind, item_id)
     db.session.commit()
+    return jsonify({'msg': deleted_msg}), 200
 
-    return jsonify({'msg': 'Favorite planet added', 'data': new_fav.serialize()}), 201
 
+@route('/favorite/planet/<int:planet_id>/user/<int:user_id>', methods=['POST'])
+def add_favorite_planet(planet_id, user_id):
+    return favorite_created('planet', planet_id, user_id, 'Planet not found', 'Favorite planet added')
 
-@app.route('/favorite/people/<int:people_id>/user/<int:user_id>', methods=['POST'])
-def add_favorite_people(people_id, user_id):
-    user = User.query.get(user_id)
-    if user is None:
-        return jsonify({'msg': 'User not found'}), 404
 
-    person = Character.query.get(people_id)
-    if person is None:
-        return jsonify({'msg': 'Character not found'}), 404
+@route('/favorite/people/<int:people_id>/user/<int:user_id>', methods=['POST'])
+def add_favorite_people(people_id, user_id):
+    return favorite_created('character', people_id, user_id, 'Character not found', 'Favorite people added')
 
-    existing_fav = Favorite.query.filter_by(user_id=user_id, character_id=people_id).first()
-    if existing_fav is not None:
-        return jsonify({'msg': 'Favorite already exists'}), 409
 
-    new_fav = Favorite()
-    new_fav.user_id = user_id
-    new_fav.character_id = people_id
+@route('/favorite/planet/<int:planet_id>/user/<int:user_id>', methods=['DELETE'])
+def delete_favorite_planet(planet_id, user_id):
+    return favorite_deleted('planet', planet_id, user_id, 'Favorite planet deleted')
 
-    db.session.add(new_fav)
-    db.session.commit()
 
-    return jsonify({'msg': 'Favorite people added', 'data': new_fav.serialize()}), 201
+@route('/favorite/people/<int:people_id>/user/<int:user_id>', methods=['DELETE'])
+def delete_favorite_people(people_id, user_id):
+    return favorite_deleted('character', people_id, user_id, 'Favorite people deleted')
 
 
-@app.route('/favorite/planet/<int:planet_id>/user/<int:user_id>', methods=['DELETE'])
-def delete_favorite_planet(planet_id, user_id):
-    fav = Favorite.query.filter_by(user_id=user_id, planet_id=planet_id).first()
-    if fav is None:
-        return jsonify({'msg': 'Favorite not found'}), 404
+@route('/users/<int:user_id>/favorites/batch', methods=['POST'])
+def batch_favorites(user_id):
+    body = request.get_json(silent=True)
+    if body is None or not isinstance(body.get('items'), list):
+        return jsonify({'msg': 'debes enviar una lista items en el body'}), 400
+    if len(body['items']) > MAX_BATCH_SIZE:
+        return jsonify({'msg': f'a batch can hold at most {MAX_BATCH_SIZE} items'}), 400
 
-    db.session.delete(fav)
+    results = apply_favorite_batch(user_id, body['items'])
+    if results is None:
+        return jsonify({'msg': 'User not found'}), 404
+    if any(result['status'] in ('added', 'removed') for result in results):
+        rebuild_document(db.session, user_id)
     db.session.commit()
 
-    return jsonify({'msg': 'Favorite planet deleted'}), 200
+    return jsonify({'data': results}), 200
 
 
-@app.route('/favorite/people/<int:people_id>/user/<int:user_id>', methods=['DELETE'])
-def delete_favorite_people(people_id, user_id):
-    fav = Favorite.query.filter_by(user_id=user_id, character_id=people_id).first()
-    if fav is None:
-        return jsonify({'msg': 'Favorite not found'}), 404
+@route('/import/<kind>', methods=['POST'])
+def bulk_import(kind):
+    model = IMPORTABLE_MODELS.get(kind)
+    if model is None:
+        return jsonify({'msg': f'kind must be one of {", ".join(sorted(IMPORTABLE_MODELS))}'}), 404
 
-    db.session.delete(fav)
-    db.session.commit()
+    fmt = request.args.get('format')
+    if fmt is None:
+        fmt = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+    if fmt not in FORMATS:
+        return jsonify({'msg': f'format must be one of {", ".join(FORMATS)}'}), 400
+    batch_size = request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int)
+
+    # the body is read line by line, never loaded whole
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    report = import_rows(model, stream, fmt, max(batch_size, 1))
 
-    return jsonify({'msg': 'Favorite people deleted'}), 200
+    return jsonify(report.serialize()), 200
 
 
 # this only runs if `$ python src/app.py` is executed
 if __name__ == '__main__':
     PORT = int(os.environ.get('PORT', 3000))
-    app.run(host='0.0.0.0', port=PORT, debug=False)
+    create_app().run(host='0.0.0.0', port=PORT, debug=False)
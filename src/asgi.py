@@ -0,0 +1,235 @@
+"""
+Optional ASGI entry point, next to wsgi.py. The favorite routes, the ones that
+make several database round trips, run here on an async engine, with their
+independent lookups issued concurrently. Every other request goes to the
+Flask app on a thread pool, so all routes answer the same way as under
+gunicorn.
+
+    uvicorn asgi:application --app-dir src --workers 2
+
+Needs uvicorn (or any ASGI server), a2wsgi and the async driver of the
+database: asyncpg for PostgreSQL, aiosqlite for SQLite, all in the Pipfile. ASYNC_DATABASE_URL
+overrides the URL derived from DATABASE_URL.
+
+An AsyncSession runs one statement at a time, so lookups that run together
+use a session (and a pooled connection) each.
+"""
+import asyncio
+import os
+from a2wsgi import WSGIMiddleware
+from sqlalchemy import delete, event, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import joinedload
+from werkzeug.exceptions import HTTPException
+from app import create_app
+from database import apply_sqlite_pragmas, async_database_url, async_engine_options, track_pool
+from favorites import FAVORITE_KINDS, favorite_count_update, insert_statement
+from instrumentation import RequestStats, async_request_stats, finish_request_stats, serialization_timer
+from models import notify_tables_changed, User, Favorite, UserFavorites
+from user_favorites import FAVORITES_READ_MODEL, add_to_document, remove_from_document
+
+app = create_app()
+engine = create_async_engine(async_database_url(), **async_engine_options(async_database_url()))
+Session = async_sessionmaker(engine, expire_on_commit=False)
+track_pool(engine.sync_engine, 'async')
+
+if engine.dialect.name == 'sqlite':
+    # the sync engine listener only knows sqlite3 connections
+    @event.listens_for(engine.sync_engine, 'connect')
+    def tune_aiosqlite(dbapi_connection, connection_record):
+        apply_sqlite_pragmas(dbapi_connection)
+
+wsgi_application = WSGIMiddleware(app.wsgi_app, workers=int(os.getenv('ASGI_WSGI_THREADS', 10)))
+url_adapter = app.url_map.bind('localhost')
+
+
+async def _user_exists(user_id):
+    async with Session() as session:
+        return await session.scalar(select(User.id).where(User.id == user_id)) is not None
+
+
+async def _get_item(model, item_id):
+    async with Session() as session:
+        return await session.get(model, item_id)
+
+
+async def _user_favorites(user_id):
+    async with Session() as session:
+        favorites = await session.scalars(select(Favorite).options(
+            joinedload(Favorite.character),
+            joinedload(Favorite.planet),
+            joinedload(Favorite.starship),
+        ).where(Favorite.user_id == user_id).order_by(Favorite.id))
+        return favorites.all()
+
+
+def _notify_in_app_context(tables):
+    with app.app_context():
+        notify_tables_changed(tables)
+
+
+async def _commit(session):
+    """
+    Commits, then runs the listeners of the changed tables
+    (models.on_tables_changed) on a thread: they write with the sync engine.
+    """
+    changed = []
+    session.info['notify_tables_changed'] = changed.append
+    await session.commit()
+    for tables in changed:
+        await asyncio.to_thread(_notify_in_app_context, tables)
+
+
+async def _insert_favorite(user_id, kind, item_id):
+    column_name = FAVORITE_KINDS[kind][1]
+    async with Session() as session:
+        statement = insert_statement(engine.dialect.name, column_name).values(
+            user_id=user_id, **{column_name: item_id}).returning(Favorite.id)
+        favorite_id = await session.scalar(statement)
+        if favorite_id is not None:
+            await session.execute(favorite_count_update(kind, [item_id], 1))
+            if FAVORITES_READ_MODEL:
+                await session.run_sync(add_to_document, user_id, favorite_id)
+            await _commit(session)
+        return favorite_id
+
+
+async def _favorites_document(user_id):
+    async with Session() as session:
+        return await session.scalar(select(UserFavorites.body).where(UserFavorites.user_id == user_id))
+
+
+async def get_user_favorites(user_id):
+    if FAVORITES_READ_MODEL:
+        body = await _favorites_document(user_id)
+        if body is not None:
+            return body, 200
+    # the favorites query doesn't need to wait for the user check
+    exists, favorites = await asyncio.gather(_user_exists(user_id), _user_favorites(user_id))
+    if not exists:
+        return {'msg': 'User not found'}, 404
+    with serialization_timer():
+        return {'data': [fav.serialize() for fav in favorites]}, 200
+
+
+async def favorite_created(kind, item_id, user_id, not_found_msg, created_msg):
+    """
+    Same responses as favorite_created() in app.py. The item of the response
+    is loaded while the insert runs; the user and the item are only looked up
+    again when the insert failed.
+    """
+    model = FAVORITE_KINDS[kind][0]
+    favorite_id, item = await asyncio.gather(
+        _insert_favorite(user_id, kind, item_id), _get_item(model, item_id), return_exceptions=True)
+    if isinstance(item, BaseException):
+        raise item
+    if isinstance(favorite_id, BaseException):
+        if not isinstance(favorite_id, IntegrityError):
+            raise favorite_id
+        # the item may have been deleted after it was loaded
+        user_exists, item = await asyncio.gather(_user_exists(user_id), _get_item(model, item_id))
+        if not user_exists:
+            return {'msg': 'User not found'}, 404
+        if item is None:
+            return {'msg': not_found_msg}, 404
+        # both exist: the insert lost a race with the same favorite
+        return {'msg': 'Favorite already exists'}, 409
+    if favorite_id is None:
+        return {'msg': 'Favorite already exists'}, 409
+    # what Favorite.serialize() returns for the new row
+    return {'msg': created_msg, 'data': {'id': favorite_id, 'type': kind, 'item': item.serialize()}}, 201
+
+
+async def favorite_deleted(kind, item_id, user_id, deleted_msg):
+    column = getattr(Favorite, FAVORITE_KINDS[kind][1])
+    async with Session() as session:
+        result = await session.execute(
+            delete(Favorite).where(Favorite.user_id == user_id, column == item_id),
+            execution_options={'synchronize_session': False})
+        if result.rowcount == 0:
+            return {'msg': 'Favorite not found'}, 404
+        await session.execute(favorite_count_update(kind, [item_id], -1))
+        if FAVORITES_READ_MODEL:
+            await session.run_sync(remove_from_document, user_id, kind, item_id)
+        await _commit(session)
+    return {'msg': deleted_msg}, 200
+
+
+# endpoint of the Flask route -> coroutine serving it
+ASYNC_VIEWS = {
+    'get_user_favorites': get_user_favorites,
+    'add_favorite_planet': lambda planet_id, user_id: favorite_created(
+        'planet', planet_id, user_id, 'Planet not found', 'Favorite planet added'),
+    'add_favorite_people': lambda people_id, user_id: favorite_created(
+        'character', people_id, user_id, 'Character not found', 'Favorite people added'),
+    'delete_favorite_planet': lambda planet_id, user_id: favorite_deleted(
+        'planet', planet_id, user_id, 'Favorite planet deleted'),
+    'delete_favorite_people': lambda people_id, user_id: favorite_deleted(
+        'character', people_id, user_id, 'Favorite people deleted'),
+}
+
+
+def match_async_view(scope):
+    if scope['method'] not in ('GET', 'POST', 'DELETE'):
+        return None, None
+    try:
+        rule, view_args = url_adapter.match(scope['path'], scope['method'], return_rule=True)
+    except HTTPException:
+        return None, None
+    view = ASYNC_VIEWS.get(rule.endpoint)
+    if view is None:
+        return None, None
+    return rule, lambda: view(**view_args)
+
+
+async def serve_async_view(scope, send, rule, view):
+    stats = RequestStats()
+    token = async_request_stats.set(stats)
+    try:
+        # the documents of user_favorites.py are encoded by the app
+        with app.app_context():
+            body, status = await view()
+        if isinstance(body, bytes):
+            # stored already encoded
+            encoded = body
+        else:
+            with serialization_timer():
+                encoded = app.json.dumpb(body) + b'\n'
+    finally:
+        async_request_stats.reset(token)
+    path = scope['path'] + ('?' + scope['query_string'].decode('latin-1') if scope['query_string'] else '')
+    headers = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(encoded)).encode()),
+        (b'server-timing', finish_request_stats(stats, scope['method'], rule.rule, path, status).encode()),
+    ]
+    # what flask-cors adds with its default settings
+    origin = next((value for name, value in scope['headers'] if name == b'origin'), None)
+    if origin is not None:
+        headers += [(b'access-control-allow-origin', origin), (b'vary', b'Origin')]
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': encoded})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] == 'http':
+        rule, view = match_async_view(scope)
+        if view is not None:
+            await serve_async_view(scope, send, rule, view)
+            return
+    await wsgi_application(scope, receive, send)
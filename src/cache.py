@@ -0,0 +1,260 @@
+"""
+Cache of encoded JSON responses for the read-mostly endpoints.
+
+Every key embeds a per-table version number. Committing a write to a table
+bumps its version (see on_tables_changed in models.py), so entries built
+from the old data are never read again. The version counters are shared by
+every process: the memory backend reads them from the database (see
+versions.py), so a write handled by another gunicorn worker or a CLI command
+is seen within VERSION_POLL_SECONDS; the Redis backend keeps them in Redis.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, make_response, request
+from models import on_tables_changed, last_modified_header, tables_last_modified
+from replicas import REPLICA_LAG_SECONDS, built_on_replica
+from versions import table_versions
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """
+    Bounded LRU with a TTL, local to the process. The versions are the ones
+    of the database, shared by every process.
+    """
+    name = 'memory'
+
+    def __init__(self, maxsize=1024, ttl=300, versions=table_versions):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.evictions = 0
+        self.versions = versions
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def version(self, table):
+        return self.versions.version(table)
+
+    def bumped_at(self, table):
+        return self.versions.changed_at(table)
+
+    def bump(self, tables):
+        # the versions were bumped in the database (record_table_changes)
+        with self._lock:
+            # entries of the old versions can't be hit anymore, free them now
+            tables = set(tables)
+            for key in [key for key in self._entries if not tables.isdisjoint(_key_tables(key))]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'evictions': self.evictions, 'size': len(self._entries),
+                'maxsize': self.maxsize, 'ttl': self.ttl,
+                **{f'versions_{name}': value for name, value in self.versions.stats().items()}}
+
+
+def _key_tables(key):
+    # keys look like "planets:3:favorites:12:/planets?fields=..."
+    return key.split(':/', 1)[0].split(':')[::2]
+
+
+class RedisBackend:
+    """
+    Shared backend speaking the Redis protocol. Errors are logged and treated
+    as misses so an unavailable Redis slows the API down instead of failing it.
+    """
+    name = 'redis'
+
+    def __init__(self, url, ttl=300, prefix='swapi:', client=None):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise RuntimeError('CACHE_URL points to Redis but the redis package is not installed')
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.errors = 0
+
+    def _failed(self, action):
+        self.errors += 1
+        logger.warning('cache %s failed', action, exc_info=True)
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except Exception:
+            self._failed('get')
+            return None
+
+    def set(self, key, value):
+        try:
+            self.client.set(self.prefix + key, value, ex=int(self.ttl))
+        except Exception:
+            self._failed('set')
+
+    def version(self, table):
+        try:
+            return int(self.client.get(f'{self.prefix}version:{table}') or 0)
+        except Exception:
+            self._failed('version')
+            return None
+
+    def bumped_at(self, table):
+        try:
+            return float(self.client.get(f'{self.prefix}bumped:{table}') or 0)
+        except Exception:
+            self._failed('bumped_at')
+            # assume a recent write, the caller then skips caching
+            return time.time()
+
+    def bump(self, tables):
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for table in tables:
+                pipeline.incr(f'{self.prefix}version:{table}')
+                pipeline.set(f'{self.prefix}bumped:{table}', time.time())
+            pipeline.execute()
+        except Exception:
+            self._failed('bump')
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+    def stats(self):
+        return {'errors': self.errors, 'ttl': self.ttl}
+
+
+def create_backend(url, maxsize, ttl):
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisBackend(url, ttl=ttl)
+    return MemoryBackend(maxsize=maxsize, ttl=ttl)
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, tables, path):
+        """
+        Key of `path` at the current version of `tables`, the tables the
+        response reads (a name or a tuple of names).
+        """
+        parts = []
+        for table in (tables,) if isinstance(tables, str) else tables:
+            version = self.backend.version(table)
+            if version is None:
+                return None
+            parts.append(f'{table}:{version}:')
+        return ''.join(parts) + path
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return unpack_entry(value)
+
+    def set(self, key, body, etag, headers):
+        self.backend.set(key, pack_entry(body, etag, headers))
+
+    def invalidate_tables(self, tables):
+        self.backend.bump(tables)
+
+    def written_within(self, tables, seconds):
+        tables = (tables,) if isinstance(tables, str) else tables
+        return any(time.time() - self.backend.bumped_at(table) < seconds for table in tables)
+
+    def stats(self):
+        return {'backend': self.backend.name, 'hits': self.hits, 'misses': self.misses,
+                **self.backend.stats()}
+
+
+def pack_entry(body, etag, headers):
+    meta = json.dumps({'etag': etag, 'headers': headers}).encode()
+    return meta + b'\n' + body
+
+
+def unpack_entry(value):
+    meta, body = value.split(b'\n', 1)
+    meta = json.loads(meta)
+    return body, meta['etag'], [tuple(header) for header in meta['headers']]
+
+
+response_cache = ResponseCache(create_backend(
+    os.getenv('CACHE_URL', 'memory://'),
+    maxsize=int(os.getenv('CACHE_MAX_ENTRIES', 1024)),
+    ttl=float(os.getenv('CACHE_TTL', 300)),
+))
+on_tables_changed(response_cache.invalidate_tables)
+
+# headers of the built response that are replayed on a cache hit
+REPLAYED_HEADERS = ('Link', 'Last-Modified')
+
+
+def cached_response(tables, build):
+    """
+    Serves the response of `build` for the current URL from the cache, with a
+    strong ETag and the Last-Modified date of `tables`, so clients that
+    already have it get a 304. Only complete 200 responses are cached.
+    """
+    # the version is read before building, so a write committed meanwhile
+    # leaves the new entry under an outdated key
+    key = response_cache.key(tables, request.full_path)
+    entry = response_cache.get(key) if key is not None else None
+    if entry is None:
+        response = make_response(build())
+        if key is None or response.status_code != 200 or response.is_streamed:
+            return response
+        if built_on_replica() and response_cache.written_within(tables, REPLICA_LAG_SECONDS):
+            # the replica may not have the write that bumped the version yet
+            return response
+        cacheable = True
+        if response.last_modified is None:
+            last_modified = tables_last_modified((tables,) if isinstance(tables, str) else tables)
+            response.last_modified = last_modified_header(last_modified)
+            # changed less than a second ago: cached now, the entry would never get a date
+            cacheable = last_modified is None or response.last_modified is not None
+        body = response.get_data()
+        headers = [(name, response.headers[name]) for name in REPLAYED_HEADERS if name in response.headers]
+        entry = (body, hashlib.sha1(body).hexdigest(), headers)
+        if cacheable:
+            response_cache.set(key, *entry)
+
+    body, etag, headers = entry
+    response = current_app.response_class(body, mimetype='application/json', headers=headers)
+    response.set_etag(etag)
+    return response.make_conditional(request)
@@ -0,0 +1,412 @@
+"""
+Change feed of the characters, planets, starships and favorites, for clients
+that follow changes instead of polling the lists. GET /changes returns what
+changed after a cursor (type, id and op of each row) and the client fetches
+the rows again with GET /people?ids=... (a missing id was deleted).
+
+    since      cursor of the last response, the current end of the log when absent
+    type       character, planet, starship and/or favorite, comma separated
+    user_id    only the favorites of that user
+    limit      changes per response (50, up to 1000)
+    wait       seconds to wait for a change when there is none yet (long poll)
+    stream=sse (or Accept: text/event-stream) Server-Sent Events, resumed
+               from Last-Event-ID
+
+Every insert, update and delete is recorded in the changes table by database
+triggers, created with the tables (see the DDL events below) and by the
+change log migration, so bulk statements, imports, the admin and every
+process are covered. Updates of favorites_count alone are not recorded.
+
+Positions in the log are (txid, id). On PostgreSQL ids are handed out before
+the commit, so a later id can become visible first: txid is the writing
+transaction, and only the rows below the first transaction still running are
+read, in (txid, id) order, so a reader never moves past a row it can't see
+yet. A long running write transaction holds the feed back until it ends. On
+SQLite writes are serial, txid is 0 and the id alone gives the order.
+
+The log is kept bounded by maintain_change_log(): changes of a row are
+compacted to its latest one, and changes older than CHANGES_RETENTION_SECONDS
+or past the newest CHANGES_MAX_ROWS are dropped. The newest dropped change
+stays behind as a 'horizon' row, a cursor before it gets 410 Gone and the
+client reloads the lists.
+
+A waiting request holds its worker thread (but no database connection):
+many followers need threaded workers (gunicorn --threads) or asgi.py.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from flask import Response, current_app, request, stream_with_context, url_for
+from sqlalchemy import DDL, delete, event, func, insert, select, true, tuple_, update
+from sqlalchemy.orm import aliased
+from favorites import KIND_ALIASES
+from instrumentation import record_rows, wait_timer
+from models import db, on_tables_changed, Change, Character, Planet, Starship, Favorite
+from pagination import decode_cursor, encode_cursor, parse_limit
+from utils import APIException
+
+logger = logging.getLogger(__name__)
+
+CHANGES_RETENTION_SECONDS = float(os.getenv('CHANGES_RETENTION_SECONDS', 7 * 24 * 3600))
+CHANGES_MAX_ROWS = int(os.getenv('CHANGES_MAX_ROWS', 1000000))
+# how often each process compacts and trims the log
+CHANGES_MAINTENANCE_SECONDS = float(os.getenv('CHANGES_MAINTENANCE_SECONDS', 300))
+# waiting requests are woken by the commits of their process, and look at the
+# log this often for the commits of other processes
+CHANGES_POLL_SECONDS = float(os.getenv('CHANGES_POLL_SECONDS', 1))
+CHANGES_MAX_WAIT = 30
+# an event stream ends after this long, the client reconnects with Last-Event-ID
+CHANGES_STREAM_SECONDS = float(os.getenv('CHANGES_STREAM_SECONDS', 300))
+HEARTBEAT_SECONDS = 15
+
+# table -> type in the feed
+TRACKED = {
+    Character.__tablename__: 'character',
+    Planet.__tablename__: 'planet',
+    Starship.__tablename__: 'starship',
+    Favorite.__tablename__: 'favorite',
+}
+TRACKED_TABLES = {kind: table for table, kind in TRACKED.items()}
+HORIZON = 'horizon'
+START = (0, 0)
+
+
+def recorded_columns(table):
+    # the counters change with every favorite, which has changes of its own
+    return [column.name for column in table.columns if column.name != 'favorites_count']
+
+
+def sqlite_ddl(table):
+    statements = []
+    for op, timing, row in (('insert', 'INSERT', 'new'),
+                            ('update', f"UPDATE OF {', '.join(recorded_columns(table))}", 'new'),
+                            ('delete', 'DELETE', 'old')):
+        user_id = f'{row}.user_id' if 'user_id' in table.columns else 'NULL'
+        statements.append(
+            f"CREATE TRIGGER {table.name}_changes_{op} AFTER {timing} ON {table.name} BEGIN "
+            f"INSERT INTO changes (table_name, row_id, op, user_id, changed_at) "
+            f"VALUES ('{table.name}', {row}.id, '{op}', {user_id}, CURRENT_TIMESTAMP); END")
+    return statements
+
+
+POSTGRESQL_FUNCTION = """
+CREATE OR REPLACE FUNCTION record_change() RETURNS trigger AS $$
+DECLARE
+    changed jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        changed := to_jsonb(OLD);
+    ELSE
+        changed := to_jsonb(NEW);
+    END IF;
+    INSERT INTO changes (table_name, row_id, op, user_id, changed_at, txid)
+    VALUES (TG_TABLE_NAME, (changed->>'id')::integer, lower(TG_OP), (changed->>'user_id')::integer,
+            now() AT TIME ZONE 'utc', txid_current());
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def postgresql_ddl(table):
+    return [
+        POSTGRESQL_FUNCTION,
+        f"CREATE TRIGGER {table.name}_changes AFTER INSERT OR DELETE OR UPDATE OF "
+        f"{', '.join(recorded_columns(table))} ON {table.name} FOR EACH ROW EXECUTE PROCEDURE record_change()",
+    ]
+
+
+for _table_name in TRACKED:
+    _table = db.metadata.tables[_table_name]
+    for _statement in postgresql_ddl(_table):
+        event.listen(_table, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+    for _statement in sqlite_ddl(_table):
+        event.listen(_table, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _position():
+    return tuple_(Change.txid, Change.id)
+
+
+def _settled(connection, change=Change):
+    """
+    The rows no running transaction can come before: all of them but on
+    PostgreSQL.
+    """
+    if connection.dialect.name == 'postgresql':
+        return change.txid < func.txid_snapshot_xmin(func.txid_current_snapshot())
+    return true()
+
+
+def log_end(connection):
+    """
+    Position of the last change readers can see, START for an empty log.
+    Every change before it is visible.
+    """
+    row = connection.execute(select(Change.txid, Change.id).where(_settled(connection)).order_by(
+        Change.txid.desc(), Change.id.desc()).limit(1)).first()
+    return tuple(row) if row is not None else START
+
+
+def log_horizon(connection):
+    """
+    Position of the horizon row, the newest change dropped by retention, or
+    None when nothing was dropped.
+    """
+    row = connection.execute(select(Change.txid, Change.id, Change.op).order_by(
+        Change.txid, Change.id).limit(1)).first()
+    return (row.txid, row.id) if row is not None and row.op == HORIZON else None
+
+
+def read_changes(connection, after, limit, tables=None, user_id=None):
+    """
+    Returns (rows, position): up to `limit` changes after the position
+    `after`, and the position to read from next time.
+    """
+    end = log_end(connection)
+    statement = select(Change.txid, Change.id, Change.table_name, Change.row_id, Change.op,
+                       Change.user_id, Change.changed_at).where(
+        _position() > tuple_(*after), _position() <= tuple_(*end), Change.op != HORIZON)
+    if tables:
+        statement = statement.where(Change.table_name.in_(tables))
+    if user_id is not None:
+        statement = statement.where(Change.user_id == user_id)
+    rows = connection.execute(statement.order_by(Change.txid, Change.id).limit(limit + 1)).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, (rows[-1].txid, rows[-1].id)
+    # nothing else up to the end matches
+    return rows, max(end, after)
+
+
+def serialize_change(row):
+    change = {'type': TRACKED[row.table_name], 'id': row.row_id, 'op': row.op,
+              'changed_at': row.changed_at.isoformat() + 'Z'}
+    if row.user_id is not None:
+        change['user_id'] = row.user_id
+    return change
+
+
+def compact_changes(connection, after=START):
+    """
+    Deletes the changes followed by a later change of the same row, looking
+    at the later changes past `after` only. Returns (deleted, position up to
+    which the log is compacted).
+    """
+    end = log_end(connection)
+    later = aliased(Change)
+    same_row = (later.table_name == Change.table_name) & (later.row_id == Change.row_id)
+    superseded = select(Change.id).join(later, same_row & (tuple_(later.txid, later.id) > _position())).where(
+        tuple_(later.txid, later.id) > tuple_(*after), tuple_(later.txid, later.id) <= tuple_(*end),
+        Change.op != HORIZON)
+    deleted = connection.execute(delete(Change).where(Change.id.in_(superseded))).rowcount
+    return deleted, end
+
+
+def expire_changes(connection, now=None):
+    """
+    Deletes the changes older than CHANGES_RETENTION_SECONDS or past the
+    newest CHANGES_MAX_ROWS, and turns the newest of them into the horizon.
+    Returns the number of changes deleted.
+    """
+    cutoff = (now or _utcnow()) - timedelta(seconds=CHANGES_RETENTION_SECONDS)
+    newest = connection.execute(select(func.max(Change.id))).scalar() or 0
+    candidates = []
+    for condition in (Change.changed_at < cutoff, Change.id <= newest - CHANGES_MAX_ROWS):
+        row = connection.execute(select(Change.txid, Change.id).where(condition, _settled(connection)).order_by(
+            Change.txid.desc(), Change.id.desc()).limit(1)).first()
+        if row is not None:
+            candidates.append(tuple(row))
+    if not candidates:
+        return 0
+    horizon = max(candidates)
+    deleted = connection.execute(delete(Change).where(_position() < tuple_(*horizon))).rowcount
+    connection.execute(update(Change).where(Change.id == horizon[1]).values(op=HORIZON))
+    return deleted
+
+
+def reset_change_log(connection):
+    """
+    Empties the log after the tables were replaced: every cursor is before
+    the new horizon, the clients reload the lists.
+    """
+    connection.execute(delete(Change))
+    values = {'table_name': '', 'row_id': 0, 'op': HORIZON, 'changed_at': _utcnow()}
+    if connection.dialect.name == 'postgresql':
+        values['txid'] = func.txid_current()
+    connection.execute(insert(Change).values(**values))
+
+
+class ChangeLogMaintenance:
+    """
+    Compaction and retention, at most once per CHANGES_MAINTENANCE_SECONDS
+    per process, on a thread of its own after a commit to a tracked table.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.compacted = START
+        self.last_run = time.monotonic()
+        self.runs = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def due(self):
+        return time.monotonic() - self.last_run >= self.interval
+
+    def run(self, engine):
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self.last_run = time.monotonic()
+            with engine.begin() as connection:
+                compacted, self.compacted = compact_changes(connection, self.compacted)
+                expired = expire_changes(connection)
+            self.runs += 1
+            self.deleted += compacted + expired
+        except Exception:
+            logger.warning('could not maintain the change log', exc_info=True)
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'runs': self.runs, 'deleted': self.deleted}
+
+
+maintenance = ChangeLogMaintenance(CHANGES_MAINTENANCE_SECONDS)
+_changed = threading.Condition()
+
+
+@on_tables_changed
+def follow_tracked_tables(tables):
+    if not set(tables) & TRACKED.keys():
+        return
+    with _changed:
+        _changed.notify_all()
+    if maintenance.due():
+        maintenance.last_run = time.monotonic()
+        threading.Thread(target=maintenance.run, args=(db.engine,), daemon=True).start()
+
+
+def _wait_for_changes(timeout):
+    with wait_timer(), _changed:
+        _changed.wait(timeout)
+
+
+def _parse_feed_args():
+    tables = None
+    if request.args.get('type'):
+        kinds = [KIND_ALIASES.get(kind, kind) for kind in request.args['type'].split(',')]
+        if any(kind not in TRACKED_TABLES for kind in kinds):
+            raise APIException(f'type must be a comma separated list of {", ".join(TRACKED_TABLES)}',
+                               status_code=400)
+        tables = sorted({TRACKED_TABLES[kind] for kind in kinds})
+    user_id = request.args.get('user_id')
+    if user_id is not None:
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            raise APIException('user_id must be an integer', status_code=400)
+    wait = request.args.get('wait', 0, type=float)
+    if wait is None or wait < 0:
+        raise APIException('wait must be a number of seconds', status_code=400)
+    return tables, user_id, min(wait, CHANGES_MAX_WAIT)
+
+
+def _start_position(since):
+    """
+    Position of the `since` cursor, the end of the log without one; 410 when
+    the changes after it were dropped.
+    """
+    connection = db.session.connection()
+    if since is None:
+        return log_end(connection)
+    position = decode_cursor(since)
+    valid = isinstance(position, list) and len(position) == 2
+    if not valid or not all(isinstance(value, int) for value in position):
+        raise APIException('Invalid cursor', status_code=400)
+    horizon = log_horizon(connection)
+    if horizon is not None and tuple(position) < horizon:
+        raise APIException('since is older than the change log, reload the lists', status_code=410)
+    return tuple(position)
+
+
+def _read(position, limit, tables, user_id):
+    try:
+        rows, position = read_changes(db.session.connection(), position, limit, tables, user_id)
+    finally:
+        # no connection held while waiting
+        db.session.close()
+    record_rows(len(rows))
+    return rows, position
+
+
+def wants_event_stream():
+    stream = request.args.get('stream')
+    if stream is not None and stream != 'sse':
+        raise APIException('stream must be sse', status_code=400)
+    return stream == 'sse' or request.accept_mimetypes.best == 'text/event-stream'
+
+
+def feed_response():
+    tables, user_id, wait = _parse_feed_args()
+    limit = parse_limit()
+    if wants_event_stream():
+        return event_stream_response(request.args.get('since') or request.headers.get('Last-Event-ID'),
+                                     limit, tables, user_id)
+
+    position = _start_position(request.args.get('since'))
+    deadline = time.monotonic() + wait
+    while True:
+        rows, position = _read(position, limit, tables, user_id)
+        remaining = deadline - time.monotonic()
+        if rows or remaining <= 0:
+            break
+        _wait_for_changes(min(remaining, CHANGES_POLL_SECONDS))
+
+    cursor = encode_cursor(list(position))
+    args = request.args.to_dict()
+    args['since'] = cursor
+    body = {'data': [serialize_change(row) for row in rows], 'cursor': cursor,
+            'next': url_for(request.endpoint, **args)}
+    return current_app.json.response(body), 200, {'Link': f'<{body["next"]}>; rel="next"',
+                                                  'Cache-Control': 'no-store'}
+
+
+def event_stream_response(since, limit, tables, user_id):
+    """
+    One `change` event per change, its id the cursor right after it, until
+    CHANGES_STREAM_SECONDS are over.
+    """
+    position = _start_position(since)
+    dumps = current_app.json.dumps
+
+    def generate():
+        nonlocal position
+        deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+        # tells the client to reconnect after a second, not the default three
+        yield 'retry: 1000\n\n'
+        last_sent = time.monotonic()
+        while time.monotonic() < deadline:
+            rows, next_position = _read(position, limit, tables, user_id)
+            for row in rows:
+                yield (f'id: {encode_cursor([row.txid, row.id])}\nevent: change\n'
+                       f'data: {dumps(serialize_change(row))}\n\n')
+            if rows:
+                last_sent = time.monotonic()
+            elif time.monotonic() - last_sent >= HEARTBEAT_SECONDS:
+                # ids of the changes the filters skipped, so a reconnect starts past them
+                yield f'id: {encode_cursor(list(next_position))}\n\n'
+                last_sent = time.monotonic()
+            position = next_position
+            if len(rows) < limit:
+                _wait_for_changes(min(CHANGES_POLL_SECONDS, max(deadline - time.monotonic(), 0)))
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,126 @@
+import os
+import sqlite3
+import time
+from contextlib import closing
+import click
+from sqlalchemy.engine import make_url
+from ingest import IMPORTABLE_MODELS, FORMATS, DEFAULT_BATCH_SIZE, import_rows
+from replicas import replica_urls
+from favorites import backfill_favorite_counts
+from search import rebuild_search_index
+from changes import compact_changes, expire_changes
+from user_favorites import check_documents, rebuild_all_documents
+from snapshot import DEFAULT_CHUNK_SIZE, SnapshotError, export_snapshot, restore_snapshot
+from models import db
+
+"""
+In this file, you can add as many commands as you want using the @app.cli.command decorator
+Flask commands are useful to run cronjobs or tasks outside of the API but still in integration
+with your database, for example: bulk loading the catalog
+"""
+
+
+def setup_commands(app):
+
+    @app.cli.command('import-data')
+    @click.argument('kind', type=click.Choice(sorted(IMPORTABLE_MODELS)))
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+                  help='Defaults to the file extension (.csv or .ndjson/.jsonl).')
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+    def import_data(kind, path, fmt, batch_size):
+        """Bulk load characters, planets or starships from an NDJSON or CSV file."""
+        if fmt is None:
+            fmt = 'csv' if os.path.splitext(path)[1].lower() == '.csv' else 'ndjson'
+        with open(path, newline='', encoding='utf-8') as stream:
+            report = import_rows(IMPORTABLE_MODELS[kind], stream, fmt, batch_size).serialize()
+        click.echo(f"{report['inserted']} rows inserted, {report['failed']} failed "
+                   f"in {report['elapsed_seconds']}s ({report['rows_per_second']} rows/s)")
+        for error in report['errors']:
+            click.echo(f"line {error['line']}: {error['error']}", err=True)
+
+    @app.cli.command('sync-sqlite-replicas')
+    def sync_sqlite_replicas():
+        """Copy the SQLite database over the SQLite files of DATABASE_REPLICA_URLS, to try the replicas locally."""
+        primary = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if primary.get_backend_name() != 'sqlite':
+            raise click.ClickException('the primary database is not SQLite')
+        with closing(sqlite3.connect(primary.database)) as source:
+            for url in replica_urls():
+                replica = make_url(url)
+                if replica.get_backend_name() != 'sqlite':
+                    click.echo(f'skipping {replica!r}, not SQLite', err=True)
+                    continue
+                with closing(sqlite3.connect(replica.database)) as target:
+                    source.backup(target)
+                click.echo(f'copied {primary.database} to {replica.database}')
+
+    @app.cli.command('backfill-favorite-counts')
+    def backfill_favorite_counts_command():
+        """Recompute the favorites_count of every character, planet and starship."""
+        corrected = backfill_favorite_counts()
+        db.session.commit()
+        for kind, count in corrected.items():
+            click.echo(f'{kind}: {count} counters corrected')
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Rebuild the SQLite full-text index of characters, planets and starships."""
+        if not rebuild_search_index():
+            click.echo('nothing to rebuild: the search index is a generated column on this database')
+            return
+        db.session.commit()
+        click.echo('search index rebuilt')
+
+    @app.cli.command('prune-changes')
+    def prune_changes_command():
+        """Compact the change log and drop the changes past its retention."""
+        with db.engine.begin() as connection:
+            compacted, _ = compact_changes(connection)
+            expired = expire_changes(connection)
+        click.echo(f'{compacted} superseded changes and {expired} expired changes deleted')
+
+    @app.cli.command('rebuild-favorite-documents')
+    def rebuild_favorite_documents_command():
+        """Build the favorites document of every user from the favorites table."""
+        done = 0
+        for done in rebuild_all_documents(db.session):
+            db.session.commit()
+        click.echo(f'{done} favorites documents built')
+
+    @app.cli.command('check-favorite-documents')
+    def check_favorite_documents_command():
+        """Compare the favorites documents with the favorites table."""
+        stale, missing = check_documents(db.session)
+        click.echo(f'{len(stale)} stale documents, {missing} users without a document')
+        if stale:
+            raise click.ClickException(f"stale documents of the users {', '.join(map(str, stale[:20]))}"
+                                       f"{'...' if len(stale) > 20 else ''}, run rebuild-favorite-documents")
+
+    @app.cli.command('export-snapshot')
+    @click.argument('path', type=click.Path(dir_okay=False, writable=True))
+    @click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True)
+    def export_snapshot_command(path, chunk_size):
+        """Write every table to a compact columnar snapshot file."""
+        started = time.perf_counter()
+        with open(path, 'wb') as stream:
+            counts = export_snapshot(stream, chunk_size)
+        click.echo(f'{sum(counts.values())} rows written to {path} ({os.path.getsize(path)} bytes) '
+                   f'in {time.perf_counter() - started:.2f}s')
+        for table, count in counts.items():
+            click.echo(f'{table}: {count}')
+
+    @app.cli.command('restore-snapshot')
+    @click.argument('path', type=click.Path(exists=True, dir_okay=False))
+    @click.confirmation_option(prompt='This replaces every row of the database. Continue?')
+    def restore_snapshot_command(path):
+        """Replace the content of the database with a snapshot written by export-snapshot."""
+        started = time.perf_counter()
+        try:
+            with open(path, 'rb') as stream:
+                counts = restore_snapshot(stream)
+        except SnapshotError as error:
+            raise click.ClickException(str(error))
+        click.echo(f'{sum(counts.values())} rows restored in {time.perf_counter() - started:.2f}s')
+        for table, count in counts.items():
+            click.echo(f'{table}: {count}')
@@ -0,0 +1,235 @@
+"""
+Compression of the JSON responses, negotiated with Accept-Encoding: gzip,
+plus br and zstd when the brotli and zstandard packages are installed.
+
+    COMPRESSION_ENCODINGS       preferred first (zstd,br,gzip)
+    COMPRESSION_MIN_SIZE        smaller bodies are sent as they are (1024 bytes)
+    COMPRESSION_GZIP_LEVEL      6
+    COMPRESSION_BROTLI_QUALITY  4
+    COMPRESSION_ZSTD_LEVEL      3
+    COMPRESSION_CACHE_BYTES     compressed bodies kept by ETag (64 MB)
+
+Streamed responses are compressed as they go, flushed every
+COMPRESSION_STREAM_FLUSH_BYTES of input. Responses with a strong ETag (the
+cached ones) get their own ETag per encoding, and their compressed bodies are
+kept so a cache hit isn't compressed again.
+"""
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson')
+MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+STREAM_FLUSH_BYTES = int(os.getenv('COMPRESSION_STREAM_FLUSH_BYTES', 16384))
+
+
+class Gzip:
+    name = 'gzip'
+
+    def __init__(self, level):
+        self.level = level
+
+    def compressor(self):
+        # wbits 31: deflate with a gzip header and trailer
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        compressor = self.compressor()
+        return compressor.compress(data) + compressor.flush()
+
+    def write(self, compressor, data):
+        return compressor.compress(data)
+
+    def flush(self, compressor):
+        return compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, compressor):
+        return compressor.flush()
+
+
+class Brotli:
+    name = 'br'
+
+    def __init__(self, quality):
+        self.quality = quality
+
+    def compressor(self):
+        return brotli.Compressor(quality=self.quality)
+
+    def compress(self, data):
+        return brotli.compress(data, quality=self.quality)
+
+    def write(self, compressor, data):
+        return compressor.process(data)
+
+    def flush(self, compressor):
+        return compressor.flush()
+
+    def finish(self, compressor):
+        return compressor.finish()
+
+
+class Zstd:
+    name = 'zstd'
+
+    def __init__(self, level):
+        self.context = zstandard.ZstdCompressor(level=level)
+
+    def compressor(self):
+        return self.context.compressobj()
+
+    def compress(self, data):
+        return self.context.compress(data)
+
+    def write(self, compressor, data):
+        return compressor.compress(data)
+
+    def flush(self, compressor):
+        return compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self, compressor):
+        return compressor.flush()
+
+
+def available_encoders():
+    encoders = {'gzip': Gzip(int(os.getenv('COMPRESSION_GZIP_LEVEL', 6)))}
+    if brotli is not None:
+        encoders['br'] = Brotli(int(os.getenv('COMPRESSION_BROTLI_QUALITY', 4)))
+    if zstandard is not None:
+        encoders['zstd'] = Zstd(int(os.getenv('COMPRESSION_ZSTD_LEVEL', 3)))
+    preferred = os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',')
+    return [encoders[name.strip()] for name in preferred if name.strip() in encoders]
+
+
+class CompressedBodies:
+    """
+    LRU of compressed bodies by (ETag, encoding), bounded in bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return body
+
+    def set(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                self.size -= len(self._entries.popitem(last=False)[1])
+
+
+class Compression:
+    def __init__(self, encoders, min_size=MIN_SIZE, cache_bytes=64 * 1024 * 1024):
+        self.encoders = {encoder.name: encoder for encoder in encoders}
+        self.offers = [encoder.name for encoder in encoders] + ['identity']
+        self.min_size = min_size
+        self.bodies = CompressedBodies(cache_bytes)
+        self.compressed = 0
+        self.streamed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def negotiate(self):
+        if not request.accept_encodings:
+            return None
+        return self.encoders.get(request.accept_encodings.best_match(self.offers))
+
+    def applies(self, response):
+        if request.method == 'HEAD' or response.status_code != 200 or response.direct_passthrough:
+            return False
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES or 'Content-Encoding' in response.headers:
+            return False
+        return 'no-transform' not in response.headers.get('Cache-Control', '')
+
+    def stream(self, encoder, chunks):
+        compressor = encoder.compressor()
+        pending = 0
+        for chunk in chunks:
+            self.bytes_in += len(chunk)
+            data = encoder.write(compressor, chunk)
+            pending += len(chunk)
+            if pending >= STREAM_FLUSH_BYTES:
+                data += encoder.flush(compressor)
+                pending = 0
+            if data:
+                self.bytes_out += len(data)
+                yield data
+        data = encoder.finish(compressor)
+        self.bytes_out += len(data)
+        yield data
+
+    def compress(self, response):
+        if not self.applies(response):
+            return response
+        # the representation depends on Accept-Encoding even when it isn't compressed
+        response.vary.add('Accept-Encoding')
+        encoder = self.negotiate()
+        if encoder is None:
+            return response
+
+        if response.is_streamed:
+            self.streamed += 1
+            response.response = self.stream(encoder, response.response)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoder.name
+            return response
+
+        etag, weak = response.get_etag()
+        body = response.get_data()
+        if len(body) < self.min_size:
+            return response
+        key = (etag, encoder.name) if etag and not weak else None
+        compressed = self.bodies.get(key) if key else None
+        if compressed is None:
+            compressed = encoder.compress(body)
+            self.compressed += 1
+            if key:
+                self.bodies.set(key, compressed)
+        self.bytes_in += len(body)
+        self.bytes_out += len(compressed)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoder.name
+        if key:
+            # another representation, another strong ETag
+            response.set_etag(f'{etag}-{encoder.name}')
+            response.make_conditional(request)
+        return response
+
+    def stats(self):
+        return {'encodings': len(self.encoders), 'compressed': self.compressed, 'streamed': self.streamed,
+                'cache_hits': self.bodies.hits, 'cache_bytes': self.bodies.size,
+                'bytes_in': self.bytes_in, 'bytes_out': self.bytes_out}
+
+
+def setup_compression(app):
+    compression = Compression(available_encoders(),
+                              cache_bytes=int(os.getenv('COMPRESSION_CACHE_BYTES', 64 * 1024 * 1024)))
+    app.after_request(compression.compress)
+    return compression
@@ -0,0 +1,252 @@
+"""
+Engine configuration from environment variables, SQLite tuning, connection
+pool metrics and the database check behind /readyz
+"""
+import os
+import sqlite3
+import threading
+import time
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+DEFAULT_DATABASE_URL = 'sqlite:////tmp/test.db'
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return default if value in (None, '') else int(value)
+
+
+def _env_bool(name, default):
+    value = os.getenv(name)
+    if value in (None, ''):
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def database_url():
+    db_url = os.getenv('DATABASE_URL')
+    if db_url is None:
+        return DEFAULT_DATABASE_URL
+    return db_url.replace('postgres://', 'postgresql://')
+
+
+# drivers of the ASGI entry point, see asgi.py
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+}
+
+
+def async_database_url():
+    """
+    ASYNC_DATABASE_URL, or the URL of database_url() with the async driver
+    of its database.
+    """
+    db_url = os.getenv('ASYNC_DATABASE_URL')
+    if db_url:
+        return db_url
+    db_url = database_url()
+    scheme, rest = db_url.split('://', 1)
+    return f'{ASYNC_DRIVERS.get(scheme.split("+")[0], scheme)}://{rest}'
+
+
+class PoolStats:
+    """
+    Counters of the connections of one pool. Checkouts and checkins run on
+    every thread using the pool, so every update takes the lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.checked_out = 0
+
+    def count(self, name, delta=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + delta)
+
+    def record_wait(self, seconds):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checked_out': self.checked_out,
+                'invalidations': self.invalidations,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_max': round(self.max_wait_seconds, 6),
+                'wait_seconds_avg': round(self.wait_seconds / self.waits, 6) if self.waits else 0.0,
+            }
+
+
+# pool name -> (engine, PoolStats), see track_pool()
+tracked_pools = {}
+
+
+class TimedQueuePool(QueuePool):
+    """
+    QueuePool that measures how long a checkout waits for a free connection.
+    """
+    # set by track_pool()
+    stats = None
+
+    def recreate(self):
+        # engine.dispose() replaces the pool, the stats carry on
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            if self.stats is not None:
+                self.stats.record_wait(time.perf_counter() - started)
+
+
+def _pool_options():
+    return {
+        'pool_size': _env_int('DB_POOL_SIZE', 5),
+        'max_overflow': _env_int('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': _env_int('DB_POOL_TIMEOUT', 30),
+        # recycle before the server or a proxy drops idle connections
+        'pool_recycle': _env_int('DB_POOL_RECYCLE', 1800),
+    }
+
+
+def engine_options(url):
+    """
+    SQLALCHEMY_ENGINE_OPTIONS for `url`, tuned by the DB_* environment variables:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE (seconds),
+    DB_POOL_PRE_PING and DB_STATEMENT_TIMEOUT_MS.
+    """
+    options = {'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', True)}
+    if url.startswith('sqlite'):
+        # SQLite has no server side connections to manage, the pragmas below do the tuning
+        return options
+
+    options.update(_pool_options(), poolclass=TimedQueuePool)
+    statement_timeout = _env_int('DB_STATEMENT_TIMEOUT_MS', 0)
+    if statement_timeout:
+        if url.startswith('postgresql'):
+            options['connect_args'] = {'options': f'-c statement_timeout={statement_timeout}'}
+        elif url.startswith('mysql'):
+            options['connect_args'] = {'init_command': f'SET SESSION max_execution_time={statement_timeout}'}
+    return options
+
+
+def async_engine_options(url):
+    """
+    Options of create_async_engine() for `url`, from the same DB_* variables
+    as engine_options(). The pool is SQLAlchemy's default async queue pool.
+    """
+    options = {'pool_pre_ping': _env_bool('DB_POOL_PRE_PING', True)}
+    if url.startswith('sqlite'):
+        return options
+
+    options.update(_pool_options())
+    statement_timeout = _env_int('DB_STATEMENT_TIMEOUT_MS', 0)
+    if statement_timeout:
+        if url.startswith('postgresql+asyncpg'):
+            options['connect_args'] = {'server_settings': {'statement_timeout': str(statement_timeout)}}
+        elif url.startswith('mysql'):
+            options['connect_args'] = {'init_command': f'SET SESSION max_execution_time={statement_timeout}'}
+    return options
+
+
+SQLITE_PRAGMAS = (
+    'PRAGMA foreign_keys=ON',
+    # readers don't block the writer and the other way around
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    f'PRAGMA busy_timeout={_env_int("DB_SQLITE_BUSY_TIMEOUT_MS", 5000)}',
+    'PRAGMA cache_size=-20000',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=134217728',
+)
+
+
+def apply_sqlite_pragmas(dbapi_connection):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+@event.listens_for(Engine, 'connect')
+def tune_sqlite(dbapi_connection, connection_record):
+    # foreign keys are also what the favorite inserts rely on to detect unknown users and items
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        apply_sqlite_pragmas(dbapi_connection)
+
+
+def track_pool(engine, name):
+    """
+    Counts the connections of the pool of `engine` (a sync engine) in a
+    PoolStats of its own, reported by pool_status() under `name`. A pool
+    tracked again under the same name (a new app) replaces the previous one.
+    """
+    stats = PoolStats()
+
+    # pool events of an engine follow its pool through dispose()
+    @event.listens_for(engine, 'connect')
+    def count_connect(dbapi_connection, connection_record):
+        stats.count('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def count_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats.count('checkouts')
+        stats.count('checked_out')
+
+    @event.listens_for(engine, 'checkin')
+    def count_checkin(dbapi_connection, connection_record):
+        stats.count('checked_out', -1)
+
+    @event.listens_for(engine, 'invalidate')
+    def count_invalidation(dbapi_connection, connection_record, exception):
+        stats.count('invalidations')
+
+    if isinstance(engine.pool, TimedQueuePool):
+        engine.pool.stats = stats
+    tracked_pools[name] = (engine, stats)
+    return stats
+
+
+def pool_status():
+    """
+    The stats of every tracked pool, by pool name.
+    """
+    status = {}
+    for name, (engine, stats) in sorted(tracked_pools.items()):
+        status[name] = stats.as_dict()
+        pool = engine.pool
+        if isinstance(pool, QueuePool):
+            status[name].update({'size': pool.size(), 'overflow': pool.overflow(), 'idle': pool.checkedin()})
+    return status
+
+
+def check_database(engine):
+    """
+    Runs SELECT 1 on a pooled connection, without going through the ORM
+    session. Returns None when the database answers, the error otherwise.
+    """
+    try:
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SELECT 1')
+    except Exception as error:
+        return error
+    return None
@@ -0,0 +1,293 @@
+"""
+Write path of the favorites: one INSERT ... ON CONFLICT DO NOTHING RETURNING
+per add and one DELETE per removal, relying on the unique indexes of the
+favorites table for duplicate detection.
+
+Every change also updates the favorites_count of the item in the same
+transaction: explicitly on these Core statements, through mapper events for
+the ORM (the admin).
+"""
+from sqlalchemy import delete, event, func, insert, inspect, or_, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
+from models import db, User, Character, Planet, Starship, Favorite
+
+FAVORITE_KINDS = {
+    'character': (Character, 'character_id'),
+    'planet': (Planet, 'planet_id'),
+    'starship': (Starship, 'starship_id'),
+}
+# the routes call characters "people"
+KIND_ALIASES = {'people': 'character'}
+
+UPSERT_DIALECTS = {
+    'postgresql': postgresql.insert,
+    'sqlite': sqlite.insert,
+}
+
+CREATED = 'created'
+EXISTS = 'exists'
+USER_NOT_FOUND = 'user_not_found'
+ITEM_NOT_FOUND = 'item_not_found'
+
+ADD = 'add'
+REMOVE = 'remove'
+MAX_BATCH_SIZE = 500
+
+
+def insert_statement(dialect_name, column_name):
+    dialect_insert = UPSERT_DIALECTS.get(dialect_name)
+    if dialect_insert is None:
+        return insert(Favorite)
+    column = getattr(Favorite, column_name)
+    return dialect_insert(Favorite).on_conflict_do_nothing(
+        index_elements=[Favorite.user_id, column],
+        index_where=column.isnot(None),
+    )
+
+
+def favorite_count_update(kind, item_ids, delta):
+    """
+    Adds `delta` to the favorites_count of `item_ids`. The statement is
+    tracked as a change of the favorites table, the counter isn't part of the
+    default representation of the items.
+    """
+    model = FAVORITE_KINDS[kind][0]
+    return update(model).where(model.id.in_(item_ids)).values(
+        favorites_count=model.favorites_count + delta,
+    ).execution_options(synchronize_session=False, tracked_table='favorites')
+
+
+def _dialect_name():
+    return db.session.get_bind().dialect.name
+
+
+def _failure_reason(user_id, model, item_id):
+    # only reached when the insert failed, so the common path stays one statement
+    if db.session.get(User, user_id) is None:
+        return USER_NOT_FOUND
+    if db.session.get(model, item_id) is None:
+        return ITEM_NOT_FOUND
+    return EXISTS
+
+
+def add_favorite(user_id, kind, item_id):
+    """
+    Inserts the favorite and returns (status, favorite_id). The caller commits.
+    """
+    model, column_name = FAVORITE_KINDS[kind]
+    values = {'user_id': user_id, column_name: item_id}
+    try:
+        statement = insert_statement(_dialect_name(), column_name).values(**values).returning(Favorite.id)
+        favorite_id = db.session.execute(statement).scalar()
+    except IntegrityError:
+        db.session.rollback()
+        return _failure_reason(user_id, model, item_id), None
+    if favorite_id is None:
+        return EXISTS, None
+    db.session.execute(favorite_count_update(kind, [item_id], 1))
+    return CREATED, favorite_id
+
+
+def remove_favorite(user_id, kind, item_id):
+    """
+    Deletes the favorite and returns whether it existed. The caller commits.
+    """
+    column = getattr(Favorite, FAVORITE_KINDS[kind][1])
+    statement = delete(Favorite).where(Favorite.user_id == user_id, column == item_id)
+    result = db.session.execute(statement, execution_options={'synchronize_session': False})
+    if result.rowcount == 0:
+        return False
+    db.session.execute(favorite_count_update(kind, [item_id], -1))
+    return True
+
+
+def get_favorite(favorite_id):
+    return db.session.get(Favorite, favorite_id, options=[
+        joinedload(Favorite.character),
+        joinedload(Favorite.planet),
+        joinedload(Favorite.starship),
+    ])
+
+
+def _parse_operation(entry):
+    if not isinstance(entry, dict):
+        return None, 'each entry must be an object'
+    op, kind, item_id = entry.get('op'), entry.get('type'), entry.get('id')
+    kind = KIND_ALIASES.get(kind, kind)
+    if op not in (ADD, REMOVE):
+        return None, 'op must be add or remove'
+    if kind not in FAVORITE_KINDS:
+        return None, f'type must be one of {", ".join(FAVORITE_KINDS)}'
+    if not isinstance(item_id, int) or isinstance(item_id, bool):
+        return None, 'id must be an integer'
+    return (op, kind, item_id), None
+
+
+def apply_favorite_batch(user_id, entries):
+    """
+    Applies a list of {op, type, id} entries for one user with one IN query
+    per item type, one query for the current favorites and one bulk INSERT and
+    DELETE per type. Entries are applied in order, so a later entry sees the
+    effect of an earlier one. Returns the per-entry results, or None when the
+    user does not exist. The caller commits.
+    """
+    if db.session.get(User, user_id) is None:
+        return None
+
+    operations = [_parse_operation(entry) for entry in entries]
+    requested = {kind: set() for kind in FAVORITE_KINDS}
+    for operation, error in operations:
+        if error is None:
+            requested[operation[1]].add(operation[2])
+
+    existing_items = set()
+    for kind, ids in requested.items():
+        if ids:
+            model = FAVORITE_KINDS[kind][0]
+            found = db.session.execute(select(model.id).where(model.id.in_(ids))).scalars()
+            existing_items.update((kind, item_id) for item_id in found)
+
+    initial = set()
+    conditions = [getattr(Favorite, FAVORITE_KINDS[kind][1]).in_(ids)
+                  for kind, ids in requested.items() if ids]
+    if conditions:
+        rows = db.session.execute(
+            select(Favorite.character_id, Favorite.planet_id, Favorite.starship_id)
+            .where(Favorite.user_id == user_id, or_(*conditions)))
+        for character_id, planet_id, starship_id in rows:
+            for kind, item_id in (('character', character_id), ('planet', planet_id), ('starship', starship_id)):
+                if item_id is not None:
+                    initial.add((kind, item_id))
+
+    # entry indexes per (kind, item id), in order
+    entries_of = {}
+    results = []
+    for entry, (operation, error) in zip(entries, operations):
+        if error is not None:
+            results.append({'entry': entry, 'status': 'invalid', 'error': error})
+            continue
+        op, kind, item_id = operation
+        results.append({'op': op, 'type': kind, 'id': item_id, 'status': 'not_found'})
+        if (kind, item_id) in existing_items:
+            entries_of.setdefault((kind, item_id), []).append(len(results) - 1)
+
+    state = {key for key, indexes in entries_of.items() if _replay(results, indexes, key in initial)}
+    for kind, (model, column_name) in FAVORITE_KINDS.items():
+        column = getattr(Favorite, column_name)
+        added = [{'user_id': user_id, column_name: item_id}
+                 for item_kind, item_id in state - initial if item_kind == kind]
+        if added:
+            inserted = _insert_batch(user_id, kind, added, results, entries_of)
+            if inserted is None:
+                return None
+            _settle(results, entries_of, kind, [values[column_name] for values in added], inserted, present=True)
+            if inserted:
+                db.session.execute(favorite_count_update(kind, inserted, 1))
+        removed = [item_id for item_kind, item_id in initial - state if item_kind == kind]
+        if removed:
+            deleted = db.session.execute(
+                delete(Favorite).where(Favorite.user_id == user_id, column.in_(removed)).returning(column),
+                execution_options={'synchronize_session': False}).scalars().all()
+            _settle(results, entries_of, kind, removed, deleted, present=False)
+            if deleted:
+                db.session.execute(favorite_count_update(kind, deleted, -1))
+    return results
+
+
+def _insert_batch(user_id, kind, added, results, entries_of):
+    """
+    Inserts the favorites of `added` and returns the item ids inserted. The
+    items deleted since they were looked up are dropped from `added` and
+    their entries reported as not_found. None when the user is gone.
+    """
+    model, column_name = FAVORITE_KINDS[kind]
+    column = getattr(Favorite, column_name)
+    while added:
+        try:
+            with db.session.begin_nested():
+                return db.session.execute(insert_statement(_dialect_name(), column_name).values(added)
+                                          .returning(column)).scalars().all()
+        except IntegrityError:
+            # not db.session.get(), the user is in the identity map
+            if db.session.scalar(select(User.id).where(User.id == user_id)) is None:
+                return None
+            ids = [values[column_name] for values in added]
+            existing = set(db.session.execute(select(model.id).where(model.id.in_(ids))).scalars())
+            if len(existing) == len(ids):
+                raise
+            for item_id in set(ids) - existing:
+                for index in entries_of[(kind, item_id)]:
+                    results[index]['status'] = 'not_found'
+            added[:] = [values for values in added if values[column_name] in existing]
+    return []
+
+
+def _replay(results, indexes, present):
+    """
+    Sets the status of the entries of one item given whether the favorite
+    existed before them, and returns whether it exists after them.
+    """
+    for index in indexes:
+        result = results[index]
+        if result['op'] == ADD:
+            result['status'] = 'exists' if present else 'added'
+            present = True
+        else:
+            result['status'] = 'removed' if present else 'not_favorite'
+            present = False
+    return present
+
+
+def _settle(results, entries_of, kind, planned, changed, present):
+    # a concurrent request added (or removed) the favorite after it was read,
+    # the entries of the item are replayed from what the table held instead
+    changed = set(changed)
+    for item_id in planned:
+        if item_id not in changed:
+            _replay(results, entries_of[(kind, item_id)], present)
+
+
+def backfill_favorite_counts():
+    """
+    Recomputes every favorites_count from the favorites table. Returns the
+    number of counters corrected per kind. The caller commits.
+    """
+    corrected = {}
+    for kind, (model, column_name) in FAVORITE_KINDS.items():
+        count = select(func.count(Favorite.id)).where(getattr(Favorite, column_name) == model.id).scalar_subquery()
+        result = db.session.execute(
+            update(model).where(model.favorites_count != count).values(favorites_count=count)
+            .execution_options(synchronize_session=False, tracked_table='favorites'))
+        corrected[kind] = result.rowcount
+    return corrected
+
+
+def _count_orm_change(connection, kind, item_id, delta):
+    if item_id is not None:
+        connection.execute(favorite_count_update(kind, [item_id], delta))
+
+
+@event.listens_for(Favorite, 'after_insert')
+def count_inserted_favorite(mapper, connection, target):
+    for kind, (model, column_name) in FAVORITE_KINDS.items():
+        _count_orm_change(connection, kind, getattr(target, column_name), 1)
+
+
+@event.listens_for(Favorite, 'after_delete')
+def count_deleted_favorite(mapper, connection, target):
+    for kind, (model, column_name) in FAVORITE_KINDS.items():
+        _count_orm_change(connection, kind, getattr(target, column_name), -1)
+
+
+@event.listens_for(Favorite, 'after_update')
+def count_updated_favorite(mapper, connection, target):
+    state = inspect(target)
+    for kind, (model, column_name) in FAVORITE_KINDS.items():
+        history = state.attrs[column_name].history
+        if history.has_changes():
+            for item_id in history.deleted:
+                _count_orm_change(connection, kind, item_id, -1)
+            for item_id in history.added:
+                _count_orm_change(connection, kind, item_id, 1)
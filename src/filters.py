@@ -0,0 +1,85 @@
+"""
+Filters, sorting and sparse fieldsets of the list endpoints, pushed down into
+SQL. Every filter and sort column here is backed by an index (see the
+__table_args__ of the models).
+"""
+from flask import request
+from models import db, User, Character, Planet, Starship
+from utils import APIException
+
+
+def _integer(name, value):
+    try:
+        return int(value)
+    except ValueError:
+        raise APIException(f'{name} must be an integer', status_code=400)
+
+
+def name_prefix(column, value):
+    if db.session.get_bind().dialect.name == 'postgresql':
+        # served by the varchar_pattern_ops index
+        return column.startswith(value, autoescape=True)
+    # a range on the plain btree index; with a binary collation it matches
+    # exactly the values that start with the prefix
+    if not value:
+        return column.isnot(None)
+    return (column >= value) & (column < value[:-1] + chr(ord(value[-1]) + 1))
+
+
+LIST_FILTERS = {
+    Character: {
+        'planet_id': lambda value: Character.planet_id == _integer('planet_id', value),
+        'name': lambda value: name_prefix(Character.name, value),
+        'min_height': lambda value: Character.height >= _integer('min_height', value),
+        'max_height': lambda value: Character.height <= _integer('max_height', value),
+    },
+    Planet: {
+        'name': lambda value: name_prefix(Planet.name, value),
+        'climate': lambda value: Planet.climate == value,
+        'terrain': lambda value: Planet.terrain == value,
+    },
+    Starship: {
+        'name': lambda value: name_prefix(Starship.name, value),
+    },
+}
+
+SORTABLE_COLUMNS = {
+    User: ('id',),
+    Character: ('id', 'name', 'height'),
+    Planet: ('id', 'name'),
+    Starship: ('id', 'name'),
+}
+
+
+def apply_filters(query, model):
+    for name, condition in LIST_FILTERS.get(model, {}).items():
+        value = request.args.get(name)
+        if value is not None:
+            query = query.filter(condition(value))
+    return query
+
+
+def parse_sort(model):
+    """
+    Returns (column, descending) from `sort=name` or `sort=-name`.
+    """
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    name = sort.lstrip('-')
+    if name not in SORTABLE_COLUMNS.get(model, ('id',)):
+        allowed = ', '.join(SORTABLE_COLUMNS.get(model, ('id',)))
+        raise APIException(f'sort must be one of {allowed}', status_code=400)
+    return getattr(model, name), descending
+
+
+def parse_fields(model):
+    fields = request.args.get('fields')
+    if fields is None:
+        return None
+    fields = [field for field in fields.split(',') if field]
+    selectable = model.serialized_columns + getattr(model, 'optional_columns', ())
+    unknown = [field for field in fields if field not in selectable]
+    if unknown or not fields:
+        allowed = ', '.join(selectable)
+        raise APIException(f'fields must be a comma separated list of {allowed}', status_code=400)
+    return fields
@@ -0,0 +1,165 @@
+"""
+Bulk import of characters, planets and starships from NDJSON or CSV streams
+"""
+import csv
+import json
+import time
+from sqlalchemy import Integer, String, insert
+from sqlalchemy.exc import IntegrityError
+from models import db, Character, Planet, Starship
+
+IMPORTABLE_MODELS = {
+    'people': Character,
+    'characters': Character,
+    'planets': Planet,
+    'starships': Starship,
+}
+FORMATS = ('ndjson', 'csv')
+DEFAULT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 1000
+
+
+def read_ndjson(stream):
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield line_number, None, f'invalid JSON: {error}'
+            continue
+        if not isinstance(row, dict):
+            yield line_number, None, 'each line must be a JSON object'
+            continue
+        yield line_number, row, None
+
+
+def read_csv(stream):
+    # line 1 is the header
+    for line_number, row in enumerate(csv.DictReader(stream), start=2):
+        yield line_number, {key: value for key, value in row.items() if value != ''}, None
+
+
+READERS = {'ndjson': read_ndjson, 'csv': read_csv}
+
+
+def _maintained_columns(model):
+    # counters kept up to date by the app, see favorites.py
+    return set(getattr(model, 'optional_columns', ()))
+
+
+def _importable_columns(model):
+    maintained = _maintained_columns(model)
+    return [column for column in model.__table__.columns
+            if not column.primary_key and column.name not in maintained]
+
+
+def validate_row(columns, row, maintained=()):
+    """
+    Checks a row against the column definitions of the model (required
+    columns, String lengths and Integer types) and returns (values, error).
+    The `maintained` columns and the id can't be set.
+    """
+    values = {}
+    given = sorted(set(row) & set(maintained))
+    if given:
+        return None, f'{", ".join(given)} can not be imported, it is maintained by the API'
+    if 'id' in row:
+        # an imported id would collide with the ids of the sequence later on
+        return None, 'id can not be imported, it is assigned by the database'
+    known = {column.name for column in columns}
+    unknown = set(row) - known
+    if unknown:
+        return None, f'unknown columns: {", ".join(sorted(unknown))}'
+    for column in columns:
+        value = row.get(column.name)
+        if value is None:
+            if not column.nullable:
+                return None, f'{column.name} is required'
+            values[column.name] = None
+            continue
+        if isinstance(column.type, Integer):
+            if isinstance(value, bool):
+                return None, f'{column.name} must be an integer'
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                return None, f'{column.name} must be an integer'
+        elif isinstance(column.type, String):
+            value = str(value)
+            if column.type.length is not None and len(value) > column.type.length:
+                return None, f'{column.name} is longer than {column.type.length} characters'
+        values[column.name] = value
+    return values, None
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.failed = 0
+        self.errors = []
+        self.started = time.perf_counter()
+
+    def add_error(self, line_number, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line_number, 'error': message})
+
+    def serialize(self):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'inserted': self.inserted,
+            'failed': self.failed,
+            'errors': self.errors,
+            'elapsed_seconds': round(elapsed, 3),
+            'rows_per_second': round(self.inserted / elapsed, 1) if elapsed > 0 else None,
+        }
+
+
+def _flush_batch(model, batch, report):
+    """
+    Inserts a batch with one executemany. When the batch violates a
+    constraint (duplicate name, unknown planet_id...) it is retried row by
+    row so only the offending rows are reported and the rest still load.
+    """
+    statement = insert(model)
+    try:
+        db.session.execute(statement, [values for _, values in batch])
+        db.session.commit()
+        report.inserted += len(batch)
+        return
+    except IntegrityError:
+        db.session.rollback()
+    for line_number, values in batch:
+        try:
+            db.session.execute(statement, [values])
+            db.session.commit()
+            report.inserted += 1
+        except IntegrityError as error:
+            db.session.rollback()
+            report.add_error(line_number, str(error.orig))
+
+
+def import_rows(model, stream, fmt, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Streams `stream` (a text file object) into the table of `model`, batch by
+    batch, and returns an ImportReport. Invalid rows are reported and skipped.
+    """
+    columns = _importable_columns(model)
+    maintained = _maintained_columns(model)
+    report = ImportReport()
+    batch = []
+    for line_number, row, error in READERS[fmt](stream):
+        if error is None:
+            row, error = validate_row(columns, row, maintained)
+        if error is not None:
+            report.add_error(line_number, error)
+            continue
+        batch.append((line_number, row))
+        if len(batch) >= batch_size:
+            _flush_batch(model, batch, report)
+            batch = []
+    if batch:
+        _flush_batch(model, batch, report)
+    return report
@@ -0,0 +1,237 @@
+"""
+Per-request performance instrumentation: SQL statement count and time,
+serialization time and rows loaded for every request, reported in a
+Server-Timing header, logged for slow requests and aggregated per route for
+the Prometheus style /metrics endpoint.
+
+Metrics live in the process, so under gunicorn every worker reports its own.
+"""
+import fnmatch
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', 500))
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# stats of the requests served by the ASGI handlers, outside of any Flask request context
+async_request_stats = ContextVar('async_request_stats', default=None)
+
+
+class RequestStats:
+    __slots__ = ('started', 'statements', 'db_seconds', 'serialization_seconds', 'rows',
+                 'slowest_seconds', 'slowest_statement', 'wait_seconds')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.rows = 0
+        self.slowest_seconds = 0.0
+        self.slowest_statement = None
+        # time spent waiting for something to happen (long polls), not working
+        self.wait_seconds = 0.0
+
+
+def current_stats():
+    if has_request_context():
+        return g.get('request_stats')
+    return async_request_stats.get()
+
+
+def record_rows(count):
+    stats = current_stats()
+    if stats is not None:
+        stats.rows += count
+
+
+@contextmanager
+def wait_timer():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.wait_seconds += time.perf_counter() - started
+
+
+@contextmanager
+def serialization_timer():
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stats = current_stats()
+        if stats is not None:
+            stats.serialization_seconds += time.perf_counter() - started
+
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.total += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f'{name}_sum{{{labels}}} {self.total}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class RouteMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+        # prefix -> (source, counters, label)
+        self._stats_sources = {}
+
+    def observe(self, method, route, status, stats, total_seconds):
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[(method, route)] = {
+                    'duration': Histogram(), 'db': Histogram(), 'serialization': Histogram(),
+                    'statements': 0, 'rows': 0, 'statuses': {},
+                }
+            metrics['duration'].observe(total_seconds)
+            metrics['db'].observe(stats.db_seconds)
+            metrics['serialization'].observe(stats.serialization_seconds)
+            metrics['statements'] += stats.statements
+            metrics['rows'] += stats.rows
+            metrics['statuses'][status] = metrics['statuses'].get(status, 0) + 1
+
+    def register_stats(self, prefix, source, counters=(), label=None):
+        """
+        Exposes the numeric values of the dict returned by `source()` as gauges,
+        and the ones whose keys match a pattern of `counters` (monotonic
+        totals, fnmatch patterns) as counters named with a _total suffix.
+        With a `label`, `source()` returns a dict of those dicts by the value
+        of the label. The source of a later app replaces the one of its prefix.
+        """
+        self._stats_sources[prefix] = (source, tuple(counters), label)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            routes = sorted(self._routes.items())
+            for name, key, help_text in (
+                    ('http_request_duration_seconds', 'duration', 'Time spent handling the request'),
+                    ('http_request_db_seconds', 'db', 'Time spent in SQL statements per request'),
+                    ('http_request_serialization_seconds', 'serialization', 'Time spent encoding JSON per request')):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+                for (method, route), metrics in routes:
+                    lines += metrics[key].lines(name, f'method="{method}",route="{route}"')
+            for name, key, help_text in (
+                    ('http_request_sql_statements_total', 'statements', 'SQL statements issued'),
+                    ('http_request_rows_loaded_total', 'rows', 'Rows loaded from the database')):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                for (method, route), metrics in routes:
+                    lines.append(f'{name}{{method="{method}",route="{route}"}} {metrics[key]}')
+            lines += ['# HELP http_requests_total Requests handled', '# TYPE http_requests_total counter']
+            for (method, route), metrics in routes:
+                for status, count in sorted(metrics['statuses'].items()):
+                    lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        for prefix, (source, counters, label) in self._stats_sources.items():
+            if label is None:
+                samples = [('', key, value) for key, value in source().items()]
+            else:
+                samples = [(f'{{{label}="{label_value}"}}', key, value)
+                           for label_value, stats in source().items() for key, value in stats.items()]
+            # key -> samples of its metric, under a single TYPE line
+            metrics = {}
+            for labels, key, value in samples:
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metrics.setdefault(key, []).append(f'{labels} {value}')
+            for key, values in metrics.items():
+                name = f'{prefix}_{key}'
+                if any(fnmatch.fnmatchcase(key, pattern) for pattern in counters):
+                    name = name if name.endswith('_total') else f'{name}_total'
+                    lines.append(f'# TYPE {name} counter')
+                else:
+                    lines.append(f'# TYPE {name} gauge')
+                lines += [f'{name}{value}' for value in values]
+        return '\n'.join(lines) + '\n'
+
+
+route_metrics = RouteMetrics()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['statement_started'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_started']
+    stats = current_stats()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_seconds += elapsed
+        if elapsed > stats.slowest_seconds:
+            stats.slowest_seconds = elapsed
+            stats.slowest_statement = statement
+
+
+def finish_request_stats(stats, method, route, path, status):
+    """
+    Records a finished request in the route metrics, logs it when it was slow
+    and returns the value of its Server-Timing header.
+    """
+    total = time.perf_counter() - stats.started
+    route_metrics.observe(method, route, status, stats, total)
+    if (total - stats.wait_seconds) * 1000 >= SLOW_REQUEST_MS:
+        logger.warning('slow request %s %s: %.1f ms, %d queries in %.1f ms, %d rows, slowest query %.1f ms: %s',
+                       method, path, total * 1000, stats.statements, stats.db_seconds * 1000, stats.rows,
+                       stats.slowest_seconds * 1000, stats.slowest_statement)
+    return (f'db;dur={stats.db_seconds * 1000:.2f};desc="{stats.statements} queries", '
+            f'ser;dur={stats.serialization_seconds * 1000:.2f}, '
+            f'wait;dur={stats.wait_seconds * 1000:.2f}, '
+            f'total;dur={total * 1000:.2f}')
+
+
+def count_loaded_instance(target, context):
+    record_rows(1)
+
+
+def setup_instrumentation(app, db):
+    # the listener is process wide, every app after the first one shares it
+    if not event.contains(db.Model, 'load', count_loaded_instance):
+        event.listen(db.Model, 'load', count_loaded_instance, propagate=True)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def report_request_stats(response):
+        stats = g.pop('request_stats', None)
+        if stats is None:
+            return response
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        response.headers['Server-Timing'] = finish_request_stats(
+            stats, request.method, route, request.full_path, response.status_code)
+        return response
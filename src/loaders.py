@@ -0,0 +1,70 @@
+"""
+Request scoped batching of lookups by id, in the manner of a DataLoader:
+callers first say which rows they will need (want), then the first load()
+fetches every wanted row of the model with one IN query. The rows are kept
+for the rest of the request, so nested serializations asking for the same
+rows again don't query again.
+"""
+from flask import g, has_request_context
+from sqlalchemy import inspect
+
+# ids per IN query
+LOAD_BATCH_SIZE = 500
+
+
+class Loader:
+    def __init__(self, model):
+        self.model = model
+        # id -> row, None for the ids that don't exist
+        self.rows = {}
+        self.wanted = set()
+        self.queries = 0
+
+    def _cached(self, id_):
+        if id_ not in self.rows:
+            return False
+        row = self.rows[id_]
+        # rows expired by a commit load again, rather than one by one on access
+        return row is None or not inspect(row).expired_attributes
+
+    def want(self, ids):
+        self.wanted.update(id_ for id_ in ids if id_ is not None and not self._cached(id_))
+
+    def prime(self, row):
+        self.rows[row.id] = row
+
+    def dispatch(self):
+        wanted = sorted(self.wanted)
+        self.wanted = set()
+        for start in range(0, len(wanted), LOAD_BATCH_SIZE):
+            batch = wanted[start:start + LOAD_BATCH_SIZE]
+            found = {row.id: row for row in self.model.query.filter(self.model.id.in_(batch))}
+            self.queries += 1
+            for id_ in batch:
+                self.rows[id_] = found.get(id_)
+
+    def load_many(self, ids):
+        """
+        The rows of `ids` in the same order, None for the missing ones, along
+        with everything else wanted so far.
+        """
+        self.want(ids)
+        if self.wanted:
+            self.dispatch()
+        return [self.rows.get(id_) for id_ in ids]
+
+    def load(self, id_):
+        return self.load_many([id_])[0]
+
+
+def loader(model):
+    """
+    The loader of `model` for the current request, a new one outside of
+    requests.
+    """
+    if not has_request_context():
+        return Loader(model)
+    loaders = g.setdefault('loaders', {})
+    if model not in loaders:
+        loaders[model] = Loader(model)
+    return loaders[model]
@@ -1,12 +1,91 @@
+import logging
+import math
+import time
+from datetime import datetime, timezone
+from itertools import chain
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import String, ForeignKey, Boolean, Integer
-from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy import String, ForeignKey, Boolean, Integer, BigInteger, DateTime, Index, LargeBinary, case, event, func, inspect, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Mapped, Session, mapped_column, relationship
+from loaders import loader
+from replicas import RoutingSession
 
-db = SQLAlchemy()
+logger = logging.getLogger(__name__)
+
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# callables run after every commit with the names of the tables it wrote
+table_change_listeners = []
+
+
+def on_tables_changed(listener):
+    table_change_listeners.append(listener)
+    return listener
+
+
+def notify_tables_changed(tables):
+    for listener in table_change_listeners:
+        listener(tables)
+
+
+@event.listens_for(Session, 'after_flush')
+def track_flushed_tables(session, flush_context):
+    changed = session.info.setdefault('changed_tables', set())
+    for obj in chain(session.new, session.deleted):
+        changed.add(obj.__table__.name)
+    for obj in session.dirty:
+        if session.is_modified(obj):
+            changed.add(obj.__table__.name)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_bulk_statements(orm_execute_state):
+    # bulk INSERT/UPDATE/DELETE statements bypass the flush
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        changed = orm_execute_state.session.info.setdefault('changed_tables', set())
+        # a statement can be tracked under another table, see favorite_count_update()
+        table = orm_execute_state.execution_options.get('tracked_table', orm_execute_state.statement.table.name)
+        changed.add(table)
+
+
+@event.listens_for(Session, 'after_commit')
+def notify_changed_tables(session):
+    changed = session.info.pop('changed_tables', None)
+    if changed:
+        # a session can run the listeners elsewhere, see asgi.py
+        session.info.get('notify_tables_changed', notify_tables_changed)(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changed_tables(session):
+    session.info.pop('changed_tables', None)
+
+
+def pick_fields(data, fields):
+    if fields is None:
+        return data
+    return {field: data[field] for field in fields}
+
+
+def popularity_index(table):
+    # read backwards for the most favorited first
+    return Index(f'ix_{table}_favorites_count', 'favorites_count', 'id')
+
+
+def favorite_unique_index(column):
+    # partial index: a row only takes part in the index of the item type it holds
+    where = text(f'{column} IS NOT NULL')
+    return Index(f'uq_favorites_user_{column}', 'user_id', column, unique=True,
+                 postgresql_where=where, sqlite_where=where)
 
 
 class User(db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        # prefix searches of the admin
+        Index('ix_users_email_pattern', 'email', postgresql_ops={'email': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+    )
+    serialized_columns = ('id', 'name', 'email', 'is_active')
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(50), nullable=False)
@@ -19,17 +98,20 @@ class User(db.Model):
     def __repr__(self):
         return f'Usuario {self.email}'
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None):
+        return pick_fields({
             'id': self.id,
             'name': self.name,
             'email': self.email,
             'is_active': self.is_active,
-        }
+        }, fields)
 
 
 class Login(db.Model):
     __tablename__ = 'logins'
+    __table_args__ = (
+        Index('ix_logins_user_id', 'user_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=False)
@@ -47,12 +129,23 @@ class Login(db.Model):
 
 class Planet(db.Model):
     __tablename__ = 'planets'
+    __table_args__ = (
+        Index('ix_planets_climate', 'climate', 'id'),
+        Index('ix_planets_terrain', 'terrain', 'id'),
+        Index('ix_planets_name_pattern', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+        popularity_index('planets'),
+    )
+    serialized_columns = ('id', 'name', 'climate', 'terrain', 'description')
+    # only serialized when asked for
+    optional_columns = ('favorites_count',)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     climate: Mapped[str] = mapped_column(String(100), nullable=False)
     name: Mapped[str] = mapped_column(String(30), nullable=False, unique=True)
     description: Mapped[str] = mapped_column(String(150), nullable=False)
     terrain: Mapped[str] = mapped_column(String(100), nullable=False)
+    # maintained by favorites.py, rebuilt by `flask backfill-favorite-counts`
+    favorites_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
 
     characters: Mapped[list['Character']] = relationship(back_populates='planet')
     favorites: Mapped[list['Favorite']] = relationship(back_populates='planet')
@@ -60,73 +153,105 @@ class Planet(db.Model):
     def __repr__(self):
         return f'<Planet id={self.id} name="{self.name}">'
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None):
+        return pick_fields({
             'id': self.id,
             'name': self.name,
             'climate': self.climate,
             'terrain': self.terrain,
             'description': self.description,
-        }
+            'favorites_count': self.favorites_count,
+        }, fields or self.serialized_columns)
 
 
 class Character(db.Model):
     __tablename__ = 'characters'
+    __table_args__ = (
+        Index('ix_characters_planet_id', 'planet_id', 'id'),
+        Index('ix_characters_name', 'name', 'id'),
+        Index('ix_characters_height', 'height', 'id'),
+        Index('ix_characters_name_pattern', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+        popularity_index('characters'),
+    )
+    serialized_columns = ('id', 'name', 'height', 'description', 'planet_id')
+    optional_columns = ('favorites_count',)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(25), nullable=False)
     height: Mapped[int] = mapped_column(Integer, nullable=False)
     description: Mapped[str] = mapped_column(String(200), nullable=False)
     planet_id: Mapped[int] = mapped_column(ForeignKey('planets.id'), nullable=True)
+    favorites_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
     planet: Mapped['Planet'] = relationship(back_populates='characters')
     favorites: Mapped[list['Favorite']] = relationship(back_populates='character')
 
     def __repr__(self):
         return f'personaje {self.name}'
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None):
+        return pick_fields({
             'id': self.id,
             'name': self.name,
             'height': self.height,
             'description': self.description,
             'planet_id': self.planet_id,
-        }
+            'favorites_count': self.favorites_count,
+        }, fields or self.serialized_columns)
 
 
 class Starship(db.Model):
     __tablename__ = 'starships'
+    __table_args__ = (
+        Index('ix_starships_name', 'name', 'id'),
+        Index('ix_starships_name_pattern', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}).ddl_if(dialect='postgresql'),
+        popularity_index('starships'),
+    )
+    serialized_columns = ('id', 'name', 'model', 'manufacturer', 'description')
+    optional_columns = ('favorites_count',)
 
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(String(60), nullable=False)
     model: Mapped[str] = mapped_column(String(80), nullable=False)
     manufacturer: Mapped[str] = mapped_column(String(120), nullable=False)
     description: Mapped[str] = mapped_column(String(200), nullable=False)
+    favorites_count: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default='0')
 
     favorites: Mapped[list['Favorite']] = relationship(back_populates='starship')
 
     def __repr__(self):
         return f'<Starship id={self.id} name="{self.name}" model="{self.model}">'
 
-    def serialize(self):
-        return {
+    def serialize(self, fields=None):
+        return pick_fields({
             'id': self.id,
             'name': self.name,
             'model': self.model,
             'manufacturer': self.manufacturer,
             'description': self.description,
-        }
+            'favorites_count': self.favorites_count,
+        }, fields or self.serialized_columns)
 
 
 class Favorite(db.Model):
     __tablename__ = 'favorites'
+    __table_args__ = (
+        favorite_unique_index('character_id'),
+        favorite_unique_index('planet_id'),
+        favorite_unique_index('starship_id'),
+        # the unique indexes are partial, these serve the lookups by user or by item
+        Index('ix_favorites_user_id', 'user_id', 'id'),
+        Index('ix_favorites_character_id', 'character_id'),
+        Index('ix_favorites_planet_id', 'planet_id'),
+        Index('ix_favorites_starship_id', 'starship_id'),
+    )
 
     id: Mapped[int] = mapped_column(primary_key=True)
 
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=False)
-    character_id: Mapped[int] = mapped_column(ForeignKey('characters.id'), nullable=True)
-    planet_id: Mapped[int] = mapped_column(ForeignKey('planets.id'), nullable=True)
-    starship_id: Mapped[int] = mapped_column(ForeignKey('starships.id'), nullable=True)
+    # active history: the favorite counters need the previous item when it changes
+    character_id: Mapped[int] = mapped_column(ForeignKey('characters.id'), nullable=True, active_history=True)
+    planet_id: Mapped[int] = mapped_column(ForeignKey('planets.id'), nullable=True, active_history=True)
+    starship_id: Mapped[int] = mapped_column(ForeignKey('starships.id'), nullable=True, active_history=True)
 
     user: Mapped['User'] = relationship(back_populates='favorites')
     character: Mapped['Character'] = relationship(back_populates='favorites')
@@ -136,22 +261,166 @@ class Favorite(db.Model):
     def __repr__(self):
         return f'Favorite(user_id={self.user_id}, character_id={self.character_id}, planet_id={self.planet_id}, starship_id={self.starship_id})'
 
+    def _item_reference(self):
+        # (type, model, id) of the favorited item; the type names the relationship
+        if self.character_id is not None:
+            return 'character', Character, self.character_id
+        if self.planet_id is not None:
+            return 'planet', Planet, self.planet_id
+        if self.starship_id is not None:
+            return 'starship', Starship, self.starship_id
+        return None, None, None
+
+    def want_item(self):
+        """
+        Queues the item for the loader of the request (see loaders.py), so
+        serializing a list of favorites takes one query per item type.
+        """
+        fav_type, model, item_id = self._item_reference()
+        if fav_type is not None and fav_type in inspect(self).unloaded:
+            loader(model).want([item_id])
+
     def serialize(self):
-        fav_type = None
+        fav_type, model, item_id = self._item_reference()
         item = None
-
-        if self.character_id is not None:
-            fav_type = 'character'
-            item = self.character.serialize() if self.character else {'id': self.character_id, 'name': None}
-        elif self.planet_id is not None:
-            fav_type = 'planet'
-            item = self.planet.serialize() if self.planet else {'id': self.planet_id, 'name': None}
-        elif self.starship_id is not None:
-            fav_type = 'starship'
-            item = self.starship.serialize() if self.starship else {'id': self.starship_id, 'name': None}
+        if fav_type is not None:
+            # loaded with the favorite (joinedload), or through the loader,
+            # which keeps it for the rest of the request either way
+            if fav_type in inspect(self).unloaded:
+                row = loader(model).load(item_id)
+            else:
+                row = getattr(self, fav_type)
+                if row is not None:
+                    loader(model).prime(row)
+            item = row.serialize() if row else {'id': item_id, 'name': None}
 
         return {
             'id': self.id,
             'type': fav_type,
             'item': item
         }
+
+
+class TableChange(db.Model):
+    """
+    When each table last changed, for the Last-Modified of the responses read
+    from it, and its version, bumped by every commit that writes it: what the
+    processes compare their caches with (see versions.py). Written after the
+    commits (see record_table_changes), so the write transactions never wait
+    on these rows.
+    """
+    __tablename__ = 'table_changes'
+
+    table_name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    changed_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    version: Mapped[int] = mapped_column(BigInteger(), nullable=False, server_default='0')
+
+    def __repr__(self):
+        return f'<TableChange {self.table_name} {self.changed_at}>'
+
+
+class Change(db.Model):
+    """
+    The change log of the characters, planets, starships and favorites, one
+    row per inserted, updated or deleted row. Written by database triggers,
+    read in (txid, id) order (see changes.py).
+    """
+    __tablename__ = 'changes'
+    __table_args__ = (
+        Index('ix_changes_position', 'txid', 'id'),
+        Index('ix_changes_row', 'table_name', 'row_id', 'id'),
+        Index('ix_changes_changed_at', 'changed_at'),
+        # ids are never reused, even after the newest rows are deleted
+        {'sqlite_autoincrement': True},
+    )
+
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer(), 'sqlite'), primary_key=True)
+    table_name: Mapped[str] = mapped_column(String(50), nullable=False)
+    row_id: Mapped[int] = mapped_column(Integer(), nullable=False)
+    op: Mapped[str] = mapped_column(String(10), nullable=False)
+    # the user of a favorite
+    user_id: Mapped[int] = mapped_column(Integer(), nullable=True)
+    changed_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+    # the writing transaction on PostgreSQL, 0 elsewhere
+    txid: Mapped[int] = mapped_column(BigInteger(), nullable=False, server_default='0')
+
+    def __repr__(self):
+        return f'<Change {self.id} {self.op} {self.table_name} {self.row_id}>'
+
+
+class ChangeCursor(db.Model):
+    """
+    Position of a reader of the change log that runs in any process, shared
+    so they take turns (see user_favorites.py).
+    """
+    __tablename__ = 'change_cursors'
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    txid: Mapped[int] = mapped_column(BigInteger(), nullable=False)
+    change_id: Mapped[int] = mapped_column(BigInteger(), nullable=False)
+
+    def __repr__(self):
+        return f'<ChangeCursor {self.name} {self.txid} {self.change_id}>'
+
+
+class UserFavorites(db.Model):
+    """
+    The body of GET /users/<id>/favorites of a user, kept up to date by
+    user_favorites.py.
+    """
+    __tablename__ = 'user_favorites'
+
+    user_id: Mapped[int] = mapped_column(ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
+    body: Mapped[bytes] = mapped_column(LargeBinary(), nullable=False)
+    built_at: Mapped[datetime] = mapped_column(DateTime(), nullable=False)
+
+    def __repr__(self):
+        return f'<UserFavorites {self.user_id} {self.built_at}>'
+
+
+@on_tables_changed
+def record_table_changes(tables):
+    """
+    Bumps the version of `tables` and stores the time of the commit that
+    changed them.
+    """
+    changed_at = datetime.fromtimestamp(time.time(), timezone.utc).replace(tzinfo=None)
+    # another worker may have recorded a later change already
+    values = {'version': TableChange.version + 1,
+              'changed_at': case((TableChange.changed_at < changed_at, changed_at), else_=TableChange.changed_at)}
+    try:
+        with db.engine.begin() as connection:
+            for table in sorted(tables):
+                statement = update(TableChange).where(TableChange.table_name == table).values(values)
+                if connection.execute(statement).rowcount:
+                    continue
+                try:
+                    with connection.begin_nested():
+                        connection.execute(TableChange.__table__.insert().values(
+                            table_name=table, changed_at=changed_at, version=1))
+                except IntegrityError:
+                    # inserted by another worker meanwhile
+                    connection.execute(statement)
+    except Exception:
+        # the write itself is committed, the other processes only see it
+        # when the table changes again
+        logger.warning('could not record the changes of %s', ', '.join(tables), exc_info=True)
+
+
+def tables_last_modified(tables, connection=None):
+    """
+    Last-Modified of a response read from `tables`: their last change, rounded
+    up to the second. Until that second is over the date isn't usable yet (see
+    last_modified_header), a later change in the same second gets the same one.
+    """
+    changed_at = (connection or db.session).execute(
+        select(func.max(TableChange.changed_at)).where(TableChange.table_name.in_(tables))).scalar()
+    if changed_at is None:
+        return None
+    return datetime.fromtimestamp(math.ceil(changed_at.replace(tzinfo=timezone.utc).timestamp()), timezone.utc)
+
+
+def last_modified_header(last_modified):
+    if last_modified is None or last_modified.timestamp() > time.time():
+        return None
+    return last_modified
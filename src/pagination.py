@@ -0,0 +1,214 @@
+"""
+Keyset (cursor) pagination and streaming helpers for the list endpoints
+"""
+import base64
+import binascii
+import json
+from flask import Response, current_app, request, stream_with_context, url_for
+from sqlalchemy import and_, or_
+from filters import apply_filters, parse_fields, parse_sort
+from serializers import row_dicts
+from instrumentation import record_rows
+from loaders import loader
+from utils import APIException
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 1000
+STREAM_BATCH_SIZE = 500
+STREAM_FORMATS = ('json', 'ndjson')
+# the query string of a multi-get (`ids`)
+MULTI_GET_ARGS = {'ids', 'fields'}
+
+
+def encode_cursor(position):
+    # position is the id of the last row, or [sort value, id] when sorting by another column
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        return json.loads(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise APIException('Invalid cursor', status_code=400)
+
+
+def wants_pagination():
+    return 'limit' in request.args or 'after' in request.args
+
+
+def parse_limit():
+    limit = request.args.get('limit', DEFAULT_LIMIT, type=int)
+    if limit is None or limit < 1:
+        raise APIException('limit must be a positive integer', status_code=400)
+    return min(limit, MAX_LIMIT)
+
+
+def ordered(query, model, sort_column, descending):
+    if sort_column is model.id:
+        return query.order_by(model.id.desc() if descending else model.id)
+    # id breaks ties so the order (and the cursors) are stable
+    return query.order_by(sort_column.desc() if descending else sort_column, model.id)
+
+
+def after_position(model, sort_column, descending, position):
+    if sort_column is model.id:
+        if not isinstance(position, int):
+            raise APIException('Invalid cursor', status_code=400)
+        return model.id < position if descending else model.id > position
+    if not isinstance(position, list) or len(position) != 2:
+        raise APIException('Invalid cursor', status_code=400)
+    value, last_id = position
+    past_value = sort_column < value if descending else sort_column > value
+    return or_(past_value, and_(sort_column == value, model.id > last_id))
+
+
+def keyset_page(query, model, sort_column, descending):
+    """
+    Returns (rows, next_cursor) for the page after the `after` cursor.
+    Rows are ordered by an indexed column (and id), so each page is a single
+    index range scan. `query` selects columns and ends with the sort column
+    and the id.
+    """
+    limit = parse_limit()
+    after = request.args.get('after')
+    if after:
+        query = query.filter(after_position(model, sort_column, descending, decode_cursor(after)))
+    # one extra row tells us whether there is a next page without a COUNT(*)
+    rows = ordered(query, model, sort_column, descending).limit(limit + 1).all()
+    record_rows(len(rows))
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        sort_value, last_id = rows[-1][-2:]
+        if sort_column is model.id:
+            next_cursor = encode_cursor(last_id)
+        else:
+            next_cursor = encode_cursor([sort_value, last_id])
+    return rows, next_cursor
+
+
+def paginated_response(query, model, sort_column, descending, keys):
+    rows, next_cursor = keyset_page(query, model, sort_column, descending)
+    return page_response(row_dicts(rows, keys), next_cursor)
+
+
+def page_response(data, next_cursor, **fields):
+    """
+    A page of `data`, with the link to the next page in the body and in a
+    Link header when there is one. `fields` go in the body too.
+    """
+    body = {'data': data, **fields}
+    headers = {}
+    if next_cursor is not None:
+        args = request.args.to_dict()
+        args['after'] = next_cursor
+        body['next'] = url_for(request.endpoint, **request.view_args, **args)
+        headers['Link'] = f'<{body["next"]}>; rel="next"'
+    return current_app.json.response(body), 200, headers
+
+
+def stream_format():
+    fmt = request.args.get('stream')
+    if fmt is None:
+        if request.accept_mimetypes.best == 'application/x-ndjson':
+            return 'ndjson'
+        return None
+    if fmt not in STREAM_FORMATS:
+        raise APIException(f'stream must be one of {", ".join(STREAM_FORMATS)}', status_code=400)
+    return fmt
+
+
+def streamed_response(query, keys, fmt):
+    """
+    Streams every row of `query` without materializing the result: rows come
+    from a server-side cursor in batches of STREAM_BATCH_SIZE.
+    """
+    session = query.session
+    statement = query.statement
+    dumpb = current_app.json.dumpb
+
+    def rows():
+        return session.execute(statement, execution_options={
+            'yield_per': STREAM_BATCH_SIZE, 'stream_results': True})
+
+    def generate_json():
+        yield b'{"data":['
+        first = True
+        for row in rows():
+            if not first:
+                yield b','
+            first = False
+            yield dumpb(dict(zip(keys, row)))
+        yield b']}\n'
+
+    def generate_ndjson():
+        for row in rows():
+            yield dumpb(dict(zip(keys, row))) + b'\n'
+
+    if fmt == 'ndjson':
+        return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+    return Response(stream_with_context(generate_json()), mimetype='application/json')
+
+
+def parse_ids():
+    try:
+        ids = [int(id_) for id_ in request.args['ids'].split(',') if id_.strip()]
+    except ValueError:
+        raise APIException('ids must be a comma separated list of integers', status_code=400)
+    if not ids or len(ids) > MAX_LIMIT:
+        raise APIException(f'ids must hold between 1 and {MAX_LIMIT} ids', status_code=400)
+    # repeated ids are answered once
+    return list(dict.fromkeys(ids))
+
+
+def multi_get_response(model):
+    """
+    The rows of `ids`, in the order asked for, fetched with one IN query
+    through the loader of the request; the ids that don't exist are listed
+    under `missing`.
+    """
+    if set(request.args) - MULTI_GET_ARGS:
+        raise APIException('ids can only be combined with fields', status_code=400)
+    ids = parse_ids()
+    fields = parse_fields(model)
+    rows = loader(model).load_many(ids)
+    # ORM rows, counted by the load event (see instrumentation.py)
+    found = [row for row in rows if row is not None]
+    return current_app.json.response({
+        'data': [row.serialize(fields) for row in found],
+        'missing': [id_ for id_, row in zip(ids, rows) if row is None],
+    }), 200
+
+
+def list_response(query, model):
+    """
+    Shared body of the list endpoints: filters, sort and sparse fieldsets from
+    the query string, then streaming when asked for, a keyset page when
+    `limit`/`after` are present and the full list otherwise. The full list
+    stays uncapped, as GET /planets and /people answer it from the
+    precompiled lists; admission.py charges it `unbounded_cost` instead.
+
+    Only the serialized columns are selected and the rows are encoded as they
+    come, without building ORM objects. The output is the same as encoding
+    [row.serialize(fields) for row in query].
+
+    With `ids`, the rows of those ids instead (see multi_get_response).
+    """
+    if 'ids' in request.args:
+        return multi_get_response(model)
+    query = apply_filters(query, model)
+    sort_column, descending = parse_sort(model)
+    keys = parse_fields(model) or model.serialized_columns
+    # the sort column and the id go last, for the cursors
+    columns = [getattr(model, key) for key in keys] + [sort_column, model.id]
+    query = query.with_entities(*columns)
+
+    fmt = stream_format()
+    if fmt is not None:
+        return streamed_response(ordered(query, model, sort_column, descending), keys, fmt)
+    if wants_pagination():
+        return paginated_response(query, model, sort_column, descending, keys)
+    rows = ordered(query, model, sort_column, descending).all()
+    record_rows(len(rows))
+    return current_app.json.response({'data': row_dicts(rows, keys)}), 200
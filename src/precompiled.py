@@ -0,0 +1,252 @@
+"""
+Precompiled bodies of the full catalog lists, GET /planets and GET /people
+without a query string. Each list keeps the encoded JSON of every row, the
+assembled body and its compressed variants in memory, and is served without
+touching the database while the version of its table stays the same. The
+versions are shared by every process (see versions.py): a write of another
+worker, a CLI command or the admin is seen within VERSION_POLL_SECONDS.
+
+Rows written through a session of this process are patched in place: the
+next request re-reads only those rows. Any other change to the table (a
+bulk statement, another process) rebuilds the whole list. In debug mode the lists go through the regular handlers, the
+debug JSON provider indents its output.
+
+gunicorn.conf.py builds them when a worker starts.
+"""
+import bisect
+import hashlib
+import itertools
+import struct
+import threading
+import zlib
+from flask import current_app, request
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import db, last_modified_header, tables_last_modified, Character, Planet
+from versions import table_versions
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the rows re-read per query when patching
+PATCH_BATCH_SIZE = 500
+# the gzip body is made of independently compressed segments of the rows
+# with ids in the same range, a patch only recompresses the segments it touches
+GZIP_SEGMENT_IDS = 1024
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def deflate(data, final=False):
+    """
+    Raw deflate blocks of `data` that can be concatenated with other ones: a
+    new compressor each time, and a flush to a byte boundary.
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+PREFIX = b'{"data":['
+SUFFIX = b']}\n'
+DEFLATED_PREFIX = deflate(PREFIX)
+DEFLATED_COMMA = deflate(b',')
+DEFLATED_SUFFIX = deflate(SUFFIX, final=True)
+
+
+class PrecompiledList:
+    def __init__(self, model):
+        self.table = model.__table__
+        self.keys = model.serialized_columns
+        self.columns = [self.table.c[key] for key in self.keys] + [self.table.c.id]
+        self.ids = []
+        self.entries = {}
+        self.body = None
+        self.variants = {}
+        self.segments = {}
+        self.last_modified = None
+        # version of the table (versions.py) the body matches
+        self.version = None
+        # commits of this process since: their rows are in `pending`, unless
+        # one of them changed rows it can't name
+        self.local_commits = 0
+        self.pending = set()
+        self.stale = True
+        self.rebuilds = 0
+        self.patches = 0
+        self._lock = threading.Lock()
+
+    def _encode(self, row):
+        return current_app.json.dumpb(dict(zip(self.keys, row)))
+
+    def _assemble(self, version):
+        self.body = PREFIX + b','.join([self.entries[id_] for id_ in self.ids]) + SUFFIX
+        self.variants = {None: (self.body, hashlib.sha1(self.body).hexdigest())}
+        self.version = version
+        self.local_commits = 0
+        self.pending = set()
+        self.stale = False
+
+    def _rebuild(self, connection, version):
+        rows = connection.execute(select(*self.columns).order_by(self.table.c.id)).all()
+        self.entries = {row[-1]: self._encode(row) for row in rows}
+        self.ids = [row[-1] for row in rows]
+        self.segments = {}
+        self.rebuilds += 1
+        self._assemble(version)
+
+    def _patch(self, connection, version):
+        pending = sorted(self.pending)
+        found = set()
+        for start in range(0, len(pending), PATCH_BATCH_SIZE):
+            batch = pending[start:start + PATCH_BATCH_SIZE]
+            for row in connection.execute(select(*self.columns).where(self.table.c.id.in_(batch))):
+                found.add(row[-1])
+                if row[-1] not in self.entries:
+                    bisect.insort(self.ids, row[-1])
+                self.entries[row[-1]] = self._encode(row)
+        for id_ in pending:
+            self.segments.pop(id_ // GZIP_SEGMENT_IDS, None)
+        deleted = [id_ for id_ in pending if id_ not in found and id_ in self.entries]
+        for id_ in deleted:
+            del self.entries[id_]
+        if deleted:
+            deleted = set(deleted)
+            self.ids = [id_ for id_ in self.ids if id_ not in deleted]
+        self.patches += 1
+        self._assemble(version)
+
+    def refresh(self):
+        """
+        Brings the body up to date with the table. False when the version of
+        the table can't be read.
+        """
+        version = table_versions.version(self.table.name)
+        if version is None:
+            return False
+        with self._lock:
+            if self.body is not None and not self.stale and version == self.version and not self.pending:
+                return True
+            # always from the primary, a replica may not have the writes yet
+            with db.engine.connect() as connection:
+                if self.body is None or self.stale or version != self.version + self.local_commits:
+                    self._rebuild(connection, version)
+                else:
+                    self._patch(connection, version)
+                self.last_modified = tables_last_modified([self.table.name], connection)
+        return True
+
+    def _gzip(self):
+        parts = [GZIP_HEADER, DEFLATED_PREFIX]
+        for segment, ids in itertools.groupby(self.ids, lambda id_: id_ // GZIP_SEGMENT_IDS):
+            if segment not in self.segments:
+                self.segments[segment] = deflate(b','.join([self.entries[id_] for id_ in ids]))
+            if len(parts) > 2:
+                parts.append(DEFLATED_COMMA)
+            parts.append(self.segments[segment])
+        parts += [DEFLATED_SUFFIX, struct.pack('<II', zlib.crc32(self.body), len(self.body) & 0xffffffff)]
+        return b''.join(parts)
+
+    def variant(self, encoding):
+        """
+        (body, etag) of the body compressed with `encoding`, compressed on
+        first use.
+        """
+        with self._lock:
+            if encoding not in self.variants:
+                body, etag = self.variants[None]
+                compressed = brotli.compress(body, quality=9) if encoding == 'br' else self._gzip()
+                # another representation, another strong ETag
+                self.variants[encoding] = (compressed, f'{etag}-{encoding}')
+            return self.variants[encoding]
+
+    def changed(self, ids):
+        with self._lock:
+            if ids is None:
+                self.stale = True
+            else:
+                self.local_commits += 1
+                self.pending.update(ids)
+
+    def stats(self):
+        return {'rows': len(self.ids), 'bytes': len(self.body or b''),
+                'rebuilds': self.rebuilds, 'patches': self.patches}
+
+
+precompiled_lists = {model.__tablename__: PrecompiledList(model) for model in (Planet, Character)}
+
+
+@event.listens_for(Session, 'after_flush')
+def track_flushed_rows(session, flush_context):
+    changed = session.info.setdefault('precompiled_rows', {})
+    for obj in list(session.new) + list(session.deleted) + list(session.dirty):
+        table = obj.__table__.name
+        if table in precompiled_lists and (obj not in session.dirty or session.is_modified(obj)):
+            ids = changed.setdefault(table, set())
+            if ids is not None:
+                ids.add(obj.id)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def track_bulk_rows(orm_execute_state):
+    # counted like in models.track_bulk_statements, the rows are unknown
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = orm_execute_state.execution_options.get('tracked_table', orm_execute_state.statement.table.name)
+        if table in precompiled_lists:
+            orm_execute_state.session.info.setdefault('precompiled_rows', {})[table] = None
+
+
+@event.listens_for(Session, 'after_commit')
+def patch_precompiled_lists(session):
+    for table, ids in session.info.pop('precompiled_rows', {}).items():
+        precompiled_lists[table].changed(ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_precompiled_rows(session):
+    session.info.pop('precompiled_rows', None)
+
+
+ENCODINGS = ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def accepted_encoding():
+    if not request.accept_encodings:
+        return None
+    encoding = request.accept_encodings.best_match(ENCODINGS + ['identity'])
+    return None if encoding == 'identity' else encoding
+
+
+def full_list_response(table, build):
+    """
+    The precompiled body of `table` when the request asks for the whole list,
+    the response of `build` otherwise.
+    """
+    precompiled = precompiled_lists[table]
+    if request.args or current_app.debug or not precompiled.refresh():
+        return build()
+    encoding = accepted_encoding()
+    body, etag = precompiled.variant(encoding)
+    response = current_app.response_class(body, mimetype='application/json')
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    response.last_modified = last_modified_header(precompiled.last_modified)
+    return response.make_conditional(request)
+
+
+def warm_up(app):
+    with app.app_context():
+        for precompiled in precompiled_lists.values():
+            if precompiled.refresh():
+                for encoding in ENCODINGS:
+                    precompiled.variant(encoding)
+
+
+def precompiled_stats():
+    stats = {}
+    for table, precompiled in precompiled_lists.items():
+        for name, value in precompiled.stats().items():
+            stats[f'{table}_{name}'] = value
+    return stats
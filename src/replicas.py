@@ -0,0 +1,203 @@
+"""
+Read replicas: the GET requests of the API run their queries on one of the
+DATABASE_REPLICA_URLS (comma separated), picked round-robin per request,
+while writes, the admin and everything else stay on the primary.
+
+A replica that fails is taken out of the rotation and the request is retried
+on the primary. After REPLICA_RETRY_SECONDS the next request probes it with a
+SELECT 1 before sending reads to it again.
+
+Replicas lag behind the primary, by up to REPLICA_LAG_SECONDS. For that long
+after a user changes their favorites, their favorites are read from the
+primary, and list responses built on a replica are not cached after a write
+to their table.
+"""
+import itertools
+import os
+import threading
+import time
+from flask import g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from database import check_database, engine_options, track_pool
+
+REPLICA_RETRY_SECONDS = float(os.getenv('REPLICA_RETRY_SECONDS', 30))
+REPLICA_LAG_SECONDS = float(os.getenv('REPLICA_LAG_SECONDS', 5))
+
+# endpoints that change the favorites of the `user_id` of their URL
+USER_WRITE_ENDPOINTS = {'add_favorite_planet', 'add_favorite_people', 'delete_favorite_planet',
+                        'delete_favorite_people', 'batch_favorites'}
+# endpoints that read them back and must see those changes
+USER_READ_ENDPOINTS = {'get_user_favorites'}
+
+
+def replica_urls():
+    urls = os.getenv('DATABASE_REPLICA_URLS', '')
+    return [url.strip().replace('postgres://', 'postgresql://') for url in urls.split(',') if url.strip()]
+
+
+class Replica:
+    def __init__(self, url, name):
+        self.url = url
+        self.engine = create_engine(url, **engine_options(url))
+        track_pool(self.engine, name)
+        self.down_until = 0.0
+        self.reads = 0
+        self.failures = 0
+        self._probing = threading.Lock()
+
+    def available(self):
+        if self.down_until == 0.0:
+            return True
+        if time.monotonic() < self.down_until or not self._probing.acquire(blocking=False):
+            return False
+        # a single request probes a replica coming back, the others skip it meanwhile
+        try:
+            if check_database(self.engine) is not None:
+                self.down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+                return False
+            self.down_until = 0.0
+            return True
+        finally:
+            self._probing.release()
+
+    def mark_down(self):
+        self.failures += 1
+        self.down_until = time.monotonic() + REPLICA_RETRY_SECONDS
+
+
+class ReplicaSet:
+    def __init__(self, urls):
+        self.replicas = [Replica(url, f'replica_{index}') for index, url in enumerate(urls)]
+        self._next = itertools.count()
+        self.primary_reads = 0
+
+    def choose(self):
+        """
+        The next available replica, or None when they are all down.
+        """
+        if not self.replicas:
+            return None
+        start = next(self._next)
+        for offset in range(len(self.replicas)):
+            replica = self.replicas[(start + offset) % len(self.replicas)]
+            if replica.available():
+                replica.reads += 1
+                return replica
+        return None
+
+    def stats(self):
+        stats = {'replicas': len(self.replicas),
+                 'healthy': sum(1 for replica in self.replicas if replica.down_until == 0.0),
+                 'primary_reads': self.primary_reads}
+        for index, replica in enumerate(self.replicas):
+            stats[f'reads_{index}'] = replica.reads
+            stats[f'failures_{index}'] = replica.failures
+        return stats
+
+
+class RecentWriters:
+    """
+    Users who changed their favorites less than REPLICA_LAG_SECONDS ago. With
+    a Redis cache backend they are kept in Redis, so every worker knows them.
+    """
+
+    def __init__(self, window, client=None, prefix='swapi:'):
+        self.window = window
+        self.client = client
+        self.prefix = prefix
+        self._deadlines = {}
+        self._lock = threading.Lock()
+
+    def add(self, user_id):
+        if self.client is not None:
+            try:
+                self.client.set(f'{self.prefix}wrote:{user_id}', 1, px=int(self.window * 1000))
+                return
+            except Exception:
+                pass
+        with self._lock:
+            now = time.monotonic()
+            self._deadlines = {user: deadline for user, deadline in self._deadlines.items() if deadline > now}
+            self._deadlines[user_id] = now + self.window
+
+    def __contains__(self, user_id):
+        if self.client is not None:
+            try:
+                return bool(self.client.exists(f'{self.prefix}wrote:{user_id}'))
+            except Exception:
+                pass
+        return self._deadlines.get(user_id, 0.0) > time.monotonic()
+
+
+replica_set = ReplicaSet(replica_urls())
+recent_writers = RecentWriters(REPLICA_LAG_SECONDS)
+
+
+def read_replica():
+    """
+    Replica of the current request, picked on its first query. None outside
+    of requests, for requests that read from the primary and when every
+    replica is down.
+    """
+    if not has_request_context() or not g.get('use_replica'):
+        return None
+    if 'read_replica' not in g:
+        g.read_replica = replica_set.choose()
+        if g.read_replica is None:
+            replica_set.primary_reads += 1
+    return g.read_replica
+
+
+def built_on_replica():
+    return has_request_context() and g.get('read_replica') is not None
+
+
+class RoutingSession(Session):
+    """
+    Session sending the queries of a request to its read replica, if it has
+    one. Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        replica = read_replica()
+        if replica is not None and bind is None and not self._flushing and not getattr(clause, 'is_dml', False):
+            return replica.engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def _reads_from_primary():
+    if request.method not in ('GET', 'HEAD') or request.blueprint is not None:
+        return True
+    if request.endpoint in USER_READ_ENDPOINTS:
+        return request.view_args.get('user_id') in recent_writers
+    return False
+
+
+def setup_replicas(app, db, cache_backend=None):
+    recent_writers.client = getattr(cache_backend, 'client', None)
+    if not replica_set.replicas:
+        return
+
+    @app.before_request
+    def route_reads():
+        g.use_replica = not _reads_from_primary()
+
+    @app.after_request
+    def remember_writers(response):
+        if request.endpoint in USER_WRITE_ENDPOINTS and response.status_code < 400:
+            recent_writers.add(request.view_args.get('user_id'))
+        return response
+
+    @app.errorhandler(OperationalError)
+    def retry_on_primary(error):
+        replica = g.pop('read_replica', None)
+        if replica is None:
+            raise error
+        g.use_replica = False
+        replica.mark_down()
+        replica_set.primary_reads += 1
+        db.session.rollback()
+        app.logger.warning('read replica %s failed, retrying on the primary: %s', replica.engine.url, error)
+        return app.ensure_sync(app.view_functions[request.endpoint])(**request.view_args)
@@ -0,0 +1,172 @@
+"""
+Full-text search over the names and descriptions of characters, planets and
+starships.
+
+PostgreSQL: every table has a generated `search_vector` tsvector column (name
+weighted above description) with a GIN index. SQLite: an FTS5 table indexes
+each table as external content, kept in sync by triggers. Both are created
+with the tables (see the DDL events below) and by the search index migration.
+Other databases fall back to a LIKE scan.
+
+Results of every type are ranked together and paginated with the same opaque
+cursors as the list endpoints.
+"""
+import os
+import re
+from sqlalchemy import DDL, event, text
+from models import db, Character, Planet, Starship
+
+SEARCHABLE = {
+    'character': Character.__table__,
+    'planet': Planet.__table__,
+    'starship': Starship.__table__,
+}
+# name matches count ten times as much as description matches in SQLite
+SQLITE_WEIGHTS = (10.0, 1.0)
+# the results of each type are its best SEARCH_MAX_CANDIDATES matches, so
+# the merged ranking and its pages never sort more rows than that; terms
+# found in more rows say the results are truncated (see truncated_kinds())
+SEARCH_MAX_CANDIDATES = int(os.getenv('SEARCH_MAX_CANDIDATES', 10000))
+
+SEARCH_OBJECT = re.compile(r'^(ix_)?(characters|planets|starships)_search(_\w+)?$')
+
+
+def postgresql_ddl(table):
+    return [
+        f"ALTER TABLE {table} ADD COLUMN search_vector tsvector GENERATED ALWAYS AS ("
+        f"setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+        f"setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED",
+        f"CREATE INDEX ix_{table}_search ON {table} USING GIN (search_vector)",
+    ]
+
+
+def sqlite_ddl(table):
+    index = f'{table}_search'
+    return [
+        f"CREATE VIRTUAL TABLE {index} USING fts5(name, description, content='{table}', "
+        f"content_rowid='id', tokenize='porter unicode61')",
+        f"CREATE TRIGGER {index}_insert AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {index}(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+        f"CREATE TRIGGER {index}_delete AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name, description) "
+        f"VALUES ('delete', old.id, old.name, old.description); END",
+        # only on the indexed columns, the favorite counters update these rows all the time
+        f"CREATE TRIGGER {index}_update AFTER UPDATE OF name, description ON {table} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, name, description) "
+        f"VALUES ('delete', old.id, old.name, old.description); "
+        f"INSERT INTO {index}(rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    ]
+
+
+for _table in SEARCHABLE.values():
+    for _statement in postgresql_ddl(_table.name):
+        event.listen(_table, 'after_create', DDL(_statement).execute_if(dialect='postgresql'))
+    for _statement in sqlite_ddl(_table.name):
+        event.listen(_table, 'after_create', DDL(_statement).execute_if(dialect='sqlite'))
+    # the triggers go with the table, the FTS5 table doesn't
+    event.listen(_table, 'before_drop',
+                 DDL(f'DROP TABLE IF EXISTS {_table.name}_search').execute_if(dialect='sqlite'))
+
+
+def include_object(obj, name, type_, reflected, compare_to):
+    """
+    Keeps the search index out of autogenerated migrations: it isn't part of
+    the models.
+    """
+    if type_ == 'column':
+        return name != 'search_vector'
+    return name is None or not SEARCH_OBJECT.match(name)
+
+
+def search_terms(query):
+    return re.findall(r'\w+', query)
+
+
+def _matches(dialect, kind, table):
+    if dialect == 'postgresql':
+        # id breaks the ties, the same candidates for every page
+        return (f"SELECT * FROM (SELECT '{kind}' AS type, id, name, "
+                f"CAST(ts_rank_cd(search_vector, query) AS FLOAT) AS rank "
+                f"FROM {table}, plainto_tsquery('english', :q) AS query WHERE search_vector @@ query "
+                f"ORDER BY rank DESC, id LIMIT :candidates) AS {table}_candidates")
+    if dialect == 'sqlite':
+        weights = ', '.join(str(weight) for weight in SQLITE_WEIGHTS)
+        index = f'{table}_search'
+        # bm25() is lower for better matches
+        return (f"SELECT * FROM (SELECT '{kind}' AS type, rowid AS id, name, -bm25({index}, {weights}) AS rank "
+                f"FROM {index} WHERE {index} MATCH :match ORDER BY bm25({index}, {weights}), rowid "
+                f"LIMIT :candidates) AS {table}_candidates")
+    return (f"SELECT '{kind}' AS type, id, name, "
+            f"CASE WHEN name LIKE :pattern ESCAPE '/' THEN 2.0 ELSE 1.0 END AS rank "
+            f"FROM {table} WHERE name LIKE :pattern ESCAPE '/' OR description LIKE :pattern ESCAPE '/'")
+
+
+def _overflow(dialect, kind, table):
+    # a match of the type past the number of candidates, if any
+    if dialect == 'postgresql':
+        return (f"SELECT '{kind}' AS type FROM (SELECT id FROM {table} "
+                f"WHERE search_vector @@ plainto_tsquery('english', :q) ORDER BY id LIMIT 1 OFFSET :candidates) AS overflow")
+    if dialect == 'sqlite':
+        index = f'{table}_search'
+        return (f"SELECT '{kind}' AS type FROM (SELECT rowid FROM {index} WHERE {index} MATCH :match "
+                f"ORDER BY rowid LIMIT 1 OFFSET :candidates) AS overflow")
+    # the LIKE scan ranks every match
+    return None
+
+
+def _like_escape(value):
+    # the words of search_terms() can hold _, a LIKE wildcard
+    return value.replace('/', '//').replace('%', '/%').replace('_', '/_')
+
+
+def _params(terms):
+    return {
+        'q': ' '.join(terms),
+        # quoted, so words like AND or NEAR are not read as FTS5 operators
+        'match': ' '.join(f'"{term}"' for term in terms),
+        'pattern': '%' + _like_escape(' '.join(terms)) + '%',
+        'candidates': SEARCH_MAX_CANDIDATES,
+    }
+
+
+def truncated_kinds(terms, kinds):
+    """
+    The types of `kinds` with more matches than SEARCH_MAX_CANDIDATES, whose
+    matches past the first ones were left out of the results.
+    """
+    dialect = db.session.get_bind().dialect.name
+    selects = [_overflow(dialect, kind, SEARCHABLE[kind].name) for kind in kinds]
+    selects = [select for select in selects if select is not None]
+    if not selects:
+        return []
+    return db.session.execute(text(' UNION ALL '.join(selects)), _params(terms)).scalars().all()
+
+
+def search(terms, kinds, limit, after=None):
+    """
+    Returns up to `limit` + 1 rows of (type, id, name, rank), best first,
+    matching every term. `after` is the (rank, type, id) of the last row of
+    the previous page.
+    """
+    dialect = db.session.get_bind().dialect.name
+    union = ' UNION ALL '.join(_matches(dialect, kind, SEARCHABLE[kind].name) for kind in kinds)
+    params = dict(_params(terms), limit=limit + 1)
+    where = ''
+    if after is not None:
+        where = ('WHERE rank < :rank OR (rank = :rank AND (type > :type OR (type = :type AND id > :id))) ')
+        params.update(zip(('rank', 'type', 'id'), after))
+    statement = text(f'SELECT type, id, name, rank FROM ({union}) AS results {where}'
+                     f'ORDER BY rank DESC, type, id LIMIT :limit')
+    return db.session.execute(statement, params).all()
+
+
+def rebuild_search_index():
+    """
+    Rebuilds the FTS5 tables from their content tables. Returns False on
+    databases where the index can't go out of sync.
+    """
+    if db.session.get_bind().dialect.name != 'sqlite':
+        return False
+    for table in SEARCHABLE.values():
+        db.session.execute(text(f"INSERT INTO {table.name}_search({table.name}_search) VALUES ('rebuild')"))
+    return True
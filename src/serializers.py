@@ -0,0 +1,67 @@
+"""
+Fast JSON encoding for the API: an orjson based provider (falling back to the
+standard library when orjson is missing) and a serialization path that reads
+column tuples instead of ORM objects.
+"""
+from flask.json.provider import DefaultJSONProvider
+from instrumentation import serialization_timer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+COMPACT_SEPARATORS = (',', ':')
+
+
+class JSONProvider(DefaultJSONProvider):
+    """
+    Produces exactly the bytes of Flask's default provider for compact output
+    (sorted keys, ASCII only), using orjson when it can. Anything orjson can't
+    reproduce byte for byte (indentation, non-ASCII text, non string keys...)
+    goes through the standard library.
+    """
+
+    def _fast_dumps(self, obj):
+        if orjson is None:
+            return None
+        try:
+            encoded = orjson.dumps(obj, default=self.default,
+                                   option=orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+        except TypeError:
+            return None
+        # orjson writes UTF-8 while the default provider escapes to ASCII
+        return encoded if encoded.isascii() else None
+
+    def dumps(self, obj, **kwargs):
+        if kwargs == {'separators': COMPACT_SEPARATORS}:
+            encoded = self._fast_dumps(obj)
+            if encoded is not None:
+                return encoded.decode()
+        return super().dumps(obj, **kwargs)
+
+    def dumpb(self, obj):
+        """
+        Compact encoding as bytes, skipping the str round trip when possible.
+        """
+        encoded = self._fast_dumps(obj)
+        if encoded is None:
+            encoded = super().dumps(obj, separators=COMPACT_SEPARATORS).encode()
+        return encoded
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            with serialization_timer():
+                return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        with serialization_timer():
+            body = self.dumpb(obj) + b'\n'
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def row_dicts(rows, keys):
+    """
+    Turns column tuples into the dicts serialize() would build. Extra
+    trailing columns (used for cursors) are dropped by zip.
+    """
+    return [dict(zip(keys, row)) for row in rows]
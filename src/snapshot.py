@@ -0,0 +1,352 @@
+"""
+Snapshots of the whole database (users, logins, planets, characters,
+starships and favorites) in a compact columnar file, to move the catalog
+between environments much faster than a SQL dump.
+
+Format, all integers little endian:
+
+    b'SWAPISNAP' + version byte (1)
+    per table, in foreign key order:
+        b'T' + u32 length + JSON header {"table": name, "columns": [[name, kind], ...]}
+        per chunk of up to chunk_size rows:
+            b'C' + u32 row count
+            per column: u32 length + zlib compressed column block
+    b'E'
+
+A column block is one presence byte per row (0 for NULL) followed by the
+values of the rows that are not NULL:
+
+    int   int64 each
+    bool  one byte each
+    str   u32 length in characters each, then all of them as one UTF-8 string
+
+Tables are read with streamed queries and written back chunk by chunk, so
+memory stays bounded by the chunk size on both sides.
+"""
+import json
+import logging
+import struct
+import sys
+import zlib
+from array import array
+from io import StringIO
+from itertools import accumulate
+from sqlalchemy import Boolean, Integer, String, select, text
+from sqlalchemy.exc import DBAPIError
+from models import db, table_change_listeners, Change, ChangeCursor, TableChange, UserFavorites
+from search import SEARCHABLE
+from changes import TRACKED, reset_change_log
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'SWAPISNAP'
+VERSION = 1
+DEFAULT_CHUNK_SIZE = 50000
+COMPRESSION_LEVEL = 6
+U32 = struct.Struct('<I')
+BIG_ENDIAN = sys.byteorder == 'big'
+
+
+# tables computed from the others
+DERIVED_TABLES = (TableChange.__table__, Change.__table__, ChangeCursor.__table__, UserFavorites.__table__)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def snapshot_tables():
+    # parents before children. The change dates are recorded anew by the
+    # restore, the change log starts over and the favorites documents are
+    # dropped, until `flask rebuild-favorite-documents`.
+    return [table for table in db.metadata.sorted_tables if table not in DERIVED_TABLES]
+
+
+def column_kind(column):
+    if isinstance(column.type, Boolean):
+        return 'bool'
+    if isinstance(column.type, Integer):
+        return 'int'
+    if isinstance(column.type, String):
+        return 'str'
+    raise SnapshotError(f'cannot snapshot column {column.table.name}.{column.name} of type {column.type}')
+
+
+def _little_endian(values):
+    if BIG_ENDIAN:
+        values.byteswap()
+    return values
+
+
+def encode_column(kind, values):
+    present = bytes(value is not None for value in values)
+    values = [value for value in values if value is not None]
+    if kind == 'int':
+        body = _little_endian(array('q', values)).tobytes()
+    elif kind == 'bool':
+        body = bytes(values)
+    else:
+        body = _little_endian(array('I', map(len, values))).tobytes() + ''.join(values).encode()
+    return zlib.compress(present + body, COMPRESSION_LEVEL)
+
+
+def decode_column(kind, block, rows):
+    data = zlib.decompress(block)
+    present, body = data[:rows], data[rows:]
+    count = sum(present)
+    if kind == 'int':
+        values = array('q')
+        values.frombytes(body)
+        values = _little_endian(values)
+    elif kind == 'bool':
+        values = [bool(value) for value in body]
+    else:
+        lengths = array('I')
+        lengths.frombytes(body[:4 * count])
+        lengths = _little_endian(lengths)
+        strings = str(body[4 * count:], 'utf-8')
+        ends = list(accumulate(lengths))
+        values = [strings[start:end] for start, end in zip([0] + ends, ends)]
+    if count == rows:
+        return list(values)
+    values = iter(values)
+    return [next(values) if flag else None for flag in present]
+
+
+def _write_block(stream, data):
+    stream.write(U32.pack(len(data)))
+    stream.write(data)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SnapshotError('truncated snapshot')
+    return data
+
+
+def _read_block(stream):
+    return _read_exactly(stream, U32.unpack(_read_exactly(stream, 4))[0])
+
+
+def export_snapshot(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Writes every table to the binary stream and returns the number of rows
+    of each.
+    """
+    counts = {}
+    stream.write(MAGIC + bytes([VERSION]))
+    with db.engine.connect() as connection:
+        for table in snapshot_tables():
+            columns = list(table.columns)
+            kinds = [column_kind(column) for column in columns]
+            header = {'table': table.name, 'columns': [[column.name, kind] for column, kind in zip(columns, kinds)]}
+            stream.write(b'T')
+            _write_block(stream, json.dumps(header).encode())
+            counts[table.name] = 0
+            result = connection.execution_options(yield_per=chunk_size).execute(
+                select(*columns).order_by(*table.primary_key.columns))
+            for rows in result.partitions():
+                stream.write(b'C' + U32.pack(len(rows)))
+                for kind, values in zip(kinds, zip(*rows)):
+                    _write_block(stream, encode_column(kind, values))
+                counts[table.name] += len(rows)
+    stream.write(b'E')
+    return counts
+
+
+def read_snapshot(stream):
+    """
+    Yields (table header, rows as tuples) per chunk of the snapshot, and
+    (table header, []) for empty tables.
+    """
+    if _read_exactly(stream, len(MAGIC) + 1) != MAGIC + bytes([VERSION]):
+        raise SnapshotError('not a snapshot, or written by another version')
+    header = None
+    while True:
+        marker = _read_exactly(stream, 1)
+        if marker in (b'T', b'E') and header is not None and not header['chunks']:
+            yield header, []
+        if marker == b'E':
+            return
+        if marker == b'T':
+            header = json.loads(_read_block(stream))
+            header['chunks'] = 0
+        elif marker == b'C' and header is not None:
+            rows = U32.unpack(_read_exactly(stream, 4))[0]
+            columns = [decode_column(kind, _read_block(stream), rows) for _, kind in header['columns']]
+            header['chunks'] += 1
+            yield header, list(zip(*columns))
+        else:
+            raise SnapshotError(f'unexpected {marker!r} in snapshot')
+
+
+def _check_columns(tables, header):
+    table = tables.get(header['table'])
+    if table is None:
+        raise SnapshotError(f"unknown table {header['table']}")
+    names = [name for name, _ in header['columns']]
+    unknown = [name for name in names if name not in table.columns]
+    if unknown:
+        raise SnapshotError(f"unknown columns in {table.name}: {', '.join(unknown)}")
+    return table, names
+
+
+def _disable_constraints(connection):
+    dialect = connection.dialect.name
+    if dialect == 'sqlite':
+        # only takes effect outside of a transaction, so before any write
+        connection.exec_driver_sql('PRAGMA foreign_keys=OFF')
+        # sqlite3 only opens transactions for DML on its own, the index drops
+        # must roll back too
+        connection.exec_driver_sql('BEGIN')
+    elif dialect == 'postgresql':
+        # skips the foreign key triggers, but needs a superuser: the
+        # foreign key order of the tables is enough without it
+        try:
+            with connection.begin_nested():
+                connection.exec_driver_sql('SET LOCAL session_replication_role = replica')
+        except DBAPIError:
+            logger.warning('session_replication_role needs a superuser, the foreign keys are checked row by row')
+        # the change log starts over after the restore, what the table owner
+        # may do whatever the role. Enabled again in the same transaction.
+        for table in TRACKED:
+            connection.exec_driver_sql(f'ALTER TABLE {table} DISABLE TRIGGER {table}_changes')
+
+
+def _enable_change_log_triggers(connection):
+    if connection.dialect.name == 'postgresql':
+        for table in TRACKED:
+            connection.exec_driver_sql(f'ALTER TABLE {table} ENABLE TRIGGER {table}_changes')
+
+
+def _enable_constraints(connection):
+    if connection.dialect.name == 'sqlite':
+        connection.exec_driver_sql('PRAGMA foreign_keys=ON')
+
+
+def _drop_indexes(connection, tables):
+    """
+    SQLite updates the indexes and the search index triggers row by row:
+    drops them for the restore and returns what recreates them. Other
+    databases keep theirs.
+    """
+    if connection.dialect.name != 'sqlite':
+        return []
+    names = ', '.join(f"'{table.name}'" for table in tables)
+    schema = connection.exec_driver_sql(
+        f"SELECT type, name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') "
+        f"AND sql IS NOT NULL AND tbl_name IN ({names})").all()
+    for type_, name, _ in schema:
+        connection.exec_driver_sql(f'DROP {type_.upper()} {name}')
+    return [sql for _, _, sql in schema]
+
+
+def _recreate_indexes(connection, schema):
+    for sql in schema:
+        connection.exec_driver_sql(sql)
+    if schema:
+        for table in SEARCHABLE.values():
+            connection.exec_driver_sql(f"INSERT INTO {table.name}_search({table.name}_search) VALUES ('rebuild')")
+
+
+def _clear_tables(connection, tables):
+    if connection.dialect.name == 'postgresql':
+        connection.exec_driver_sql(f"TRUNCATE {', '.join(table.name for table in tables)} RESTART IDENTITY")
+        return
+    for table in reversed(tables):
+        connection.execute(table.delete())
+
+
+def _copy_rows(connection, table, names, rows):
+    """
+    COPY FROM STDIN on psycopg2, a lot faster than INSERTs. Returns False on
+    other drivers.
+    """
+    if connection.dialect.driver != 'psycopg2':
+        return False
+
+    def field(value):
+        if value is None:
+            return '\\N'
+        if isinstance(value, bool):
+            return 't' if value else 'f'
+        if isinstance(value, int):
+            return str(value)
+        return (value.replace('\\', '\\\\').replace('\t', '\\t')
+                .replace('\n', '\\n').replace('\r', '\\r'))
+
+    buffer = StringIO(''.join('\t'.join(map(field, row)) + '\n' for row in rows))
+    with connection.connection.driver_connection.cursor() as cursor:
+        cursor.copy_expert(f"COPY {table.name} ({', '.join(names)}) FROM STDIN", buffer)
+    return True
+
+
+def _insert_rows(connection, table, names, rows):
+    if _copy_rows(connection, table, names, rows):
+        return
+    if not connection.dialect.positional:
+        connection.execute(table.insert(), [dict(zip(names, row)) for row in rows])
+        return
+    statement = table.insert().compile(dialect=connection.dialect, column_keys=names)
+    # straight to executemany(), the rows are already in the types of the columns
+    if list(statement.positiontup) != names:
+        positions = [names.index(name) for name in statement.positiontup]
+        rows = [tuple(row[position] for position in positions) for row in rows]
+    connection.exec_driver_sql(str(statement), rows)
+
+
+def _reset_sequences(connection, tables):
+    if connection.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if 'id' in table.columns and table.columns['id'].primary_key:
+            connection.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), coalesce(max(id), 1), "
+                f"max(id) IS NOT NULL) FROM {table.name}"))
+
+
+def _check_foreign_keys(connection):
+    if connection.dialect.name != 'sqlite':
+        return
+    violation = connection.exec_driver_sql('PRAGMA foreign_key_check').first()
+    if violation is not None:
+        raise SnapshotError(f'row {violation[1]} of {violation[0]} references a missing {violation[2]} row')
+
+
+def restore_snapshot(stream):
+    """
+    Replaces the content of every table with the snapshot, in one
+    transaction, and returns the number of rows restored per table.
+    Foreign keys are checked once at the end rather than row by row where
+    the database allows it.
+    """
+    tables = snapshot_tables()
+    by_name = {table.name: table for table in tables}
+    counts = {}
+    with db.engine.connect() as connection:
+        _disable_constraints(connection)
+        try:
+            schema = _drop_indexes(connection, tables)
+            # the documents reference the users
+            _clear_tables(connection, tables + [UserFavorites.__table__])
+            for header, rows in read_snapshot(stream):
+                table, names = _check_columns(by_name, header)
+                counts[table.name] = counts.get(table.name, 0) + len(rows)
+                if rows:
+                    _insert_rows(connection, table, names, rows)
+            _recreate_indexes(connection, schema)
+            _reset_sequences(connection, tables)
+            _check_foreign_keys(connection)
+            _enable_change_log_triggers(connection)
+            reset_change_log(connection)
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            _enable_constraints(connection)
+            connection.commit()
+    for listener in table_change_listeners:
+        listener({table.name for table in tables})
+    return counts
@@ -0,0 +1,325 @@
+"""
+Read model of GET /users/<id>/favorites: the encoded body of every user's
+favorites, one row per user in the user_favorites table, served with a
+single primary key lookup instead of joining the favorites with the items.
+Turned on by FAVORITES_READ_MODEL=1.
+
+- the favorite routes patch the document of their user in their own
+  transaction (add_to_document, remove_from_document, rebuild_document),
+  so a user reads their own writes
+- everything else (items edited in the admin, favorites changed outside of
+  the routes) is caught up on by refresh_documents(), which follows the
+  change log (see changes.py) from a cursor shared by every process, after
+  the commits of the tracked tables, and rebuilds the documents of the users
+  whose favorites or favorited items changed. On PostgreSQL a change held
+  back by a running transaction is caught up on by the next refresh.
+- users without a document (never built, or dropped by a snapshot restore)
+  are served by the regular query, `flask rebuild-favorite-documents`
+  builds them all and `flask check-favorite-documents` compares them with
+  the favorites table
+
+Documents are encoded compactly; in debug mode the route serves the regular
+query, whose JSON is indented.
+"""
+import bisect
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+from flask import current_app
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session, joinedload
+from changes import TRACKED, log_end, log_horizon, read_changes
+from favorites import UPSERT_DIALECTS
+from models import db, on_tables_changed, ChangeCursor, Favorite, User, UserFavorites
+
+logger = logging.getLogger(__name__)
+
+FAVORITES_READ_MODEL = os.getenv('FAVORITES_READ_MODEL', '') in ('1', 'true', 'yes')
+# users per query when building documents
+BUILD_BATCH_SIZE = 500
+# changes read per query when catching up
+REFRESH_BATCH_SIZE = 5000
+CURSOR_NAME = 'user_favorites'
+# item columns of the favorites table -> type of the item in the change log
+ITEM_COLUMNS = {'character': Favorite.character_id, 'planet': Favorite.planet_id, 'starship': Favorite.starship_id}
+
+
+def _utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def encode_document(favorites):
+    return current_app.json.dumpb({'data': favorites}) + b'\n'
+
+
+def serialized_favorites(session, user_ids):
+    """
+    user id -> serialized favorites of the user, in id order, for the users
+    of `user_ids` that exist.
+    """
+    existing = session.scalars(select(User.id).where(User.id.in_(user_ids)))
+    favorites = {user_id: [] for user_id in existing}
+    rows = session.scalars(select(Favorite).options(
+        joinedload(Favorite.character),
+        joinedload(Favorite.planet),
+        joinedload(Favorite.starship),
+    ).where(Favorite.user_id.in_(list(favorites))).order_by(Favorite.user_id, Favorite.id))
+    for favorite in rows:
+        favorites[favorite.user_id].append(favorite.serialize())
+    return favorites
+
+
+def rebuild_documents(session, user_ids, existing_only=False):
+    """
+    Builds the documents of `user_ids` again from the favorites table, or
+    only those that exist with `existing_only`. The caller commits.
+    """
+    user_ids = sorted(set(user_ids))
+    for start in range(0, len(user_ids), BUILD_BATCH_SIZE):
+        batch = user_ids[start:start + BUILD_BATCH_SIZE]
+        # deleting first locks the documents, so the patches of the favorite
+        # routes wait for the rebuild instead of being overwritten by it
+        deleted = session.execute(delete(UserFavorites).where(UserFavorites.user_id.in_(batch)).returning(
+            UserFavorites.user_id)).scalars().all()
+        if existing_only:
+            batch = deleted
+        if not batch:
+            continue
+        built_at = _utcnow()
+        documents = [{'user_id': user_id, 'body': encode_document(favorites), 'built_at': built_at}
+                     for user_id, favorites in serialized_favorites(session, batch).items()]
+        if documents:
+            _insert_documents(session, documents)
+
+
+def _insert_documents(session, documents):
+    dialect_insert = UPSERT_DIALECTS.get(session.get_bind().dialect.name)
+    if dialect_insert is None:
+        session.execute(insert(UserFavorites), documents)
+        return
+    # a concurrent transaction can build the same missing document
+    statement = dialect_insert(UserFavorites)
+    session.execute(statement.on_conflict_do_update(index_elements=[UserFavorites.user_id], set_={
+        'body': statement.excluded.body, 'built_at': statement.excluded.built_at}), documents)
+
+
+def _locked_document(session, user_id):
+    return session.execute(select(UserFavorites.body).where(
+        UserFavorites.user_id == user_id).with_for_update()).scalar()
+
+
+def _store_document(session, user_id, favorites):
+    session.execute(update(UserFavorites).where(UserFavorites.user_id == user_id).values(
+        body=encode_document(favorites), built_at=_utcnow()))
+
+
+def add_to_document(session, user_id, favorite_id):
+    """
+    Adds the new favorite `favorite_id` to the document of its user, in the
+    transaction that inserted it.
+    """
+    if not FAVORITES_READ_MODEL:
+        return
+    body = _locked_document(session, user_id)
+    if body is None:
+        rebuild_documents(session, [user_id])
+        return
+    favorite = session.get(Favorite, favorite_id, options=[
+        joinedload(Favorite.character),
+        joinedload(Favorite.planet),
+        joinedload(Favorite.starship),
+    ])
+    favorites = json.loads(body)['data']
+    # ids of concurrent inserts can commit out of order
+    index = bisect.bisect([entry['id'] for entry in favorites], favorite_id)
+    favorites.insert(index, favorite.serialize())
+    _store_document(session, user_id, favorites)
+
+
+def remove_from_document(session, user_id, kind, item_id):
+    """
+    Removes the favorite of the `kind` item `item_id` from the document of
+    the user, in the transaction that deleted it.
+    """
+    if not FAVORITES_READ_MODEL:
+        return
+    body = _locked_document(session, user_id)
+    if body is None:
+        return
+    favorites = [entry for entry in json.loads(body)['data']
+                 if not (entry['type'] == kind and entry['item'] is not None and entry['item']['id'] == item_id)]
+    _store_document(session, user_id, favorites)
+
+
+def rebuild_document(session, user_id):
+    """
+    Builds the document of the user again, in the transaction that changed
+    several of their favorites.
+    """
+    if FAVORITES_READ_MODEL:
+        rebuild_documents(session, [user_id])
+
+
+def document_body(session, user_id):
+    """
+    The stored body of the favorites of `user_id`, None when the read model
+    is off or has no document for the user.
+    """
+    if not FAVORITES_READ_MODEL or current_app.debug:
+        return None
+    return session.execute(select(UserFavorites.body).where(UserFavorites.user_id == user_id)).scalar()
+
+
+def _affected_users(session, rows):
+    users = set()
+    items = {kind: set() for kind in ITEM_COLUMNS}
+    for row in rows:
+        kind = TRACKED[row.table_name]
+        if kind == 'favorite':
+            users.add(row.user_id)
+        else:
+            items[kind].add(row.row_id)
+    for kind, item_ids in items.items():
+        item_ids = sorted(item_ids)
+        for start in range(0, len(item_ids), BUILD_BATCH_SIZE):
+            column = ITEM_COLUMNS[kind]
+            users.update(session.scalars(select(Favorite.user_id).where(
+                column.in_(item_ids[start:start + BUILD_BATCH_SIZE])).distinct()))
+    users.discard(None)
+    return users
+
+
+def refresh_documents(connection):
+    """
+    Rebuilds the documents of the users whose favorites or favorited items
+    changed since the last refresh, from the change log. Returns the number
+    of users whose documents were rebuilt.
+    """
+    with Session(bind=connection) as session:
+        return _refresh_documents(connection, session)
+
+
+def _refresh_documents(connection, session):
+    # taking the cursor row makes the other processes wait for this refresh
+    if session.execute(update(ChangeCursor).where(ChangeCursor.name == CURSOR_NAME).values(
+            name=CURSOR_NAME)).rowcount == 0:
+        # the documents are built by the routes and the rebuild command, the
+        # refreshes start from now
+        txid, change_id = log_end(connection)
+        session.execute(insert(ChangeCursor).values(name=CURSOR_NAME, txid=txid, change_id=change_id))
+        return 0
+    cursor = session.execute(select(ChangeCursor).where(ChangeCursor.name == CURSOR_NAME)).scalar_one()
+    position = (cursor.txid, cursor.change_id)
+    horizon = log_horizon(connection)
+    if horizon is not None and position < horizon:
+        # the changes since the last refresh are gone, rebuild everything
+        position = log_end(connection)
+        users = session.scalars(select(UserFavorites.user_id)).all()
+    else:
+        users = set()
+        while True:
+            rows, position = read_changes(connection, position, REFRESH_BATCH_SIZE, tables=sorted(TRACKED))
+            users |= _affected_users(session, rows)
+            if len(rows) < REFRESH_BATCH_SIZE:
+                break
+    rebuild_documents(session, users, existing_only=True)
+    session.execute(update(ChangeCursor).where(ChangeCursor.name == CURSOR_NAME).values(
+        txid=position[0], change_id=position[1]))
+    session.flush()
+    return len(users)
+
+
+def check_documents(session):
+    """
+    Compares every document with the favorites table. Returns the ids of the
+    users whose document is stale, and the number of users without one.
+    """
+    stale = []
+    missing = 0
+    last_id = 0
+    while True:
+        user_ids = session.scalars(select(User.id).where(User.id > last_id).order_by(User.id)
+                                   .limit(BUILD_BATCH_SIZE)).all()
+        if not user_ids:
+            break
+        last_id = user_ids[-1]
+        stored = dict(session.execute(select(UserFavorites.user_id, UserFavorites.body).where(
+            UserFavorites.user_id.in_(user_ids))).all())
+        for user_id, favorites in serialized_favorites(session, user_ids).items():
+            if user_id not in stored:
+                missing += 1
+            elif stored[user_id] != encode_document(favorites):
+                stale.append(user_id)
+    return stale, missing
+
+
+def rebuild_all_documents(session):
+    """
+    Builds the document of every user, in batches the caller commits as they
+    come. Yields the number of users done so far.
+    """
+    done = 0
+    last_id = 0
+    while True:
+        user_ids = session.scalars(select(User.id).where(User.id > last_id).order_by(User.id)
+                                   .limit(BUILD_BATCH_SIZE)).all()
+        if not user_ids:
+            return
+        last_id = user_ids[-1]
+        rebuild_documents(session, user_ids)
+        done += len(user_ids)
+        yield done
+
+
+class DocumentRefresher:
+    """
+    Runs refresh_documents() on a thread of its own after a commit to a
+    tracked table, one at a time per process: a commit during a refresh
+    makes it run again once it is done.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.rebuilt = 0
+        self.failures = 0
+        self._pending = False
+        self._running = False
+        self._lock = threading.Lock()
+
+    def request(self, app):
+        with self._lock:
+            if self._running:
+                self._pending = True
+                return
+            self._running = True
+        threading.Thread(target=self.run, args=(app,), daemon=True).start()
+
+    def run(self, app):
+        while True:
+            try:
+                with app.app_context(), db.engine.begin() as connection:
+                    self.rebuilt += refresh_documents(connection)
+                self.runs += 1
+            except Exception:
+                self.failures += 1
+                logger.warning('could not refresh the favorites documents', exc_info=True)
+            with self._lock:
+                if not self._pending:
+                    self._running = False
+                    return
+                self._pending = False
+
+    def stats(self):
+        return {'enabled': int(FAVORITES_READ_MODEL), 'runs': self.runs, 'rebuilt': self.rebuilt,
+                'failures': self.failures}
+
+
+refresher = DocumentRefresher()
+
+
+@on_tables_changed
+def refresh_after_commit(tables):
+    if FAVORITES_READ_MODEL and not set(tables).isdisjoint(TRACKED):
+        refresher.request(current_app._get_current_object())
@@ -0,0 +1,79 @@
+"""
+Versions of the tables shared by every process: the version column of
+table_changes, bumped after every commit that writes a table (see
+record_table_changes in models.py).
+
+The versions are read again at most every VERSION_POLL_SECONDS, so a write
+committed by another process (gunicorn worker, CLI command, admin) is seen
+within that time, and right after the commits of this process. The caches
+that compare versions (cache.py, precompiled.py) are never stale for longer.
+"""
+import logging
+import os
+import threading
+import time
+from datetime import timezone
+from sqlalchemy import select
+from models import db, on_tables_changed, TableChange
+
+logger = logging.getLogger(__name__)
+
+VERSION_POLL_SECONDS = float(os.getenv('VERSION_POLL_SECONDS', 1))
+
+
+class TableVersions:
+    def __init__(self, poll_seconds=VERSION_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.reads = 0
+        self.errors = 0
+        # table -> (version, changed_at timestamp)
+        self._versions = {}
+        self._read_at = None
+        self._lock = threading.Lock()
+
+    def _current(self):
+        with self._lock:
+            if self._read_at is not None and time.monotonic() - self._read_at < self.poll_seconds:
+                return self._versions
+            try:
+                # always from the primary, a replica may not have the bumps yet
+                with db.engine.connect() as connection:
+                    rows = connection.execute(select(
+                        TableChange.table_name, TableChange.version, TableChange.changed_at)).all()
+            except Exception:
+                self.errors += 1
+                logger.warning('could not read the table versions', exc_info=True)
+                return None
+            self.reads += 1
+            self._versions = {name: (version, changed_at.replace(tzinfo=timezone.utc).timestamp())
+                              for name, version, changed_at in rows}
+            self._read_at = time.monotonic()
+            return self._versions
+
+    def version(self, table):
+        """
+        The version of `table`, None when it can't be read.
+        """
+        versions = self._current()
+        if versions is None:
+            return None
+        return versions.get(table, (0, 0.0))[0]
+
+    def changed_at(self, table):
+        versions = self._current()
+        if versions is None:
+            # assume a recent write
+            return time.time()
+        return versions.get(table, (0, 0.0))[1]
+
+    def expire(self, tables=None):
+        with self._lock:
+            self._read_at = None
+
+    def stats(self):
+        return {'reads': self.reads, 'errors': self.errors, 'poll_seconds': self.poll_seconds}
+
+
+table_versions = TableVersions()
+# runs after record_table_changes(), registered first: the next read sees the bumps
+on_tables_changed(table_versions.expire)
@@ -0,0 +1,37 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from app import create_app  # noqa: E402
+from cache import response_cache  # noqa: E402
+from models import db  # noqa: E402
+from precompiled import precompiled_lists  # noqa: E402
+from versions import table_versions  # noqa: E402
+
+
+def forget_process_state():
+    # every test starts from an empty database, the versions start over
+    response_cache.backend.clear()
+    table_versions.expire()
+    for precompiled in precompiled_lists.values():
+        precompiled.changed(None)
+
+
+@pytest.fixture
+def app():
+    app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'})
+    with app.app_context():
+        db.create_all()
+    forget_process_state()
+    # the requests of the tests run in app contexts of their own, with empty sessions
+    yield app
+    with app.app_context():
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
@@ -0,0 +1,69 @@
+import pytest
+from admission import admission, POLICIES, RedisBackend
+from models import db, Planet
+
+
+@pytest.fixture
+def planets(app):
+    with app.app_context():
+        db.session.add(Planet(name='Hoth', climate='frozen', terrain='tundra', description=''))
+        db.session.commit()
+
+
+def test_empty_bucket_gets_429(app, client, planets, monkeypatch):
+    monkeypatch.setattr(admission, 'rate', 0.01)
+    monkeypatch.setattr(admission, 'burst', 5)
+    shed = admission.stats().get('get_planets_shed_rate', 0)
+    # a page costs 2 tokens
+    assert client.get('/planets?limit=10').status_code == 200
+    assert client.get('/planets?limit=10').status_code == 200
+    response = client.get('/planets?limit=10')
+    assert response.status_code == 429
+    assert int(response.headers['Retry-After']) >= 1
+    # the probes are exempt
+    assert client.get('/healthz').status_code == 200
+    assert admission.stats()['get_planets_shed_rate'] == shed + 1
+
+
+def test_full_list_running_queries_is_charged_after_the_request(app, client, planets, monkeypatch):
+    monkeypatch.setattr(admission, 'rate', 0.01)
+    monkeypatch.setattr(admission, 'burst', 21)
+    # 2 tokens before, the other 18 of unbounded_cost once it ran SQL
+    assert client.get('/planets?sort=name').status_code == 200
+    assert client.get('/planets?sort=name').status_code == 429
+
+
+@pytest.fixture
+def shared_slots(app, monkeypatch):
+    fakeredis = pytest.importorskip('fakeredis')
+    monkeypatch.setattr(admission, 'backend', RedisBackend(fakeredis.FakeStrictRedis()))
+    monkeypatch.setattr(admission, 'limit_concurrency', True)
+    # the slots of the other workers
+    limit = POLICIES['get_planets'].concurrency
+    return [admission.backend.acquire('get_planets', limit) for _ in range(limit)]
+
+
+def test_full_queue_gets_503(app, client, planets, shared_slots, monkeypatch):
+    monkeypatch.setattr(admission, 'queue_size', 0)
+    response = client.get('/planets?limit=10')
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+    assert client.get('/planets/1').status_code == 200
+
+
+def test_queued_request_gets_503_at_the_deadline_or_a_freed_slot(app, client, planets, shared_slots, monkeypatch):
+    monkeypatch.setattr(admission, 'queue_timeout', 0.05)
+    shed = admission.stats().get('get_planets_shed_timeout', 0)
+    assert client.get('/planets?limit=10').status_code == 503
+    assert admission.stats()['get_planets_shed_timeout'] == shed + 1
+    admission.backend.release('get_planets', shared_slots.pop())
+    assert client.get('/planets?limit=10').status_code == 200
+
+
+def test_slots_of_the_memory_backend_are_not_limited(app, client, planets, monkeypatch):
+    assert admission.backend.name == 'memory' and not admission.limit_concurrency
+    limit = POLICIES['get_planets'].concurrency
+    for _ in range(limit):
+        admission.backend.acquire('get_planets', limit)
+    monkeypatch.setattr(admission, 'queue_size', 0)
+    assert client.get('/planets?limit=10').status_code == 200
@@ -0,0 +1,43 @@
+import asyncio
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+asgi = pytest.importorskip('asgi', exc_type=ImportError)
+
+
+def failed_insert(user_id, kind, item_id):
+    async def insert():
+        raise IntegrityError('INSERT INTO favorite', {}, Exception('FOREIGN KEY constraint failed'))
+    return insert()
+
+
+def lookups(monkeypatch, user_exists, items):
+    async def _user_exists(user_id):
+        return user_exists
+
+    async def _get_item(model, item_id):
+        return items.pop(0)
+
+    monkeypatch.setattr(asgi, '_insert_favorite', failed_insert)
+    monkeypatch.setattr(asgi, '_user_exists', _user_exists)
+    monkeypatch.setattr(asgi, '_get_item', _get_item)
+
+
+def favorite_created():
+    return asyncio.run(asgi.favorite_created('planet', 1, 1, 'Planet not found', 'Favorite planet added'))
+
+
+def test_failed_insert_of_a_missing_user(monkeypatch):
+    lookups(monkeypatch, False, [object(), object()])
+    assert favorite_created() == ({'msg': 'User not found'}, 404)
+
+
+def test_failed_insert_of_an_item_deleted_after_it_was_loaded(monkeypatch):
+    lookups(monkeypatch, True, [object(), None])
+    assert favorite_created() == ({'msg': 'Planet not found'}, 404)
+
+
+def test_failed_insert_when_user_and_item_exist(monkeypatch):
+    lookups(monkeypatch, True, [object(), object()])
+    assert favorite_created() == ({'msg': 'Favorite already exists'}, 409)
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy import update
+from cache import MemoryBackend, RedisBackend, response_cache
+from models import db, Planet, TableChange
+from versions import table_versions
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request, app):
+    if request.param == 'memory':
+        backend = MemoryBackend()
+    else:
+        fakeredis = pytest.importorskip('fakeredis')
+        backend = RedisBackend('redis://', client=fakeredis.FakeRedis())
+    previous, response_cache.backend = response_cache.backend, backend
+    yield backend
+    response_cache.backend = previous
+
+
+def add_planet(app, name):
+    with app.app_context():
+        planet = Planet(name=name, climate='arid', terrain='desert', description='')
+        db.session.add(planet)
+        db.session.commit()
+        return planet.id
+
+
+def rename_planet(app, planet_id, name):
+    with app.app_context():
+        db.session.get(Planet, planet_id).name = name
+        db.session.commit()
+
+
+def test_write_invalidates_cached_response(app, client, backend):
+    planet_id = add_planet(app, 'Tatooine')
+    assert client.get(f'/planets/{planet_id}').get_json()['data']['name'] == 'Tatooine'
+    hits = response_cache.hits
+    assert client.get(f'/planets/{planet_id}').get_json()['data']['name'] == 'Tatooine'
+    assert response_cache.hits == hits + 1
+    hits = response_cache.hits
+
+    rename_planet(app, planet_id, 'Jakku')
+
+    assert client.get(f'/planets/{planet_id}').get_json()['data']['name'] == 'Jakku'
+    assert response_cache.hits == hits
+
+
+def test_matching_etag_gets_304(app, client, backend):
+    planet_id = add_planet(app, 'Tatooine')
+    response = client.get(f'/planets/{planet_id}')
+    etag = response.headers['ETag']
+
+    cached = client.get(f'/planets/{planet_id}', headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+    assert cached.data == b''
+
+    rename_planet(app, planet_id, 'Jakku')
+    changed = client.get(f'/planets/{planet_id}', headers={'If-None-Match': etag})
+    assert changed.status_code == 200
+    assert changed.headers['ETag'] != etag
+
+
+def test_write_of_another_process_reaches_memory_cache(app, client, monkeypatch):
+    monkeypatch.setattr(table_versions, 'poll_seconds', 0)
+    planet_id = add_planet(app, 'Tatooine')
+    assert client.get(f'/planets/{planet_id}').get_json()['data']['name'] == 'Tatooine'
+
+    # what another worker does: write, then bump the version in the database,
+    # without the listeners of this process knowing
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(update(Planet).where(Planet.id == planet_id).values(name='Jakku'))
+            connection.execute(update(TableChange).where(TableChange.table_name == 'planets').values(
+                version=TableChange.version + 1))
+
+    assert client.get(f'/planets/{planet_id}').get_json()['data']['name'] == 'Jakku'
@@ -0,0 +1,74 @@
+from datetime import datetime, timedelta, timezone
+from changes import compact_changes, expire_changes
+from models import db, Planet, Starship
+
+
+def add_planet(app, name):
+    with app.app_context():
+        planet = Planet(name=name, climate='', terrain='', description='')
+        db.session.add(planet)
+        db.session.commit()
+        return planet.id
+
+
+def feed(client, path):
+    response = client.get(path)
+    assert response.status_code == 200
+    body = response.get_json()
+    assert response.headers['Link'] == f'<{body["next"]}>; rel="next"'
+    return [(change['type'], change['id'], change['op']) for change in body['data']], body['next']
+
+
+def test_cursor_returns_each_change_once(app, client):
+    add_planet(app, 'Hoth')
+    # without since, the feed starts at the end of the log
+    changes, next_page = feed(client, '/changes')
+    assert changes == []
+
+    dagobah = add_planet(app, 'Dagobah')
+    with app.app_context():
+        db.session.get(Planet, dagobah).climate = 'murky'
+        db.session.add(Starship(name='X-wing', model='', manufacturer='', description=''))
+        db.session.commit()
+    changes, next_page = feed(client, next_page + '&limit=2')
+    assert changes == [('planet', dagobah, 'insert'), ('planet', dagobah, 'update')]
+    changes, next_page = feed(client, next_page)
+    assert changes == [('starship', 1, 'insert')]
+    assert feed(client, next_page) == ([], next_page)
+
+
+def test_type_filter(app, client):
+    _, start = feed(client, '/changes?type=starship')
+    add_planet(app, 'Hoth')
+    with app.app_context():
+        db.session.add(Starship(name='X-wing', model='', manufacturer='', description=''))
+        db.session.commit()
+    assert feed(client, start)[0] == [('starship', 1, 'insert')]
+    assert client.get('/changes?type=droid').status_code == 400
+
+
+def test_compacted_changes_keep_the_latest_one(app, client):
+    _, start = feed(client, '/changes')
+    hoth = add_planet(app, 'Hoth')
+    with app.app_context():
+        db.session.get(Planet, hoth).climate = 'frozen'
+        db.session.commit()
+        with db.engine.begin() as connection:
+            assert compact_changes(connection)[0] == 1
+    assert feed(client, start)[0] == [('planet', hoth, 'update')]
+
+
+def test_cursor_before_the_horizon_gets_410(app, client):
+    add_planet(app, 'Hoth')
+    _, old = feed(client, '/changes')
+    add_planet(app, 'Dagobah')
+    _, current = feed(client, old)
+    with app.app_context(), db.engine.begin() as connection:
+        assert expire_changes(connection, now=datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(days=30)) > 0
+
+    response = client.get(old)
+    assert response.status_code == 410
+    assert response.get_json()['message'] == 'since is older than the change log, reload the lists'
+    # a cursor at the horizon still reads on
+    assert feed(client, current)[0] == []
+    assert client.get('/changes?since=bad').status_code == 400
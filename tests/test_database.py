@@ -0,0 +1,43 @@
+import threading
+from sqlalchemy import create_engine
+import database
+from database import pool_status, track_pool, TimedQueuePool
+
+
+def test_each_pool_counts_its_own_connections(tmp_path, monkeypatch):
+    monkeypatch.setattr(database, 'tracked_pools', {})
+    first = create_engine(f'sqlite:///{tmp_path}/first.db', poolclass=TimedQueuePool, pool_size=2, max_overflow=0)
+    second = create_engine(f'sqlite:///{tmp_path}/second.db', poolclass=TimedQueuePool, pool_size=2, max_overflow=0)
+    first_stats = track_pool(first, 'first')
+    track_pool(second, 'second')
+
+    def check_out(times):
+        for _ in range(times):
+            with first.connect():
+                pass
+
+    threads = [threading.Thread(target=check_out, args=(200,)) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with second.connect():
+        status = pool_status()
+        assert (status['first']['checkouts'], status['first']['checked_out']) == (800, 0)
+        assert (status['second']['checkouts'], status['second']['checked_out']) == (1, 1)
+    assert status['first']['connects'] <= 2 and status['first']['size'] == 2
+
+    # dispose() replaces the pool, the stats go on
+    first.dispose()
+    with first.connect():
+        pass
+    assert first.pool.stats is first_stats
+    assert pool_status()['first']['checkouts'] == 801
+
+
+def test_pools_are_labelled_in_the_metrics(app, client):
+    body = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE db_pool_checkouts_total counter' in body
+    assert body.count('# TYPE db_pool_checkouts_total counter') == 1
+    assert 'db_pool_checkouts_total{pool="primary"} ' in body
+    assert 'db_pool_checked_out{pool="primary"} ' in body
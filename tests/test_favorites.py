@@ -0,0 +1,97 @@
+from sqlalchemy import event
+from models import db, Character, Favorite, Planet, Starship, User
+
+
+def count_statements(app, client, path):
+    statements = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements)
+
+
+def add_user(name):
+    user = User(name=name, email=f'{name}@example.com', password='secret', is_active=True)
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def add_favorites(user, count):
+    for number in range(count):
+        planet = Planet(name=f'{user.name} planet {number}', climate='arid', terrain='desert', description='')
+        starship = Starship(name=f'{user.name} starship {number}', model='', manufacturer='', description='')
+        character = Character(name=f'{user.name} character {number}', height=170, description='', planet=planet)
+        db.session.add_all([planet, starship, character])
+        db.session.flush()
+        db.session.add_all([
+            Favorite(user_id=user.id, planet_id=planet.id),
+            Favorite(user_id=user.id, starship_id=starship.id),
+            Favorite(user_id=user.id, character_id=character.id),
+        ])
+    db.session.commit()
+
+
+def test_user_favorites_query_count_does_not_grow_with_favorites(app, client):
+    with app.app_context():
+        one = add_user('one')
+        many = add_user('many')
+        add_favorites(one, 1)
+        add_favorites(many, 10)
+        one_id, many_id = one.id, many.id
+
+    assert len(client.get(f'/users/{many_id}/favorites').get_json()['data']) == 30
+    assert count_statements(app, client, f'/users/{one_id}/favorites') == \
+        count_statements(app, client, f'/users/{many_id}/favorites')
+
+
+def test_adding_a_favorite_twice_conflicts(app, client):
+    with app.app_context():
+        user = add_user('leia')
+        planet = Planet(name='Alderaan', climate='temperate', terrain='grasslands', description='')
+        db.session.add(planet)
+        db.session.commit()
+        user_id, planet_id = user.id, planet.id
+
+    response = client.post(f'/favorite/planet/{planet_id}/user/{user_id}')
+    assert response.status_code == 201
+    assert response.get_json()['data']['item']['name'] == 'Alderaan'
+    response = client.post(f'/favorite/planet/{planet_id}/user/{user_id}')
+    assert response.status_code == 409
+    assert response.get_json()['msg'] == 'Favorite already exists'
+    with app.app_context():
+        assert Favorite.query.count() == 1
+        assert db.session.get(Planet, planet_id).favorites_count == 1
+
+
+def test_favorite_of_missing_user_or_item(app, client):
+    with app.app_context():
+        user = add_user('han')
+        planet = Planet(name='Corellia', climate='temperate', terrain='plains', description='')
+        db.session.add(planet)
+        db.session.commit()
+        user_id, planet_id = user.id, planet.id
+
+    response = client.post(f'/favorite/planet/{planet_id}/user/{user_id + 1}')
+    assert (response.status_code, response.get_json()['msg']) == (404, 'User not found')
+    response = client.post(f'/favorite/planet/{planet_id + 1}/user/{user_id}')
+    assert (response.status_code, response.get_json()['msg']) == (404, 'Planet not found')
+    response = client.post(f'/favorite/people/1/user/{user_id}')
+    assert (response.status_code, response.get_json()['msg']) == (404, 'Character not found')
+    response = client.delete(f'/favorite/planet/{planet_id}/user/{user_id}')
+    assert (response.status_code, response.get_json()['msg']) == (404, 'Favorite not found')
+
+    assert client.post(f'/favorite/planet/{planet_id}/user/{user_id}').status_code == 201
+    assert client.delete(f'/favorite/planet/{planet_id}/user/{user_id}').status_code == 200
+    with app.app_context():
+        assert Favorite.query.count() == 0
+        assert db.session.get(Planet, planet_id).favorites_count == 0
@@ -0,0 +1,73 @@
+from sqlalchemy import delete
+import favorites
+from favorites import MAX_BATCH_SIZE
+from models import db, Favorite, Planet, Starship, User
+
+
+def add_catalog(app):
+    with app.app_context():
+        user = User(name='Leia', email='leia@example.com', password='secret', is_active=True)
+        planets = [Planet(name=name, climate='', terrain='', description='') for name in ('Alderaan', 'Hoth', 'Endor')]
+        starship = Starship(name='Tantive IV', model='', manufacturer='', description='')
+        db.session.add_all([user, starship, *planets])
+        db.session.commit()
+        return user.id, [planet.id for planet in planets], starship.id
+
+
+def favorite_counts(app, model):
+    with app.app_context():
+        return {item.id: item.favorites_count for item in model.query}
+
+
+def test_batch_reports_every_entry(app, client):
+    user_id, (alderaan, hoth, endor), starship = add_catalog(app)
+    client.post(f'/favorite/planet/{hoth}/user/{user_id}')
+
+    response = client.post(f'/users/{user_id}/favorites/batch', json={'items': [
+        {'op': 'add', 'type': 'planet', 'id': alderaan},
+        {'op': 'add', 'type': 'planet', 'id': alderaan},
+        {'op': 'remove', 'type': 'planet', 'id': hoth},
+        {'op': 'remove', 'type': 'planet', 'id': endor},
+        {'op': 'add', 'type': 'starship', 'id': starship},
+        {'op': 'add', 'type': 'people', 'id': 999},
+        {'op': 'rename', 'type': 'planet', 'id': endor},
+    ]})
+
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['data']] == [
+        'added', 'exists', 'removed', 'not_favorite', 'added', 'not_found', 'invalid']
+    assert favorite_counts(app, Planet) == {alderaan: 1, hoth: 0, endor: 0}
+    assert favorite_counts(app, Starship) == {starship: 1}
+    with app.app_context():
+        assert {(favorite.planet_id, favorite.starship_id) for favorite in Favorite.query} == {
+            (alderaan, None), (None, starship)}
+
+
+def test_batch_of_unknown_user_or_too_many_items(app, client):
+    user_id, (alderaan, _, _), _ = add_catalog(app)
+    entry = {'op': 'add', 'type': 'planet', 'id': alderaan}
+    assert client.post(f'/users/{user_id + 1}/favorites/batch', json={'items': [entry]}).status_code == 404
+    assert client.post(f'/users/{user_id}/favorites/batch',
+                       json={'items': [entry] * (MAX_BATCH_SIZE + 1)}).status_code == 400
+    assert client.post(f'/users/{user_id}/favorites/batch', json={'entries': []}).status_code == 400
+
+
+def test_item_deleted_during_the_batch_is_not_found(app, client, monkeypatch):
+    user_id, (alderaan, hoth, endor), _ = add_catalog(app)
+    replay = favorites._replay
+
+    def delete_hoth_first(*args):
+        # what a concurrent request does between the lookup of the items and the insert
+        monkeypatch.setattr(favorites, '_replay', replay)
+        db.session.execute(delete(Planet).where(Planet.id == hoth))
+        return replay(*args)
+
+    monkeypatch.setattr(favorites, '_replay', delete_hoth_first)
+    response = client.post(f'/users/{user_id}/favorites/batch', json={'items': [
+        {'op': 'add', 'type': 'planet', 'id': alderaan},
+        {'op': 'add', 'type': 'planet', 'id': hoth},
+    ]})
+
+    assert response.status_code == 200
+    assert [result['status'] for result in response.get_json()['data']] == ['added', 'not_found']
+    assert favorite_counts(app, Planet) == {alderaan: 1, endor: 0}
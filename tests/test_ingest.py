@@ -0,0 +1,54 @@
+import json
+from models import db, Planet
+
+
+def import_ndjson(client, kind, rows, **args):
+    body = '\n'.join(row if isinstance(row, str) else json.dumps(row) for row in rows)
+    return client.post(f'/import/{kind}', data=body, query_string=args,
+                       content_type='application/x-ndjson')
+
+
+def planet(name, **values):
+    return {'name': name, 'climate': 'arid', 'terrain': 'desert', 'description': '', **values}
+
+
+def test_invalid_lines_are_reported_and_the_rest_loaded(app, client):
+    response = import_ndjson(client, 'planets', [
+        planet('Tatooine'),
+        '{"name": ',
+        '["Hoth"]',
+        {'name': 'Hoth'},
+        planet('x' * 31),
+        planet('Endor', id=7),
+        planet('Naboo', favorites_count=3),
+        planet('Kamino', moons=3),
+        planet('Tatooine'),
+        planet('Bespin'),
+    ], batch_size=3)
+
+    assert response.status_code == 200
+    report = response.get_json()
+    assert (report['inserted'], report['failed']) == (2, 8)
+    errors = {error['line']: error['error'] for error in report['errors']}
+    assert errors[2].startswith('invalid JSON')
+    assert errors[3] == 'each line must be a JSON object'
+    assert errors[4] == 'climate is required'
+    assert errors[5] == 'name is longer than 30 characters'
+    assert errors[6] == 'id can not be imported, it is assigned by the database'
+    assert errors[7] == 'favorites_count can not be imported, it is maintained by the API'
+    assert errors[8] == 'unknown columns: moons'
+    # the duplicate name fails its batch, which is retried row by row
+    assert 'UNIQUE' in errors[9]
+    with app.app_context():
+        assert sorted(planet.name for planet in Planet.query) == ['Bespin', 'Tatooine']
+
+
+def test_csv_types_and_unknown_kind(app, client):
+    body = 'name,height,description\nLuke,172,farm boy\nLeia,short,princess\n'
+    response = client.post('/import/people', data=body, content_type='text/csv')
+    report = response.get_json()
+    assert (report['inserted'], report['errors']) == (1, [{'line': 3, 'error': 'height must be an integer'}])
+    assert client.post('/import/droids', data='').status_code == 404
+    assert import_ndjson(client, 'planets', [], format='xml').status_code == 400
+    with app.app_context():
+        assert db.session.query(Planet).count() == 0
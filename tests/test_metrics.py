@@ -0,0 +1,29 @@
+from instrumentation import RouteMetrics
+
+
+def test_counters_of_the_stats_sources():
+    metrics = RouteMetrics()
+    metrics.register_stats('cache', lambda: {'hits': 3, 'size': 7, 'wait_seconds_total': 0.5,
+                                             'planets_rebuilds': 2, 'backend': 'memory', 'enabled': True},
+                           counters=('hits', 'wait_seconds_total', '*_rebuilds'))
+    lines = metrics.render().splitlines()
+    assert lines[-8:] == [
+        '# TYPE cache_hits_total counter', 'cache_hits_total 3',
+        '# TYPE cache_size gauge', 'cache_size 7',
+        '# TYPE cache_wait_seconds_total counter', 'cache_wait_seconds_total 0.5',
+        '# TYPE cache_planets_rebuilds_total counter', 'cache_planets_rebuilds_total 2',
+    ]
+
+
+def test_metrics_endpoint(app, client):
+    client.get('/planets')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    body = response.get_data(as_text=True)
+    # the route metrics are kept by the process, across the tests
+    assert 'http_requests_total{method="GET",route="/planets",status="200"} ' in body
+    assert '# TYPE response_cache_misses_total counter' in body
+    assert '# TYPE db_pool_checked_out gauge' in body
+    # served by the route of app.py, without admission
+    assert app.url_map.bind('localhost').match('/metrics') == ('metrics', {})
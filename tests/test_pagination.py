@@ -0,0 +1,61 @@
+from pagination import MAX_LIMIT
+from models import db, Planet
+
+NAMES = ['Tatooine', 'Alderaan', 'Yavin IV', 'Hoth', 'Dagobah']
+
+
+def add_planets(app):
+    with app.app_context():
+        db.session.add_all([Planet(name=name, climate='', terrain='', description='') for name in NAMES])
+        db.session.commit()
+
+
+def walk(client, path):
+    pages, names = [], []
+    while path is not None:
+        response = client.get(path)
+        assert response.status_code == 200
+        body = response.get_json()
+        names += [planet['name'] for planet in body['data']]
+        path = body.get('next')
+        # the same link in the body and in the header
+        if path is None:
+            assert 'Link' not in response.headers
+        else:
+            assert response.headers['Link'] == f'<{path}>; rel="next"'
+        pages.append(len(body['data']))
+    return pages, names
+
+
+def test_pages_follow_the_cursors(app, client):
+    add_planets(app)
+    assert walk(client, '/planets?limit=2') == ([2, 2, 1], NAMES)
+    assert walk(client, '/planets?limit=2&sort=name') == ([2, 2, 1], sorted(NAMES))
+    assert walk(client, '/planets?limit=3&sort=-name') == ([3, 2], sorted(NAMES, reverse=True))
+
+
+def test_cursor_is_kept_past_a_deleted_row(app, client):
+    add_planets(app)
+    first = client.get('/planets?limit=2&sort=name').get_json()
+    with app.app_context():
+        # Alderaan and Dagobah are on the first page
+        db.session.delete(Planet.query.filter_by(name='Dagobah').one())
+        db.session.commit()
+    assert [planet['name'] for planet in client.get(first['next']).get_json()['data']] == ['Hoth', 'Tatooine']
+
+
+def test_without_limit_the_whole_list_is_answered(app, client):
+    add_planets(app)
+    response = client.get('/planets?sort=name')
+    assert [planet['name'] for planet in response.get_json()['data']] == sorted(NAMES)
+    assert 'next' not in response.get_json() and 'Link' not in response.headers
+
+
+def test_invalid_limit_or_cursor(app, client):
+    add_planets(app)
+    assert client.get('/planets?limit=0').status_code == 400
+    assert client.get('/planets?after=not-a-cursor').status_code == 400
+    # an id cursor is not a cursor of another sort
+    cursor = client.get('/planets?limit=1').get_json()['next'].split('after=')[1]
+    assert client.get(f'/planets?sort=name&after={cursor}').status_code == 400
+    assert len(client.get(f'/planets?limit={MAX_LIMIT + 1}').get_json()['data']) == len(NAMES)
@@ -0,0 +1,41 @@
+from sqlalchemy import insert, update
+from models import db, Planet, TableChange
+from precompiled import precompiled_lists
+from versions import table_versions
+
+
+def planet_names(client):
+    return [planet['name'] for planet in client.get('/planets').get_json()['data']]
+
+
+def test_local_write_patches_the_list(app, client):
+    with app.app_context():
+        db.session.add(Planet(name='Tatooine', climate='arid', terrain='desert', description=''))
+        db.session.commit()
+    assert planet_names(client) == ['Tatooine']
+    patches = precompiled_lists['planets'].patches
+
+    with app.app_context():
+        db.session.add(Planet(name='Hoth', climate='frozen', terrain='tundra', description=''))
+        db.session.commit()
+
+    assert planet_names(client) == ['Tatooine', 'Hoth']
+    assert precompiled_lists['planets'].patches == patches + 1
+
+
+def test_write_of_another_process_reaches_the_list(app, client, monkeypatch):
+    monkeypatch.setattr(table_versions, 'poll_seconds', 0)
+    with app.app_context():
+        db.session.add(Planet(name='Tatooine', climate='arid', terrain='desert', description=''))
+        db.session.commit()
+    assert planet_names(client) == ['Tatooine']
+
+    # what another worker or a CLI command does, unseen by the listeners of this process
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.execute(update(Planet).values(name='Jakku'))
+            connection.execute(insert(Planet).values(name='Hoth', climate='frozen', terrain='tundra', description=''))
+            connection.execute(update(TableChange).where(TableChange.table_name == 'planets').values(
+                version=TableChange.version + 1))
+
+    assert planet_names(client) == ['Jakku', 'Hoth']
@@ -0,0 +1,52 @@
+import pytest
+from sqlalchemy import text
+import search
+from models import db, Planet
+
+
+@pytest.fixture
+def planets(app):
+    with app.app_context():
+        # the name match comes last by id
+        db.session.add_all([Planet(name=f'Rim world {number}', climate='', terrain='',
+                                   description='a desert planet far from the desert core') for number in range(4)])
+        db.session.add(Planet(name='Desert', climate='', terrain='', description='sand'))
+        db.session.add(Planet(name='Hoth_base', climate='', terrain='', description='ice'))
+        db.session.add(Planet(name='Hothxbase', climate='', terrain='', description='ice'))
+        db.session.commit()
+
+
+def names(response):
+    return [result['name'] for result in response.get_json()['data']]
+
+
+def test_name_matches_rank_first(app, client, planets):
+    response = client.get('/search?q=desert&type=planet')
+    assert response.status_code == 200
+    assert names(response)[0] == 'Desert'
+    assert len(names(response)) == 5
+    assert response.get_json()['truncated'] is False
+
+
+def test_candidates_are_the_best_matches(app, client, planets, monkeypatch):
+    monkeypatch.setattr(search, 'SEARCH_MAX_CANDIDATES', 2)
+    response = client.get('/search?q=desert&type=planet')
+    assert names(response)[0] == 'Desert'
+    assert len(names(response)) == 2
+    assert response.get_json()['truncated'] is True
+    # the pages walk the same candidates
+    first = client.get('/search?q=desert&type=planet&limit=1').get_json()
+    assert [result['name'] for result in first['data']] == ['Desert']
+    assert len(client.get(first['next']).get_json()['data']) == 1
+
+
+def test_like_fallback_escapes_wildcards(app, planets):
+    with app.app_context():
+        statement = text(search._matches('default', 'planet', 'planets'))
+        rows = db.session.execute(statement, search._params(['hoth_base'])).all()
+    assert [row.name for row in rows] == ['Hoth_base']
+
+
+def test_search_needs_words(app, client):
+    assert client.get('/search?q=%20!').status_code == 400
+    assert client.get('/search?q=hoth&type=droid').status_code == 400
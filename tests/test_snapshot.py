@@ -0,0 +1,56 @@
+import io
+import pytest
+from models import db, Change, Character, Favorite, Planet, User
+from snapshot import SnapshotError, export_snapshot, restore_snapshot
+
+
+def add_catalog():
+    user = User(name='Luke', email='luke@example.com', password='secret', is_active=True)
+    planet = Planet(name='Tatooine', climate='arid', terrain='desert', description='Twin suns')
+    character = Character(name='Luke Skywalker', height=172, description='', planet=planet)
+    db.session.add_all([user, planet, character])
+    db.session.flush()
+    db.session.add(Favorite(user_id=user.id, planet_id=planet.id))
+    db.session.commit()
+
+
+def test_snapshot_round_trip(app):
+    with app.app_context():
+        add_catalog()
+        stream = io.BytesIO()
+        export_snapshot(stream, chunk_size=1)
+
+        db.session.query(Favorite).delete()
+        db.session.query(Character).delete()
+        Planet.query.one().name = 'Jakku'
+        db.session.add(Planet(name='Hoth', climate='frozen', terrain='tundra', description=''))
+        db.session.commit()
+
+        stream.seek(0)
+        counts = restore_snapshot(stream)
+        db.session.expire_all()
+
+        assert counts['planets'] == 1 and counts['characters'] == 1 and counts['favorites'] == 1
+        assert [planet.name for planet in Planet.query] == ['Tatooine']
+        character = Character.query.one()
+        assert character.planet.name == 'Tatooine'
+        favorite = Favorite.query.one()
+        assert (favorite.user.email, favorite.planet_id) == ('luke@example.com', character.planet_id)
+        # the change log starts over from a horizon
+        assert [change.op for change in Change.query] == ['horizon']
+        # the sequences continue after the restored ids
+        db.session.add(Planet(name='Hoth', climate='frozen', terrain='tundra', description=''))
+        db.session.commit()
+
+
+def test_truncated_snapshot_leaves_the_database_alone(app):
+    with app.app_context():
+        add_catalog()
+        stream = io.BytesIO()
+        export_snapshot(stream)
+
+        with pytest.raises(SnapshotError):
+            restore_snapshot(io.BytesIO(stream.getvalue()[:-10]))
+        db.session.expire_all()
+        assert Planet.query.one().name == 'Tatooine'
+        assert Favorite.query.count() == 1